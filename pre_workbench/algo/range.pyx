@@ -10,7 +10,9 @@ cdef class Range:
 	cdef readonly int start
 	cdef readonly int end
 	cdef readonly int bytes_size
-	cdef readonly dict metadata
+	cdef dict _metadata
+	cdef object _metadata_loader
+	cdef object _metadata_state
 	cdef readonly int buffer_idx
 	cdef public object exception
 
@@ -21,10 +23,38 @@ cdef class Range:
 		self.start = start
 		self.end = end
 		self.bytes_size = end - start
-		self.metadata = {}
+		self._metadata = {}
 		self.buffer_idx = buffer_idx
 		self.exception = None
-		if meta: self.metadata.update(meta)
+		if meta: self._metadata.update(meta)
+
+	@property
+	def metadata(self):
+		if self._metadata_loader is not None:
+			loader, state = self._metadata_loader, self._metadata_state
+			self._metadata_loader = self._metadata_state = None
+			loader(self, self._metadata, state)
+		return self._metadata
+
+	def set_metadata_loader(self, loader, state):
+		"""
+		Defers computing metadata entries until the metadata is first accessed, then loader(range, metadata, state)
+		is called to add them. Entries already present are visible to matches() without calling the loader.
+		"""
+		self._metadata_loader = loader
+		self._metadata_state = state
+
+	@property
+	def metadata_state(self):
+		"""The state passed to set_metadata_loader until the loader is called, otherwise None"""
+		return self._metadata_state
+
+	def get_metadata(self, bint load=True):
+		"""Returns the metadata, without calling the loader if load is False"""
+		return self.metadata if load else self._metadata
+
+	cdef bint _has_meta_key(self, key):
+		return key in self._metadata or key in self.metadata
 
 	def __serialize__(self):
 		return [self.start, self.end, self.value, self.source_desc, self.field_name, self.metadata, self.buffer_idx, self.exception]
@@ -65,8 +95,8 @@ cdef class Range:
 		if contains is not None and not self.contains(contains): return False
 		if overlaps is not None and not self.overlaps(overlaps): return False
 		if containsRange is not None and not self.containsRange(containsRange): return False
-		if hasMetaKey is not None and hasMetaKey not in self.metadata: return False
-		if doesntHaveMetaKey is not None and doesntHaveMetaKey in self.metadata: return False
+		if hasMetaKey is not None and not self._has_meta_key(hasMetaKey): return False
+		if doesntHaveMetaKey is not None and self._has_meta_key(doesntHaveMetaKey): return False
 		for k, v in kw.items():
 			if self.metadata.get(k) == v: continue
 			return False
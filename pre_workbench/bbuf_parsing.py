@@ -14,32 +14,144 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
+import itertools
 import logging
 
-from pre_workbench import app
+from pre_workbench import app, configs
+from pre_workbench.configs import SettingsSection
+from pre_workbench.structinfo.compiler import CompiledParseContext
+from pre_workbench.structinfo.parallel import dump_parse_result, load_parse_result
 from pre_workbench.structinfo.parsecontext import AnnotatingParseContext, FormatInfoContainer
 
+configs.registerOption(SettingsSection('General', 'General', 'Parser', 'Grammar Parser'),
+					   "LazyRepeatThreshold", "Decode repeats of at least this many fixed-size elements on demand (0 = off)",
+					   "int", {'min': 0, 'max': 1000000000}, 10000, None)
+configs.registerOption(SettingsSection('General', 'General', 'Parser', 'Grammar Parser'),
+					   "LazyCacheSize", "Number of decoded elements kept per lazy repeat",
+					   "int", {'min': 1, 'max': 1000000000}, 1024, None)
+configs.registerOption(SettingsSection('General', 'General', 'Parser', 'Grammar Parser'),
+					   "ResultCacheSize", "Size of the parse result cache in the project database in MB (0 = off)",
+					   "int", {'min': 0, 'max': 1000000}, 64, None)
+
+# collects statistics of the annotated parses while the parse profiler is recording, see ParseProfilerDockWidget
+active_profile = None
+
 
 class BytebufferAnnotatingParseContext(AnnotatingParseContext):
 	def __init__(self, format_infos: FormatInfoContainer, bbuf):
 		super().__init__(format_infos, bbuf.buffer)
 		self.bbuf = bbuf
 
+	def derive(self):
+		ctx = super().derive()
+		# ranges of lazily decoded repeat elements are not added to the buffer
+		ctx.bbuf = None
+		return ctx
+
 	def pack_value(self, value):
 		range = super().pack_value(value)
-		self.bbuf.addRange(range)
+		if self.bbuf is not None:
+			self.bbuf.addRange(range)
 		return range
 
-def apply_grammar_on_bbuf(bbuf, grammarDefName, on_new_subflow_category=None):
+def apply_grammar_on_bbuf(bbuf, grammarDefName, on_new_subflow_category=None, annotate=True, background=False, fi_container=None):
+	"""
+	Parses bbuf with the grammar definition grammarDefName from the current project and stores the result in
+	bbuf.fi_tree. If annotate is False, the buffer is parsed by the compiled grammar, no ranges are created and
+	fi_tree contains plain values.
+
+	Annotated results are stored in the parse result cache of the project, and loaded from it if the buffer was
+	parsed with the same definitions before, unless the parse profiler is recording.
+
+	Set background on other threads than the GUI thread, for buffers not shown yet. The parse result cache and the
+	parse profiler belong to the GUI thread and are not used then. As the GUI thread may edit the definitions of
+	the project, pass a copy of them as fi_container (see FormatInfoContainer.copy).
+	"""
 	if not grammarDefName: return
 	# clear out the old ranges from the last run, but don't delete ranges from other sources (e.g. style, bidi-buf)
 	bbuf.setRanges(bbuf.matchRanges(doesntHaveMetaKey='_sdef_ref'))
-	bbuf.fi_container = app.CurrentProject.formatInfoContainer
-	parse_context = BytebufferAnnotatingParseContext(bbuf.fi_container, bbuf)
+	bbuf.fi_container = app.CurrentProject.formatInfoContainer if fi_container is None else fi_container
+	cacheKey = None
+	if annotate and not background and active_profile is None and configs.getValue("General.Parser.ResultCacheSize"):
+		cacheKey = (grammarDefName, bbuf.fi_container.definition_hash(grammarDefName), hashlib.sha256(bbuf.buffer).digest())
+		if _load_cached_parse_result(bbuf, grammarDefName, cacheKey):
+			return
+	if annotate:
+		parse_context = BytebufferAnnotatingParseContext(bbuf.fi_container, bbuf)
+		parse_context.lazy_repeat_threshold = configs.getValue("General.Parser.LazyRepeatThreshold") or None
+		parse_context.lazy_cache_size = configs.getValue("General.Parser.LazyCacheSize")
+		parse_context.profile = None if background else active_profile
+	else:
+		parse_context = CompiledParseContext(bbuf.fi_container, bbuf.buffer)
 	parse_context.on_new_subflow_category = on_new_subflow_category
 	bbuf.fi_root_name = grammarDefName
 	bbuf.fi_tree = parse_context.parse(grammarDefName)
 	bbuf.subflow_categories = parse_context.subflow_categories
+	# the compiled grammar doesn't record the definitions it used
+	bbuf.fi_used_definitions = bbuf.fi_container.snapshot_definitions(
+		parse_context.used_definitions if annotate else bbuf.fi_container.reachable_definitions(grammarDefName))
 	if parse_context.failed:
-		logging.exception("Failed to apply grammar definition", exc_info=parse_context.failed)
-		logging.getLogger("DataSource").error("Failed to apply grammar definition: " + str(parse_context.failed))
+		_log_failure(parse_context.failed)
+	if cacheKey is not None:
+		_store_cached_parse_result(bbuf, grammarDefName, cacheKey, parse_context.failed)
+
+def grammar_changed(bbuf, grammarDefName):
+	"""
+	Returns whether parsing bbuf with grammarDefName from the current project might give a different result than
+	the last apply_grammar_on_bbuf, i.e. whether a definition its parse used was changed since.
+	"""
+	fic = app.CurrentProject.formatInfoContainer
+	return (bbuf.fi_used_definitions is None or bbuf.fi_container is not fic or bbuf.fi_root_name != grammarDefName
+			or fic.definitions_changed(bbuf.fi_used_definitions))
+
+def _load_cached_parse_result(bbuf, grammarDefName, cacheKey):
+	data = app.CurrentProject.getParseResult(*cacheKey)
+	if data is None:
+		return False
+	try:
+		result = load_parse_result(bbuf.fi_container, grammarDefName, bbuf.buffer, data)
+	except Exception as ex:
+		logging.warning("Failed to load cached parse result: %r", ex)
+		return False
+	set_parse_result(bbuf, bbuf.fi_container, grammarDefName, *result)
+	return True
+
+def _store_cached_parse_result(bbuf, grammarDefName, cacheKey, failed):
+	try:
+		data = dump_parse_result(bbuf.fi_container, grammarDefName, bbuf.buffer, bbuf.fi_tree, failed)
+	except Exception as ex:
+		logging.warning("Failed to serialize parse result for the cache: %r", ex)
+		return
+	if data is not None:
+		app.CurrentProject.storeParseResult(*cacheKey, data, configs.getValue("General.Parser.ResultCacheSize") * 1024 * 1024)
+
+def set_parse_result(bbuf, fi_container, grammarDefName, fi_tree, ranges, failed=None):
+	"""
+	Stores the result of parsing bbuf with grammarDefName elsewhere, e.g. in a worker process (see
+	structinfo.parallel), like apply_grammar_on_bbuf does. ranges are all ranges of fi_tree.
+	"""
+	bbuf.setRanges(itertools.chain(bbuf.matchRanges(doesntHaveMetaKey='_sdef_ref'), ranges))
+	bbuf.fi_tree = fi_tree
+	_set_parse_result_info(bbuf, fi_container, grammarDefName, failed)
+
+def set_pending_parse_result(bbuf, fi_container, grammarDefName, load, failed=None):
+	"""
+	Like set_parse_result, but fi_tree and its ranges are returned by load, which is only called on first access of
+	bbuf.fi_tree or bbuf.ranges, see ByteBuffer.setPendingResult.
+	"""
+	bbuf.setRanges(bbuf.matchRanges(doesntHaveMetaKey='_sdef_ref'))
+	bbuf.setPendingResult(load)
+	_set_parse_result_info(bbuf, fi_container, grammarDefName, failed)
+
+def _set_parse_result_info(bbuf, fi_container, grammarDefName, failed):
+	bbuf.fi_container = fi_container
+	bbuf.fi_root_name = grammarDefName
+	bbuf.fi_used_definitions = fi_container.snapshot_definitions(fi_container.reachable_definitions(grammarDefName))
+	bbuf.subflow_categories = dict()
+	if failed:
+		_log_failure(failed)
+
+def _log_failure(ex):
+	logging.exception("Failed to apply grammar definition", exc_info=ex)
+	logging.getLogger("DataSource").error("Failed to apply grammar definition: " + str(ex))
@@ -30,7 +30,7 @@ from PyQt5.QtGui import QPainter, QFont, QColor, QPixmap, QFontMetrics, QKeyEven
 from PyQt5.QtWidgets import QApplication, QMenu, QSizePolicy, QAction, QInputDialog, QMessageBox, \
 	QAbstractScrollArea
 
-from pre_workbench.bbuf_parsing import apply_grammar_on_bbuf
+from pre_workbench.bbuf_parsing import apply_grammar_on_bbuf, grammar_changed
 from pre_workbench import configs, guihelper
 from pre_workbench.algo.range import Range
 from pre_workbench.configs import SettingsSection
@@ -477,12 +477,20 @@ class HexView2(QAbstractScrollArea):
 	################# FI Tree ####################################################
 
 	def _formatInfoUpdated(self):
-		self.applyFormatInfo()
-
-	def applyFormatInfo(self, root_name=None, bufIdx=None):
+		self.applyFormatInfo(onlyChanged=True)
+
+	def applyFormatInfo(self, root_name=None, bufIdx=None, onlyChanged=False):
+		"""
+		Parses the buffers with their grammar definition, or root_name. If onlyChanged is set, buffers are skipped
+		if none of the definitions used by their last parse have been changed since.
+		"""
+		parsed = False
 		for buf in self.buffers if bufIdx is None else [self.buffers[bufIdx]]:
 			if root_name is not None: buf.fi_root_name = root_name
+			if onlyChanged and not grammar_changed(buf, buf.fi_root_name): continue
 			apply_grammar_on_bbuf(buf, buf.fi_root_name, self._newSubflowCategory)
+			parsed = True
+		if not parsed: return
 		self.parseResultsUpdated.emit([buf.fi_tree for buf in self.buffers])
 		self.redraw()
 
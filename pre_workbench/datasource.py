@@ -19,18 +19,29 @@ import re
 import binascii
 import glob
 import logging
+import multiprocessing
 import os
+import queue
+import signal
+import socket
+import subprocess
+import sys
+import threading
 import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
-from PyQt5.QtCore import (pyqtSignal, QObject, QProcess)
-from PyQt5.QtNetwork import QUdpSocket, QHostAddress
+from PyQt5.QtCore import (pyqtSignal, QObject, QProcess, QTimer)
 
-from pre_workbench.bbuf_parsing import apply_grammar_on_bbuf
+from pre_workbench import bbuf_parsing
+from pre_workbench.bbuf_parsing import apply_grammar_on_bbuf, set_pending_parse_result
 from pre_workbench.configs import SettingsField, SettingsSection, registerOption, getValue
 from pre_workbench.guihelper import APP
-from pre_workbench.objects import ByteBuffer, ByteBufferList, ReloadRequired
-from pre_workbench.structinfo.exceptions import invalid, incomplete
-from pre_workbench.structinfo.pcap_reader import read_pcap_file, PcapFormats
+from pre_workbench.objects import ByteBuffer, ByteBufferList, ReloadRequired, LazyByteBufferList
+from pre_workbench.structinfo.parallel import init_parse_worker, parse_batch, load_batch, index_format_infos, \
+	parallel_parsing_supported, pickle_definitions
+from pre_workbench.structinfo.pcap_index import PcapIndex, PcapPacketReader, INDEX_SUFFIX
+from pre_workbench.structinfo.pcap_reader import PcapStreamDecoder
 from pre_workbench.typeregistry import TypeRegistry
 from pre_workbench.tshark_helper import findTshark, PdmlToPacketListParser, findInterfaces
 from pre_workbench.util import PerfTimer
@@ -42,11 +53,42 @@ except FileNotFoundError:
 	tsharkDefault = ""
 registerOption(group, "tsharkBinary", "tshark Binary", "text", {"fileselect":"open"}, tsharkDefault, None)
 
+group = SettingsSection('DataSources', 'Data Sources', 'parsing', 'Grammar Parsing')
+registerOption(group, "parallelWorkers", "Worker processes applying grammar definitions to buffer lists (0 = off)", "int", {"min": 0, "max": 256}, 0, None)
+registerOption(group, "parallelBatchSize", "Buffers per batch sent to a worker process", "int", {"min": 1, "max": 1000000}, 500, None)
+
+group = SettingsSection('DataSources', 'Data Sources', 'pcap', 'PCAP Files')
+registerOption(group, "sidecarIndex", "Store the packet offset index next to the capture file (file name + %s)" % INDEX_SUFFIX, "check", {}, True, None)
+
+group = SettingsSection('DataSources', 'Data Sources', 'live', 'Live Captures')
+registerOption(group, "refreshRate", "Packet list updates per second", "int", {"min": 1, "max": 100}, 10, None)
+registerOption(group, "maxPending", "Drop packets arriving while this many are waiting to be added to the packet list", "int", {"min": 1, "max": 1000000000}, 200000, None)
+
+group = SettingsSection('DataSources', 'Data Sources', 'lazy', 'Large Buffer Lists')
+registerOption(group, "lazyThreshold", "Load the buffers of lists with at least this many buffers on access (0 = off)", "int", {"min": 0, "max": 1000000000}, 100000, None)
+registerOption(group, "lazyCacheSize", "Number of recently used buffers kept in memory per lazily loaded list", "int", {"min": 1, "max": 1000000000}, 4096, None)
+
 DataSourceTypes = TypeRegistry("DataSourceTypes")
 
 
+def makeBufferList(provider, count) -> ByteBufferList:
+	"""
+	Returns a list of the buffers provider(0) ... provider(count - 1). It's a LazyByteBufferList creating them on
+	access if count reaches DataSources.lazy.lazyThreshold.
+	"""
+	threshold = getValue("DataSources.lazy.lazyThreshold")
+	if threshold and count >= threshold:
+		return LazyByteBufferList(provider, count, getValue("DataSources.lazy.lazyCacheSize"))
+	plist = ByteBufferList()
+	for i in range(count):
+		plist.add(provider(i))
+	return plist
+
+
 class DataSource(QObject):
 	on_finished = pyqtSignal()
+	on_progress = pyqtSignal(int, int)
+	on_stats = pyqtSignal(dict)
 	logger = logging.getLogger("DataSource")
 	def __init__(self, params):
 		super().__init__()
@@ -57,6 +99,9 @@ class DataSource(QObject):
 		pass
 	def cancelFetch(self):
 		pass
+	def close(self):
+		"""Called when the fetched data isn't used anymore, to release resources like open files"""
+		pass
 
 
 class SyncDataSource(DataSource):
@@ -69,6 +114,261 @@ class SyncDataSource(DataSource):
 		pass
 
 
+class BufferListDataSource(SyncDataSource):
+	"""
+	Base class of data sources which load a list of buffers and apply the grammar definition params["formatInfo"]
+	on each of them. If the option DataSources.parsing.parallelWorkers is set, the grammar is applied by a pool of
+	worker processes: startFetch returns an empty list, the buffers are added in batches in their original order
+	as they are parsed, and on_finished is emitted when all are done. Grammars using reassemble_into or store_into
+	are always applied here, as is every grammar while the parse profiler is recording.
+
+	If loadBuffers returns a LazyByteBufferList, the grammar is applied on each buffer when it is loaded instead.
+	"""
+	_batch_done = pyqtSignal(int, object)
+
+	def __init__(self, params):
+		super().__init__(params)
+		self.plist = None
+		self.executor = None
+
+	def loadBuffers(self) -> ByteBufferList:
+		raise NotImplementedError()
+
+	def process(self):
+		plist = self.plist = self.loadBuffers()
+		if isinstance(plist, LazyByteBufferList):
+			return self._applyGrammarOnLoad(plist)
+		with PerfTimer('Parse Buffers'):
+			for bbuf in plist.buffers:
+				apply_grammar_on_bbuf(bbuf, self.params["formatInfo"])
+		APP().project.flushParseResults()
+		return plist
+
+	def startFetch(self):
+		workers = getValue("DataSources.parsing.parallelWorkers")
+		self.executor = None
+		if not workers or not self.params.get("formatInfo") or bbuf_parsing.active_profile is not None:
+			return super().startFetch()
+		self.fic = APP().project.formatInfoContainer
+		if not parallel_parsing_supported(self.fic):
+			return super().startFetch()
+
+		loaded = self.loadBuffers()
+		if isinstance(loaded, LazyByteBufferList):
+			self.plist = loaded
+			self.on_finished.emit()
+			return self._applyGrammarOnLoad(loaded)
+		self.plist = ByteBufferList()
+		self.plist.metadata = loaded.metadata
+		self.descs = index_format_infos(self.fic)
+		batchSize = getValue("DataSources.parsing.parallelBatchSize")
+		self.batches = [loaded.buffers[i:i + batchSize] for i in range(0, len(loaded.buffers), batchSize)]
+		self.results = dict()
+		self.nextBatch = 0
+		self.parsedCount = 0
+		self.totalCount = len(loaded.buffers)
+		if not self.batches:
+			self.on_finished.emit()
+			return self.plist
+
+		self._batch_done.connect(self._onBatchDone)
+		# spawn instead of fork, forking a process running Qt threads is unsafe
+		self.executor = ProcessPoolExecutor(min(workers, len(self.batches)), multiprocessing.get_context("spawn"),
+											initializer=init_parse_worker, initargs=(pickle_definitions(self.fic),))
+		for i, batch in enumerate(self.batches):
+			future = self.executor.submit(parse_batch, self.params["formatInfo"], [bbuf.buffer for bbuf in batch])
+			future.add_done_callback(lambda future, i=i: self._onBatchParsed(i, future))
+		return self.plist
+
+	def _applyGrammarOnLoad(self, plist):
+		formatInfo = self.params.get("formatInfo")
+		if formatInfo:
+			plist.buffers.on_load = lambda bbuf: apply_grammar_on_bbuf(bbuf, formatInfo)
+		return plist
+
+	def _onBatchParsed(self, i, future):
+		# called on an executor thread, only the results are loaded here. Storing them in the buffers reads the
+		# caches of the project's definitions, which the GUI thread may edit, so that's left to _onBatchDone. The
+		# range trees are decoded on first access
+		if future.cancelled(): return
+		try:
+			batch = self.batches[i]
+			self._batch_done.emit(i, load_batch(future.result(), self.descs, [bbuf.buffer for bbuf in batch]))
+		except Exception as ex:
+			self.logger.warning("Parsing batch %d in worker process failed, parsing it here instead: %r", i, ex)
+			self._batch_done.emit(i, None)
+
+	def _onBatchDone(self, i, results):
+		# results are those of load_batch, or None if the whole batch is parsed here
+		if self.executor is None: return
+		self.results[i] = results
+		self.plist.beginUpdate()
+		while self.nextBatch in self.results:
+			results = self.results.pop(self.nextBatch)
+			batch = self.batches[self.nextBatch]
+			for bbuf, result in zip(batch, [None] * len(batch) if results is None else results):
+				if result is None:
+					apply_grammar_on_bbuf(bbuf, self.params["formatInfo"])
+				else:
+					set_pending_parse_result(bbuf, self.fic, self.params["formatInfo"], *result)
+				self.plist.add(bbuf)
+				self.parsedCount += 1
+			self.batches[self.nextBatch] = None
+			self.nextBatch += 1
+		self.plist.endUpdate()
+		self.on_progress.emit(self.parsedCount, self.totalCount)
+
+		if self.nextBatch == len(self.batches):
+			self._shutdownExecutor()
+			self.on_finished.emit()
+
+	def _shutdownExecutor(self):
+		self.executor.shutdown(wait=False, cancel_futures=True)
+		self.executor = None
+
+	def cancelFetch(self):
+		if self.executor is not None:
+			self._shutdownExecutor()
+			self.on_finished.emit()
+
+	def close(self):
+		if self.executor is not None:
+			self._shutdownExecutor()
+		if self.plist is not None:
+			self.plist.close()
+
+
+class CaptureStats:
+	"""
+	Packet counters of a live data source. The rates are updated by snapshot at most once per second. Packets
+	dropped by the operating system are counted in kernelDropped, if the source can tell.
+	"""
+	def __init__(self):
+		self.packets = 0
+		self.bytes = 0
+		self.dropped = 0
+		self.kernelDropped = 0
+		self.evicted = 0
+		self.lastTime = time.monotonic()
+		self.lastPackets = 0
+		self.lastBytes = 0
+		self.packetsPerSec = 0.0
+		self.bytesPerSec = 0.0
+
+	def snapshot(self):
+		now = time.monotonic()
+		if now - self.lastTime >= 1:
+			self.packetsPerSec = (self.packets - self.lastPackets) / (now - self.lastTime)
+			self.bytesPerSec = (self.bytes - self.lastBytes) / (now - self.lastTime)
+			self.lastTime, self.lastPackets, self.lastBytes = now, self.packets, self.bytes
+		return {'packets': self.packets, 'bytes': self.bytes, 'packetsPerSec': self.packetsPerSec,
+				'bytesPerSec': self.bytesPerSec, 'dropped': self.dropped + self.kernelDropped, 'evicted': self.evicted}
+
+
+class LiveBufferListDataSource(DataSource):
+	"""
+	Base class of live data sources receiving packets in a worker thread, started by startWorker. The worker passes
+	each packet to enqueue, and calls workerFinished when it's done. A timer adds the queued packets to the list in
+	one beginUpdate/endUpdate block, DataSources.live.refreshRate times per second at most. Packets arriving while
+	DataSources.live.maxPending packets are queued are dropped, and params["retention"] limits the list to the most
+	recent packets. The counters of CaptureStats are emitted by on_stats and stored in the list metadata.
+
+	If params["formatInfo"] is set, the grammar is applied on the packets by a parser thread before they are queued.
+	It uses a copy of the project's definitions from startFetch, so edits don't affect it while it's parsing.
+
+	close stops the worker by cancelFetch, the parser thread and the timer, the packets still queued are discarded.
+	"""
+	def __init__(self, params):
+		super().__init__(params)
+		self.plist = None
+		self.closed = False
+
+	def startFetch(self):
+		self.plist = ByteBufferList()
+		self.queue = deque()
+		self.stats = CaptureStats()
+		self.maxPending = getValue("DataSources.live.maxPending")
+		self.retention = int(self.params.get("retention") or 0)
+		self.formatInfo = self.params.get("formatInfo")
+		self.parseQueue = None
+		self.finished = False
+		if self.formatInfo:
+			self.fic = APP().project.formatInfoContainer.copy()
+			self.parseQueue = queue.SimpleQueue()
+		self.startWorker()
+		if self.formatInfo:
+			threading.Thread(target=self._parseWorker, name=type(self).__name__ + " parser", daemon=True).start()
+		self.timer = QTimer()
+		self.timer.timeout.connect(self._flushQueue)
+		self.timer.start(max(1, 1000 // getValue("DataSources.live.refreshRate")))
+		return self.plist
+
+	def startWorker(self):
+		raise NotImplementedError()
+
+	def enqueue(self, bbuf: ByteBuffer):
+		# called on the worker thread
+		self.stats.packets += 1
+		self.stats.bytes += len(bbuf.buffer)
+		parseQueue = self.parseQueue
+		if len(self.queue) + (0 if parseQueue is None else parseQueue.qsize()) >= self.maxPending:
+			self.stats.dropped += 1
+		elif parseQueue is not None:
+			parseQueue.put(bbuf)
+		else:
+			self.queue.append(bbuf)
+
+	def workerFinished(self):
+		# called on the worker thread, the timer emits on_finished after adding the remaining packets
+		if self.parseQueue is not None:
+			self.parseQueue.put(None)
+		else:
+			self.finished = True
+
+	def _parseWorker(self):
+		while True:
+			bbuf = self.parseQueue.get()
+			if bbuf is None or self.closed: break
+			try:
+				apply_grammar_on_bbuf(bbuf, self.formatInfo, background=True, fi_container=self.fic)
+			except Exception:
+				self.logger.exception("Failed to apply grammar definition %s", self.formatInfo)
+			self.queue.append(bbuf)
+		self.finished = True
+
+	def _flushQueue(self):
+		finished = self.finished
+		count = len(self.queue)
+		if count:
+			batch = [self.queue.popleft() for _ in range(count)]
+			if self.retention and count > self.retention:
+				self.stats.evicted += count - self.retention
+				batch = batch[count - self.retention:]
+			self.plist.beginUpdate()
+			for bbuf in batch:
+				self.plist.add(bbuf)
+			self.plist.endUpdate()
+			if self.retention and len(self.plist) > self.retention:
+				self.stats.evicted += len(self.plist) - self.retention
+				self.plist.removeOldest(len(self.plist) - self.retention)
+		stats = self.stats.snapshot()
+		self.plist.metadata['captureStats'] = stats
+		self.on_stats.emit(stats)
+		if finished and not self.queue:
+			self.timer.stop()
+			self.on_finished.emit()
+
+	def close(self):
+		if self.plist is None or self.closed: return
+		self.closed = True
+		self.cancelFetch()
+		self.timer.stop()
+		if self.parseQueue is not None:
+			self.parseQueue.put(None)
+		self.queue.clear()
+		self.plist.close()
+
+
 class MacroDataSource(SyncDataSource):
 	def __init__(self, macro_container_id, macroname, params):
 		super().__init__(params)
@@ -99,7 +399,7 @@ class FileDataSource(SyncDataSource):
 
 
 @DataSourceTypes.register(DisplayName="Directory of binary files", Async=False, OutputType="BYTE_BUFFER_LIST")
-class DirectoryOfBinFilesDataSource(SyncDataSource):
+class DirectoryOfBinFilesDataSource(BufferListDataSource):
 	@staticmethod
 	def getConfigFields():
 		return [
@@ -108,25 +408,22 @@ class DirectoryOfBinFilesDataSource(SyncDataSource):
 			SettingsField("formatInfo", "Grammar definition", "text", {"listselectcallback":formatinfoSelect})
 		]
 
-	def process(self):
+	def loadBuffers(self):
 		globStr = self.params['fileName'] + '/' + self.params['filePattern']
-		plist = ByteBufferList()
-		for fileName in sorted(glob.glob(globStr)):
-			if not os.path.isfile(fileName): continue
-			bbuf = ByteBuffer(metadata={'fileName': os.path.basename(fileName),
-										'fileTimestamp': os.path.getmtime(fileName)})
-			with open(fileName, "rb") as f:
-				bbuf.setContent(f.read())
-
-			apply_grammar_on_bbuf(bbuf, self.params["formatInfo"])
+		fileNames = [fileName for fileName in sorted(glob.glob(globStr)) if os.path.isfile(fileName)]
+		return makeBufferList(lambda i: self._readFile(fileNames[i]), len(fileNames))
 
-			plist.add(bbuf)
-
-		return plist
+	@staticmethod
+	def _readFile(fileName):
+		bbuf = ByteBuffer(metadata={'fileName': os.path.basename(fileName),
+									'fileTimestamp': os.path.getmtime(fileName)})
+		with open(fileName, "rb") as f:
+			bbuf.setContent(f.read())
+		return bbuf
 
 
 @DataSourceTypes.register(DisplayName = "CSV file", Async=False, OutputType="BYTE_BUFFER_LIST")
-class CSVFileDataSource(SyncDataSource):
+class CSVFileDataSource(BufferListDataSource):
 	@staticmethod
 	def getConfigFields():
 		return [
@@ -159,7 +456,7 @@ class CSVFileDataSource(SyncDataSource):
 		else:
 			return {"col%d" % i: field for i, field in enumerate(row)}
 
-	def process(self):
+	def loadBuffers(self):
 		import csv
 		plist = ByteBufferList()
 		decoder = self._getPayloadDecoder()
@@ -180,14 +477,11 @@ class CSVFileDataSource(SyncDataSource):
 				except Exception as exc:
 					raise Exception("Failed to read row %d" % i) from exc
 
-		for bbuf in plist.buffers:
-			apply_grammar_on_bbuf(bbuf, self.params["formatInfo"])
-
 		return plist
 
 
 @DataSourceTypes.register(DisplayName = "PCAP file", Async=False, OutputType="BYTE_BUFFER_LIST")
-class PcapFileDataSource(SyncDataSource):
+class PcapFileDataSource(BufferListDataSource):
 	@staticmethod
 	def getConfigFields():
 		return [
@@ -195,16 +489,17 @@ class PcapFileDataSource(SyncDataSource):
 			SettingsField("formatInfo", "Grammar definition", "text", {"listselectcallback":formatinfoSelect})
 		]
 
-	def process(self):
+	def loadBuffers(self):
+		fileName = self.params['fileName']
+		with PerfTimer('Index PCAP file'):
+			index = PcapIndex.for_file(fileName, getValue("DataSources.pcap.sidecarIndex"))
 		with PerfTimer('Load PCAP file'):
-			with open(self.params['fileName'], "rb") as f:
-				plist = read_pcap_file(f)
-
-		with PerfTimer('Parse Buffers'):
-			for bbuf in plist.buffers:
-				apply_grammar_on_bbuf(bbuf, self.params["formatInfo"])
-
-		return plist
+			reader = PcapPacketReader(fileName, index)
+			plist = makeBufferList(reader, len(reader))
+			plist.metadata = dict(index.metadata)
+			if not isinstance(plist, LazyByteBufferList):
+				reader.close()
+			return plist
 
 
 
@@ -279,106 +574,143 @@ class TsharkLiveDataSource(AbstractTsharkDataSource):
 
 
 @DataSourceTypes.register(DisplayName = "Live capture via PCAP over stdout", Async=True, OutputType="BYTE_BUFFER_LIST")
-class LivePcapCaptureDataSource(DataSource):
+class LivePcapCaptureDataSource(LiveBufferListDataSource):
+	"""
+	Runs a shell command writing a pcap or pcapNG stream to stdout, e.g. tcpdump or tshark with "-w -". The stream is
+	read and decoded on a worker thread.
+	"""
 	@staticmethod
 	def getConfigFields():
 		return [
-			SettingsField("shell_cmd", "Shell command line", "text", {"default":"sudo tcpdump -w -"})
+			SettingsField("shell_cmd", "Shell command line", "text", {"default":"sudo tcpdump -w -"}),
+			SettingsField("retention", "Keep the most recent packets only (0 = all)", "int", {"default":0}),
+			SettingsField("formatInfo", "Grammar definition", "text", {"listselectcallback":formatinfoSelect}),
 		]
 
-	def startFetch(self):
-		self.plist = ByteBufferList()
-		self.packetFI = None
-		from pre_workbench.structinfo.parsecontext import ParseContext
-		self.ctx = ParseContext()
-		self.process = QProcess()
-		self.process.finished.connect(self.onProcessFinished)
-		self.process.readyReadStandardError.connect(self.onReadyReadStderr)
-		self.process.readyReadStandardOutput.connect(self.onReadyReadStdout)
-
-		self.process.start("/bin/sh", ["-c", self.params["shell_cmd"]])
-
-		return self.plist
+	def startWorker(self):
+		self.decoder = PcapStreamDecoder()
+		self.plist.metadata = self.decoder.metadata
+		# in its own process group, so cancelFetch stops the children of the shell too
+		self.process = subprocess.Popen(["/bin/sh", "-c", self.params["shell_cmd"]], stdin=subprocess.DEVNULL,
+										stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+		threading.Thread(target=self._readStdout, name="LivePcapCapture", daemon=True).start()
+		threading.Thread(target=self._readStderr, name="LivePcapCapture stderr", daemon=True).start()
+
+	def _readStdout(self):
+		fd = self.process.stdout.fileno()
+		try:
+			while True:
+				chunk = os.read(fd, 1 << 20)
+				if not chunk: break
+				for bbuf in self.decoder.feed(chunk):
+					self.enqueue(bbuf)
+		except ValueError as ex:
+			self.logger.error("Invalid pcap stream - killing capture: %s", ex)
+			self._signal(signal.SIGKILL)
+		except Exception:
+			self.logger.exception("Reading pcap stream failed")
+			self._signal(signal.SIGKILL)
+		finally:
+			self.process.wait()
+			self.workerFinished()
+
+	def _readStderr(self):
+		for line in self.process.stderr:
+			self.logger.warning("STD-ERR: %s", line.decode("utf-8", "replace").rstrip())
+
+	def _signal(self, sig):
+		try:
+			os.killpg(self.process.pid, sig)
+		except ProcessLookupError:
+			pass
 
-	def tryParseHeader(self):
-		for headerFI, packetFI in PcapFormats:
-			try:
-				header = headerFI.read_from_buffer(self.ctx)
-				self.packetFI = packetFI
-				self.plist.metadata.update(header)
-				return
-			except invalid as ex:
-				self.logger.debug("invalid pcap format, trying next (exception: %r)", ex)
-		raise invalid(self.ctx, "no PcapVariant matched")
+	def cancelFetch(self):
+		self._signal(signal.SIGTERM)
+		try:
+			self.process.wait(0.5)
+		except subprocess.TimeoutExpired:
+			self._signal(signal.SIGKILL)
 
-	def onReadyReadStderr(self):
-		self.logger.warning("STD-ERR: %s", self.process.readAllStandardError().data().decode("utf-8", "replace"))
+# from linux/socket.h, missing in the socket module
+SO_RXQ_OVFL = getattr(socket, "SO_RXQ_OVFL", 40)
 
-	def onReadyReadStdout(self):
-		self.ctx.feed_bytes(self.process.readAllStandardOutput())
-		try:
-			if self.packetFI is None:
-				self.tryParseHeader()
-			while True:
-				packet = self.packetFI.read_from_buffer(self.ctx)
-				self.plist.add(ByteBuffer(packet['payload'], metadata=packet['header']))
-		except incomplete:
-			return
-		except invalid as ex:
-			self.logger.exception("Invalid packet format - killing pcap")
-			self.cancelFetch()
 
-	def onProcessFinished(self, exitCode, exitStatus):
-		self.on_finished.emit()
+def kernelDropCount(ancdata):
+	"""
+	Returns the number of datagrams the kernel dropped for a socket with SO_RXQ_OVFL set, from the ancillary data of
+	a datagram received by recvmsg, or None if it's not included, i.e. no datagram was dropped so far
+	"""
+	for level, cmsgType, data in ancdata:
+		if level == socket.SOL_SOCKET and cmsgType == SO_RXQ_OVFL:
+			return int.from_bytes(data[:4], sys.byteorder)
+	return None
 
-	def cancelFetch(self):
-		self.process.terminate()
-		self.process.waitForFinished(500)
-		self.process.kill()
 
 @DataSourceTypes.register(DisplayName = "UDP listener", Async=True, OutputType="BYTE_BUFFER_LIST")
-class UdpListenerDataSource(DataSource):
+class UdpListenerDataSource(LiveBufferListDataSource):
+	"""Receives datagrams of any size on a worker thread, each becomes a buffer"""
 	@staticmethod
 	def getConfigFields():
 		return [
 			SettingsField("bind_address", "UDP Bind Address", "text", {"default":"0.0.0.0"}),
 			SettingsField("bind_port", "UDP Bind Port", "int", {"default":0}),
+			SettingsField("retention", "Keep the most recent packets only (0 = all)", "int", {"default":0}),
+			SettingsField("formatInfo", "Grammar definition", "text", {"listselectcallback":formatinfoSelect}),
 		]
 
-	def startFetch(self):
-		self.plist = ByteBufferList()
-
-		self.socket = QUdpSocket()
-		self.socket.readyRead.connect(self.onReadyRead)
-		self.socket.disconnected.connect(self.onProcessFinished)
-		if not self.socket.bind(QHostAddress(self.params["bind_address"]), int(self.params["bind_port"])):
-			return None
-		self.logger.info("Listening on address %s port %d", self.socket.localAddress().toString(), self.socket.localPort())
-
-		return self.plist
-
-	def tryParseHeader(self):
-		for headerFI, packetFI in PcapFormats:
-			try:
-				header = headerFI.read_from_buffer(self.ctx)
-				self.packetFI = packetFI
-				self.plist.metadata.update(header)
-				return
-			except invalid as ex:
-				self.logger.debug("invalid pcap format, trying next (exception: %r)", ex)
-		raise invalid(self.ctx, "no PcapVariant matched")
-
-	def onReadyRead(self):
-		while self.socket.hasPendingDatagrams():
-			datagram_bytes, sender_ip, sender_port = self.socket.readDatagram(4096)
-			self.plist.add(ByteBuffer(datagram_bytes, {'source': "%s:%d"%(sender_ip.toString(),sender_port), 'timestamp': time.time()}))
-
-
-	def onProcessFinished(self):
-		self.on_finished.emit()
+	def startWorker(self):
+		family, sockType, proto, _, address = socket.getaddrinfo(self.params["bind_address"], int(self.params["bind_port"]),
+																 type=socket.SOCK_DGRAM)[0]
+		self.socket = socket.socket(family, sockType, proto)
+		try:
+			# a larger kernel buffer bridges the time the worker needs to get the GIL
+			self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 23)
+		except OSError:
+			pass
+		# on Linux, datagrams carry the number of datagrams the kernel dropped for the socket before them
+		self.countKernelDrops = sys.platform.startswith("linux")
+		if self.countKernelDrops:
+			self.socket.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+		self.socket.bind(address)
+		self.socket.settimeout(0.2)
+		self.cancelled = False
+		self.logger.info("Listening on address %s port %d", *self.socket.getsockname()[:2])
+		self.receiver = threading.Thread(target=self._receive, name="UdpListener", daemon=True)
+		self.receiver.start()
+
+	def _receive(self):
+		# 65535 bytes fit any UDP payload
+		buf = memoryview(bytearray(65535))
+		try:
+			while not self.cancelled:
+				try:
+					if self.countKernelDrops:
+						length, ancdata, flags, sender = self.socket.recvmsg_into([buf], 64)
+						dropped = kernelDropCount(ancdata)
+						if dropped is not None:
+							self.stats.kernelDropped = dropped
+					else:
+						length, sender = self.socket.recvfrom_into(buf)
+				except socket.timeout:
+					continue
+				if self.cancelled: break
+				self.enqueue(ByteBuffer(buf[:length], {'source': "%s:%d" % sender[:2], 'timestamp': time.time()}))
+		except OSError as ex:
+			if not self.cancelled:
+				self.logger.error("Receiving UDP datagrams failed: %s", ex)
+		finally:
+			self.socket.close()
+			self.workerFinished()
 
 	def cancelFetch(self):
-		self.socket.close()
+		self.cancelled = True
+
+	def close(self):
+		super().close()
+		if self.plist is not None:
+			# while the worker waits for a datagram, the port stays bound even if the socket is closed. It notices the
+			# cancellation within its timeout and closes the socket, then the port is free for a reload
+			self.receiver.join()
 
 def formatinfoSelect(dialog):
 	names = APP().project.formatInfoContainer.definitions.keys()
@@ -76,6 +76,8 @@ class PacketListModel(QAbstractItemModel):
     def setList(self, plist: Optional[ByteBufferList]):
         if self.listObject is not None:
             self.listObject.on_new_packet.disconnect(self.onNewPacket)
+            self.listObject.on_removing_packets.disconnect(self.onRemovingPackets)
+            self.listObject.on_removed_packets.disconnect(self.onRemovedPackets)
         self.beginResetModel()
         self.listObject = plist
         self.endResetModel()
@@ -83,6 +85,8 @@ class PacketListModel(QAbstractItemModel):
             self.autoCols()
         if self.listObject is not None:
             self.listObject.on_new_packet.connect(self.onNewPacket)
+            self.listObject.on_removing_packets.connect(self.onRemovingPackets)
+            self.listObject.on_removed_packets.connect(self.onRemovedPackets)
 
     def autoCols(self):
         self.beginResetModel()
@@ -103,6 +107,12 @@ class PacketListModel(QAbstractItemModel):
         if len(self.columns) == 0:
             self.autoCols()
 
+    def onRemovingPackets(self, count):
+        self.beginRemoveRows(QModelIndex(), 0, count - 1)
+
+    def onRemovedPackets(self, count):
+        self.endRemoveRows()
+
     def columnCount(self, parent):
         return len(self.columns)
 
@@ -172,6 +182,7 @@ class PacketListModel(QAbstractItemModel):
     def markPacket(self, rowIndex):
         data = self.listObject.buffers[rowIndex]
         data.metadata['marked'] = not data.metadata.get('marked', False)
+        self.listObject.pin(rowIndex)
         self.headerDataChanged.emit(Qt.Vertical, rowIndex, rowIndex)
 
 
@@ -15,7 +15,10 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import logging
-from typing import List, Dict, Any, Optional
+import weakref
+from collections import OrderedDict
+from collections.abc import Sequence
+from typing import List, Dict, Any, Optional, Callable
 
 import binascii
 import re, struct
@@ -37,17 +40,19 @@ xdrm.Serializable.register(class_id=0x2000)(Range)
 
 @xdrm.Serializable.register(class_id=0x2001)
 class ByteBuffer(QObject):
-	__slots__ = ('metadata', 'buffer', 'length', 'ranges', 'fields', 'fi_tree', 'fi_root_name', 'fi_container', 'annotation_set_name', 'subflow_categories')
+	__slots__ = ('metadata', 'buffer', 'length', '_ranges', '_fields', '_fi_tree', '_pending_result', 'fi_root_name', 'fi_container', 'fi_used_definitions', 'annotation_set_name', 'subflow_categories')
 	on_new_data = pyqtSignal()
 	def __init__(self, buf=None, metadata=None):
 		super().__init__()
 		self.metadata = dict() if metadata is None else metadata
 		self.setContent(buf)
-		self.ranges = RangeList(len(self), list())
-		self.fields = dict()
-		self.fi_tree = None
+		self._pending_result = None
+		self._ranges = RangeList(len(self), list())
+		self._fields = None
+		self._fi_tree = None
 		self.fi_root_name = None
 		self.fi_container = None
+		self.fi_used_definitions = None
 		self.annotation_set_name = None
 		self.subflow_categories = dict()
 
@@ -71,6 +76,7 @@ class ByteBuffer(QObject):
 				buf = buf.buffer
 			self.buffer = bytearray(buf)
 		self.length = len(self.buffer)
+		self.fi_used_definitions = None
 
 	def ensureCapacity(self, newLength):
 		if self.length < newLength:
@@ -85,6 +91,7 @@ class ByteBuffer(QObject):
 			self.appendBytes(databytes, datameta)
 
 	def setBytes(self, offset, newBytes):
+		self.fi_used_definitions = None
 		if isinstance(newBytes, ByteBuffer):
 			newBytes = newBytes.buffer
 		if type(newBytes) == bytes:
@@ -98,17 +105,60 @@ class ByteBuffer(QObject):
 			self.ensureCapacity(offset + n)
 		else:
 			raise TypeError("newBytes must be of type 'bytes' or 'int' or 'ByteBuffer'")
+	@property
+	def ranges(self):
+		if self._pending_result is not None: self._loadPendingResult()
+		return self._ranges
+
+	@ranges.setter
+	def ranges(self, ranges):
+		if self._pending_result is not None: self._loadPendingResult()
+		self._ranges = ranges
+
+	@property
+	def fi_tree(self):
+		if self._pending_result is not None: self._loadPendingResult()
+		return self._fi_tree
+
+	@fi_tree.setter
+	def fi_tree(self, fi_tree):
+		if self._pending_result is not None: self._loadPendingResult()
+		self._fi_tree = fi_tree
+
+	def setPendingResult(self, load):
+		"""
+		Sets a parse result which is decoded on first access of fi_tree or ranges, e.g. one returned by a worker
+		process. load returns fi_tree and its ranges, which are added to the current ranges.
+		"""
+		if self._pending_result is not None: self._loadPendingResult()
+		self._pending_result = load
+
+	def _loadPendingResult(self):
+		load, self._pending_result = self._pending_result, None
+		self._fi_tree, ranges = load()
+		self._ranges = RangeList(len(self), list(self._ranges) + ranges)
+		self._fields = None
+
+	@property
+	def fields(self):
+		# built on demand, so the metadata of parsed ranges is only computed when needed
+		if self._fields is None:
+			self._fields = {r.metadata["name"]: r for r in self.ranges if "name" in r.metadata}
+		return self._fields
+
 	def addRange(self, r):
 		self.ranges.append(r)
-		if "name" in r.metadata: self.fields[r.metadata["name"]] = r
+		self._fields = None
 		return r
 	def removeRange(self, r):
 		self.ranges.remove(r)
+		self._fields = None
 	def clearRanges(self):
 		self.ranges = RangeList(len(self), list())
+		self._fields = None
 	def setRanges(self, ranges):
 		self.ranges = RangeList(len(self), list(ranges))
-		self.fields = {r.metadata["name"]: r for r in self.ranges if "name" in r.metadata}
+		self._fields = None
 
 	def appendBytes(self, newBytes, meta=None):
 		start = len(self)
@@ -184,6 +234,8 @@ class ByteBufferList(QObject):
 	updating: Optional[int]
 
 	on_new_packet = pyqtSignal(int)
+	on_removing_packets = pyqtSignal(int)
+	on_removed_packets = pyqtSignal(int)
 
 	def __init__(self):
 		super().__init__()
@@ -209,6 +261,17 @@ class ByteBufferList(QObject):
 		else:
 			self.updating += 1
 
+	def removeOldest(self, count: int):
+		"""
+		Removes the first count buffers, e.g. to keep a live capture at a maximum length. on_removing_packets is
+		emitted before, and on_removed_packets after removing them.
+		"""
+		count = min(count, len(self.buffers))
+		if count < 1: return
+		self.on_removing_packets.emit(count)
+		del self.buffers[:count]
+		self.on_removed_packets.emit(count)
+
 	def reassemble(self, subflow_key: tuple, bufmeta, databytes, datameta):
 		if subflow_key not in self.buffers_hash:
 			logging.debug("Starting new buffer for key %r",subflow_key)
@@ -229,6 +292,17 @@ class ByteBufferList(QObject):
 	def __len__(self):
 		return len(self.buffers)
 
+	def __getitem__(self, i):
+		return self.buffers[i]
+
+	def pin(self, i: int):
+		"""Called after buffer i was modified, so a LazyByteBufferList keeps it"""
+		pass
+
+	def close(self):
+		"""Called when the list isn't used anymore, so a LazyByteBufferList can close its provider"""
+		pass
+
 	def getAllKeys(self, metadataKeys=True, fieldKeys=True):
 		s = set()
 		for bbuf in self.buffers:
@@ -240,6 +314,115 @@ class ByteBufferList(QObject):
 		return "ByteBufferList(metadata=%r, buffers=%r)" % (self.metadata, self.buffers)
 
 
+class LazyBufferSequence(Sequence):
+	"""
+	The buffers of a LazyByteBufferList. Buffer i < count is created by provider(i) on access, and passed to on_load,
+	e.g. to apply a grammar on it. The cache_size most recently used buffers are kept, as well as buffers still
+	referenced elsewhere, pinned buffers and all buffers appended later. A dropped buffer is created again by the
+	provider on its next access, losing changes like annotations unless it was pinned.
+
+	Only the first buffers can be deleted, after that buffer i is provider(i + first).
+	"""
+	def __init__(self, provider: Callable[[int], ByteBuffer], count: int, cache_size: int = 1024):
+		self.provider = provider
+		self.count = count
+		self.first = 0
+		self.cache_size = cache_size
+		self.on_load = None
+		self.recent = OrderedDict()
+		self.alive = weakref.WeakValueDictionary()
+		self.pinned = dict()
+		self.appended = list()
+
+	def __len__(self):
+		return self.count - self.first + len(self.appended)
+
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			return [self[j] for j in range(*i.indices(len(self)))]
+		if i < 0:
+			i += len(self)
+			if i < 0: raise IndexError("buffer index out of range")
+		i += self.first
+		if i >= self.count:
+			return self.appended[i - self.count]
+		bbuf = self.recent.get(i)
+		if bbuf is not None:
+			self.recent.move_to_end(i)
+			return bbuf
+		bbuf = self.pinned.get(i)
+		if bbuf is None:
+			bbuf = self.alive.get(i)
+		if bbuf is None:
+			bbuf = self.provider(i)
+			self.alive[i] = bbuf
+			if self.on_load is not None:
+				self.on_load(bbuf)
+		self.recent[i] = bbuf
+		if len(self.recent) > self.cache_size:
+			self.recent.popitem(last=False)
+		return bbuf
+
+	def __delitem__(self, i):
+		start, stop, step = i.indices(len(self)) if isinstance(i, slice) else (i, i + 1, 1)
+		if start != 0 or step != 1:
+			raise ValueError("only the first buffers can be deleted")
+		provided = min(stop, self.count - self.first)
+		for j in range(self.first, self.first + provided):
+			self.recent.pop(j, None)
+			self.alive.pop(j, None)
+			self.pinned.pop(j, None)
+		self.first += provided
+		del self.appended[:stop - provided]
+
+	def append(self, bbuf: ByteBuffer):
+		self.appended.append(bbuf)
+
+	def pin(self, i: int):
+		if i + self.first < self.count:
+			self.pinned[i + self.first] = self[i]
+
+	def loaded(self):
+		"""Returns the buffers currently in memory"""
+		return list(self.alive.values()) + self.appended
+
+
+class LazyByteBufferList(ByteBufferList):
+	"""
+	ByteBufferList of count buffers, which are created by provider(i) when they are accessed, see LazyBufferSequence.
+	Memory use depends on the buffers accessed recently, e.g. the visible rows of a packet list, instead of the
+	length of the list.
+	"""
+	__slots__ = ()
+
+	def __init__(self, provider: Callable[[int], ByteBuffer], count: int, cache_size: int = 1024):
+		super().__init__()
+		self.buffers = LazyBufferSequence(provider, count, cache_size)
+
+	def __serialize__(self):
+		return [self.metadata, list(self.buffers)]
+
+	def pin(self, i: int):
+		self.buffers.pin(i)
+
+	def close(self):
+		# e.g. the file mapping of a PcapPacketReader
+		close = getattr(self.buffers.provider, 'close', None)
+		if close is not None:
+			close()
+
+	def getAllKeys(self, metadataKeys=True, fieldKeys=True):
+		# only the buffers in memory, loading all of them could take long
+		s = set()
+		for bbuf in self.buffers.loaded() or self.buffers[:1]:
+			if metadataKeys: s.update(bbuf.metadata.keys())
+			if fieldKeys: s.update(bbuf.fields.keys())
+		return s
+
+	def __repr__(self):
+		return "LazyByteBufferList(metadata=%r, count=%d)" % (self.metadata, len(self))
+
+
 
 
 class BidiByteBuffer:
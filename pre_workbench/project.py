@@ -14,17 +14,22 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
 import json
+import logging
 import os
 import sqlite3
+import time
 from typing import List
 
+from pre_workbench import configs
 from pre_workbench.interactive_fic import InteractiveFormatInfoContainer
 from pre_workbench.macros.macro import Macro, MacroListItem
 from pre_workbench.structinfo import xdrm
 
 class ProjectFormatInfoContainer(InteractiveFormatInfoContainer):
     def write_file(self, fileName):
+        self.invalidate_caches()
         self.project.setValue("format_infos", self.to_text())
         self.updated.emit()
 
@@ -35,11 +40,25 @@ class Project:
         self.projectFolder = dirName
         self.projectDbFile = os.path.join(dirName, ".pre_workbench")
         self.db = sqlite3.connect(self.projectDbFile)
+        self.parseCacheSize = None
+        self.parseCacheCommitTime = 0
         self.initDb()
-        self.formatInfoContainer = ProjectFormatInfoContainer(load_from_string=self.getValue("format_infos", "DEFAULT struct(endianness=\"<\") {}"))
+        self.formatInfoContainer = ProjectFormatInfoContainer(load_from_string=self.getValue("format_infos", "DEFAULT struct(endianness=\"<\") {}"),
+                                                              parse_cache_file=self.getGrammarCacheFile())
         self.formatInfoContainer.project = self
         #self.formatInfoContainer = InteractiveFormatInfoContainer(load_from_string=self.getValue("format_info_file", ""))
 
+    def getGrammarCacheFile(self):
+        # the cache is unpickled on load, so it lives in the user's cache dir and is never shipped with the project
+        cacheDir = os.path.join(configs.dirs.user_cache_dir, "grammar_cache")
+        try:
+            configs.mkdir_p(cacheDir)
+        except OSError as ex:
+            logging.warning("Can't create grammar cache dir %s: %s", cacheDir, ex)
+            return None
+        key = hashlib.sha256(os.path.abspath(self.projectDbFile).encode("utf-8")).hexdigest()
+        return os.path.join(cacheDir, key[:32])
+
     def getRelativePath(self, absolutePath: str):
         path = os.path.relpath(absolutePath, self.projectFolder)
         if path.startswith(".."):
@@ -58,6 +77,12 @@ class Project:
         cur.execute('''
         CREATE TABLE IF NOT EXISTS macros (name TEXT PRIMARY KEY, input_type TEXT NOT NULL, output_type TEXT NOT NULL, code TEXT NOT NULL, options BLOB NOT NULL, metadata BLOB NOT NULL);
         ''')
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS parse_results (def_name TEXT NOT NULL, grammar_hash BLOB NOT NULL, payload_hash BLOB NOT NULL, result BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL, PRIMARY KEY (def_name, grammar_hash, payload_hash));
+        ''')
+        cur.execute('''
+        CREATE INDEX IF NOT EXISTS parse_results_last_used ON parse_results (last_used);
+        ''')
 
     def getValue(self, key: str, defaultValue=None):
         cur = self.db.cursor()
@@ -142,6 +167,60 @@ class Project:
         cur.execute("DELETE FROM macros WHERE name = ?", (name,))
         self.db.commit()
 
+    def getParseResult(self, defName: str, grammarHash: bytes, payloadHash: bytes):
+        cur = self.db.cursor()
+        cur.execute("SELECT rowid, result FROM parse_results WHERE def_name = ? AND grammar_hash = ? AND payload_hash = ?",
+                    (defName, grammarHash, payloadHash))
+        result = cur.fetchone()
+        if not result:
+            return None
+        cur.execute("UPDATE parse_results SET last_used = ? WHERE rowid = ?", (time.time(), result[0]))
+        self._commitParseResults()
+        return result[1]
+
+    def storeParseResult(self, defName: str, grammarHash: bytes, payloadHash: bytes, result: bytes, maxSize: int):
+        """
+        Stores a serialized parse result, and evicts the least recently used results if the cache is larger than
+        maxSize bytes afterwards.
+        """
+        cur = self.db.cursor()
+        if self.parseCacheSize is None:
+            cur.execute("SELECT COALESCE(SUM(size), 0) FROM parse_results")
+            self.parseCacheSize = cur.fetchone()[0]
+        cur.execute("SELECT size FROM parse_results WHERE def_name = ? AND grammar_hash = ? AND payload_hash = ?",
+                    (defName, grammarHash, payloadHash))
+        old = cur.fetchone()
+        if old:
+            self.parseCacheSize -= old[0]
+        cur.execute("REPLACE INTO parse_results (def_name, grammar_hash, payload_hash, result, size, last_used) VALUES (?,?,?,?,?,?)",
+                    (defName, grammarHash, payloadHash, result, len(result), time.time()))
+        self.parseCacheSize += len(result)
+        if self.parseCacheSize > maxSize:
+            # evict down to 90% of maxSize, so not every following store has to evict again
+            cur.execute("SELECT rowid, size FROM parse_results ORDER BY last_used")
+            evict = []
+            for rowid, size in cur:
+                if self.parseCacheSize <= maxSize * 0.9: break
+                evict.append((rowid,))
+                self.parseCacheSize -= size
+            cur.executemany("DELETE FROM parse_results WHERE rowid = ?", evict)
+        self._commitParseResults()
+
+    def clearParseResults(self):
+        cur = self.db.cursor()
+        cur.execute("DELETE FROM parse_results")
+        self.db.commit()
+        self.parseCacheSize = 0
+
+    def _commitParseResults(self, force=False):
+        # results are stored for every parsed buffer, committing each of them would be slow
+        if force or time.monotonic() - self.parseCacheCommitTime > 1:
+            self.db.commit()
+            self.parseCacheCommitTime = time.monotonic()
+
+    def flushParseResults(self):
+        self._commitParseResults(True)
+
     @property
     def macrosEditable(self):
         return True
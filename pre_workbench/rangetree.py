@@ -34,6 +34,7 @@ from pre_workbench.controls.scintillaedit import showScintillaDialog
 from pre_workbench.guihelper import getMonospaceFont, filledColorIcon, setClipboardText, navigateBrowser, \
 	isOptionPressed
 from pre_workbench.interactive_fic import InteractiveFormatInfoContainer
+from pre_workbench.structinfo.parsecontext import LazyRepeatList
 from pre_workbench.structinfo.format_info import FormatInfo, StructFI, VariantStructFI, SwitchFI, RepeatStructFI, \
 	UnionFI, BitStructFI
 from pre_workbench.typeeditor import showTypeEditorDlg, showTreeEditorDlg
@@ -47,6 +48,7 @@ class RangeTreeWidget(QTreeWidget):
 	SourceDescRole = QtCore.Qt.UserRole + 3
 	PathComponentRole = QtCore.Qt.UserRole + 4
 	BufferIndexRole = QtCore.Qt.UserRole + 5
+	LazyPageRole = QtCore.Qt.UserRole + 6
 
 	def __init__(self, parent=None):
 		super().__init__(parent)
@@ -83,7 +85,13 @@ class RangeTreeWidget(QTreeWidget):
 			Range_addToTree(buf_idx, fi_tree, self, self.onlyPrintable)
 
 	def _fiTreeItemActivated(self, item, column):
-		pass
+		lazyPage = item.data(0, RangeTreeWidget.LazyPageRole)
+		if lazyPage is not None:
+			lazy, start, printableOnly = lazyPage
+			parent = item.parent()
+			(parent if parent is not None else self.invisibleRootItem()).removeChild(item)
+			Range_addLazyPage(item.data(0, RangeTreeWidget.BufferIndexRole), lazy, start,
+							  parent if parent is not None else self, printableOnly)
 
 	def hilightFormatInfoTree(self, range):
 		start_time = time.perf_counter()
@@ -330,6 +338,9 @@ def Range_addToTree(buf_idx: int, range: Range, parent: QTreeWidgetItem, printab
 			if not collapse:me.setExpanded(True)
 			for item in x.value:
 				Range_addToTree(buf_idx, item, me, printableOnly)
+		elif type(x.value) == LazyRepeatList:
+			if not collapse:me.setExpanded(True)
+			Range_addLazyPage(buf_idx, x.value, 0, me, printableOnly)
 		else:
 			try:
 				me.setText(3, truncate_str(x.source_desc.formatter(x.value)))
@@ -345,4 +356,20 @@ def Range_addToTree(buf_idx: int, range: Range, parent: QTreeWidgetItem, printab
 		if type(x.value) == list:
 			for item in x.value:
 				Range_addToTree(buf_idx, item, parent, printableOnly)
+		if type(x.value) == LazyRepeatList:
+			Range_addLazyPage(buf_idx, x.value, 0, parent, printableOnly)
+
+
+LAZY_PAGE_SIZE = 100
+
+def Range_addLazyPage(buf_idx: int, lazy: LazyRepeatList, start: int, parent: QTreeWidgetItem, printableOnly: bool = False):
+	# only the elements shown are decoded, the rest is loaded page by page by activating the placeholder item
+	end = min(start + LAZY_PAGE_SIZE, len(lazy))
+	for i in range(start, end):
+		Range_addToTree(buf_idx, lazy[i], parent, printableOnly)
+	if end < len(lazy):
+		me = QTreeWidgetItem(parent)
+		me.setData(0, RangeTreeWidget.LazyPageRole, (lazy, end, printableOnly))
+		me.setData(0, RangeTreeWidget.BufferIndexRole, buf_idx)
+		me.setText(0, "... %d more elements (activate to show)" % (len(lazy) - end))
 
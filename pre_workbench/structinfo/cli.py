@@ -5,7 +5,8 @@ import os
 import binascii
 import sys
 
-from pre_workbench.structinfo.parsecontext import ParseContext
+from pre_workbench.structinfo.parsecontext import ParseContext, LazyRepeatList, RecordArray
+from pre_workbench.structinfo.profiler import ParseProfile
 from pre_workbench.util import PerfTimer
 
 
@@ -29,8 +30,21 @@ def run_cli():
 						help='Print json output')
 	parser.add_argument('--print', action="store_true",
 						help='Print with Python print function')
+	parser.add_argument('--compiled', action="store_true",
+						help='Parse with grammar compiled to Python code (faster, falls back to the interpreter on errors)')
+	parser.add_argument('--vectorize', action="store_true",
+						help='Decode repeats of fixed layout structs at once into numpy arrays (requires numpy)')
+	parser.add_argument('--lazy', metavar='COUNT', type=int,
+						help='Decode elements of repeats with at least COUNT fixed-size elements only when they are printed')
+	parser.add_argument('--memo', metavar='SIZE', type=int,
+						help='Reuse up to SIZE results of definitions which are parsed again at the same offset, e.g. by variants')
+	parser.add_argument('--profile', metavar='FILENAME', nargs='?', const='-', type=str,
+						help='Write calls, bytes, time, exceptions and variant alternatives tried per definition and grammar node as json to FILENAME (stderr if omitted)')
 
 	r = parser.parse_args()
+	if r.profile and r.compiled:
+		parser.error("--profile can't be combined with --compiled")
+	r.parse_profile = ParseProfile() if r.profile else None
 	if r.project:
 		from pre_workbench.project import Project
 		project = Project(r.project, 'PROJECT', '')
@@ -55,8 +69,8 @@ def run_cli():
 					import dpkt
 					plist = [buf for ts,buf in dpkt.pcap.Reader(f)]
 				else:
-					from pre_workbench.structinfo.pcap_reader import read_pcap_file
-					plist = [bbuf.buffer for bbuf in read_pcap_file(f).buffers]
+					from pre_workbench.structinfo.pcap_reader import iter_pcap_file
+					plist = [bbuf.buffer for bbuf in iter_pcap_file(f, dict())]
 		with PerfTimer('Parse Data'):
 			for buf in plist:
 				parse_data(fic, buf, definition, r)
@@ -70,17 +84,40 @@ def run_cli():
 			data = sys.stdin.read()
 		parse_data(fic, data, definition, r)
 
+	if r.parse_profile is not None:
+		write_profile(fic, r.parse_profile, r.profile)
+
 def parse_data(fic, data, definition, r):
-	pc = ParseContext(fic, data)
+	if r.compiled:
+		from pre_workbench.structinfo.compiler import CompiledParseContext
+		pc = CompiledParseContext(fic, data)
+	else:
+		pc = ParseContext(fic, data)
+		pc.lazy_repeat_threshold = r.lazy
+		pc.vectorize_repeats = r.vectorize
+		pc.memo_limit = r.memo or 0
+		pc.profile = r.parse_profile
 	result = pc.parse(definition)
 	if r.json:
 		print(json.dumps(result, indent=4, default=str_helper))
 	else:
 		print(result)
 
+def write_profile(fic, profile, filename):
+	if filename == '-':
+		json.dump(profile.to_json(fic), sys.stderr, indent=4)
+		sys.stderr.write("\n")
+	else:
+		with open(filename, "w") as f:
+			json.dump(profile.to_json(fic), f, indent=4)
+
 def str_helper(obj):
 	if isinstance(obj, (bytes, bytearray)):
 		return binascii.hexlify(obj).decode('ascii').upper()
+	elif isinstance(obj, LazyRepeatList):
+		return list(obj)
+	elif isinstance(obj, RecordArray):
+		return obj.to_list()
 	else:
 		return str(obj)
 
@@ -0,0 +1,652 @@
+# PRE Workbench
+# Copyright (C) 2022 Mira Weller
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Compiles grammar definitions into specialised Python code ("compiled grammar" mode)
+
+For each definition reachable from the start definition, one function is generated per
+combination of inherited parameters (endianness, charset, ...) it is used with. Field reads
+are emitted as straight-line struct.unpack_from calls with the endianness inlined, repeats
+become native loops, and field references in expressions are resolved to local variables
+wherever this is possible statically.
+
+Generated code produces the same plain values as ParseContext.parse(), but no annotations.
+It only handles the successful case: on any error, CompiledParseContext re-parses the buffer
+with the interpreter, so partial results and failure reporting stay exactly the same.
+"""
+
+import datetime
+import json
+import logging
+
+from lark import Transformer, Token
+from lark.exceptions import VisitError
+
+from pre_workbench.structinfo import ExprFunctions
+from pre_workbench.structinfo.expr import Expression
+from pre_workbench.structinfo.format_info import DYN_LEN, PREFIX_LEN, guess_timestamp_unit, builtinTypes
+from pre_workbench.structinfo.parsecontext import ParseContext
+
+INHERITED_PARAMS = ('endianness', 'charset', 'magic', 'unit', 'ignore_errors')
+
+_struct_formats = {
+	"BOOLEAN": "?", "UINT16": "H", "UINT32": "L", "UINT64": "Q",
+	"INT16": "h", "INT32": "l", "INT64": "q", "FLOAT": "f", "DOUBLE": "d",
+}
+_unsigned_types = ("CHAR", "E_UINT", "UINT8", "UINT24", "UINT40", "UINT48", "UINT56")
+_signed_types = ("E_INT", "INT8", "INT24", "INT40", "INT48", "INT56")
+_bytes_types = ("BYTES", "UINT_BYTES")
+_string_types = ("STRING", "UINT_STRING")
+
+
+#region runtime helpers referenced by generated code
+
+class compiled_failure(Exception):
+	pass
+
+class compiled_invalid(compiled_failure):
+	pass
+
+class compiled_incomplete(compiled_failure):
+	pass
+
+def expr_or(a, b):
+	return a or b
+
+def expr_and(a, b):
+	return a and b
+
+def expr_pad(length, param):
+	if length % param == 0:
+		return 0
+	else:
+		return param - (length % param)
+
+def find_zero(buf, start, end):
+	if isinstance(buf, memoryview):
+		# memoryview has no find(), search in chunks to avoid copying the whole remainder
+		for chunk_start in range(start, end, 4096):
+			i = bytes(buf[chunk_start:min(chunk_start + 4096, end)]).find(0)
+			if i >= 0: return chunk_start + i
+		return -1
+	return buf.find(0, start, end)
+
+def expr_call(name, params):
+	fn, meta = ExprFunctions.find(name=name)
+	if fn:
+		return fn(*params)
+	else:
+		raise Exception("Call to unknown function '"+name+"'")
+
+def expr_anyfield(outer, id):
+	for value in reversed(outer):
+		if id in value:
+			return value[id]
+	raise Exception("field \""+id+"\" not found")
+
+def expr_list_member(lst, id):
+	return lst[id]
+
+def missing_param(id):
+	raise compiled_failure("Missing parameter "+id)
+
+def no_parent_frame():
+	raise compiled_failure("expression requires a parent frame")
+
+def parse_timestamp(num, unit):
+	if unit is None:
+		unit = guess_timestamp_unit(num)
+	if unit == 'us':
+		num /= 1000000.0
+	elif unit == 'ms':
+		num /= 1000.0
+	return datetime.datetime.fromtimestamp(num)
+
+#endregion
+
+
+class UnsupportedConstruct(Exception):
+	"""Raised while generating code for a grammar construct the compiler doesn't support, see CompiledGrammar.get_entry"""
+	pass
+
+
+class _Frame:
+	__slots__ = ('start', 'start_line', 'value', 'fields', 'materialised', 'placeholders')
+
+	def __init__(self, start, value=None, fields=None):
+		self.start = start
+		self.start_line = None
+		self.value = value
+		self.fields = fields
+		self.materialised = False
+		self.placeholders = []
+
+
+class _ParamEnv:
+	"""Stands in for the caller's stack frames when a definition function is generated"""
+	def __init__(self, params):
+		self.params = params
+
+
+class PyExprGenerator(Transformer):
+	"""
+	Generates Python source for an expression tree, in the scope of the node currently
+	being generated by the PyCodeGenerator.
+	"""
+	def __init__(self, gen):
+		super().__init__()
+		self.gen = gen
+
+	def paren_expr(self, s):
+		return s[0]
+
+	def string_expr(self, s):
+		return repr(json.loads(s[0]))
+
+	def number_expr(self, n):
+		return repr(float(n[0]) if "." in n[0] else int(n[0], 0))
+
+	null_expr = lambda self, _: "None"
+	true_expr = lambda self, _: "True"
+	false_expr = lambda self, _: "False"
+
+	def math_expr(self, node):
+		a, op, b = node
+		if op == "||":
+			return "expr_or(" + a + ", " + b + ")"
+		elif op == "&&":
+			return "expr_and(" + a + ", " + b + ")"
+		return "(" + a + " " + op + " " + b + ")"
+
+	compare_expr = math_expr
+	bool_expr = math_expr
+
+	def fun_expr(self, node):
+		name, params = str(node[0]), node[1:]
+		if name == "pad":
+			return "expr_pad(off - " + self.gen.parent_start() + ", " + ", ".join(params) + ")"
+		return "expr_call(" + repr(name) + ", (" + "".join(p + ", " for p in params) + "))"
+
+	def hierarchy_expr(self, node):
+		raise UnsupportedConstruct("hierarchy expressions")
+
+	def array_expr(self, node):
+		return node[0] + "[" + node[1] + "]"
+
+	def member_expr(self, node):
+		return node[0] + "[" + repr(str(node[1])) + "]"
+
+	def anyfield_expr(self, node):
+		return self.gen.lookup_field(str(node[0]))
+
+	def param_expr(self, node):
+		if not isinstance(node[0], Token):
+			raise UnsupportedConstruct("computed parameter names")
+		return self.gen.param_src(str(node[0]))
+
+
+class PyCodeGenerator:
+	"""
+	Generates the Python module for one start definition, by visiting the FormatInfo tree
+	with a ParseContext which mirrors the stack the interpreter would have, so parameter
+	lookups can be resolved statically.
+	"""
+	def __init__(self, format_infos, param_names=INHERITED_PARAMS):
+		self.format_infos = format_infos
+		self.param_names = tuple(param_names)
+		self.functions = {}
+		self.pending = []
+		self.struct_consts = {}
+		self.lines = []
+		self.counter = 0
+
+	def generate_module(self, def_name):
+		entry = self.request_function(def_name, {}, is_root=True)
+		while self.pending:
+			self.generate_function(*self.pending.pop(0))
+
+		out = ["# generated by PRE Workbench from definition " + def_name,
+			   "from struct import Struct",
+			   "from uuid import UUID",
+			   "from pre_workbench.structinfo.compiler import compiled_failure, compiled_invalid, compiled_incomplete, expr_or, expr_and, "
+			   "expr_pad, expr_call, expr_anyfield, expr_list_member, missing_param, no_parent_frame, parse_timestamp, find_zero",
+			   ""]
+		for fmt, name in self.struct_consts.items():
+			out.append(name + " = Struct(" + repr(fmt) + ")")
+		out += ["", "", "def parse(buf):", "\treturn " + entry + "(buf, 0, len(buf), ())[0]", ""]
+		out += [line for line in self.lines if line is not None]
+		return entry, "\n".join(out) + "\n"
+
+	#region definitions
+
+	def request_function(self, def_name, env, is_root=False):
+		if def_name not in self.format_infos.definitions:
+			raise UnsupportedConstruct("reference to undefined formatinfo name: " + def_name)
+		env_key = tuple((k, env[k]) for k in self.param_names if k in env)
+		for k, v in env_key: self.literal(v)
+		key = (def_name, env_key, is_root)
+		if key not in self.functions:
+			self.functions[key] = "p_%s_%d" % (def_name, len(self.functions))
+			self.pending.append((key, dict(env_key)))
+		return self.functions[key]
+
+	def generate_function(self, key, env):
+		def_name, _, is_root = key
+		self.context = ParseContext(self.format_infos)
+		self.context.push(_ParamEnv(env))
+		self.frames = []
+		self.is_root = is_root
+		self.end = "end"
+		self.indent = 1
+		self.lines.append("")
+		self.lines.append("def " + self.functions[key] + "(buf, start, end, outer):")
+		self.emit("off = start")
+		value = self.node(self.format_infos.definitions[def_name])
+		self.emit("return " + value + ", off")
+
+	#endregion
+
+	#region helpers
+
+	def emit(self, line):
+		self.lines.append("\t" * self.indent + line)
+		return len(self.lines) - 1
+
+	def var(self, prefix):
+		self.counter += 1
+		return prefix + str(self.counter)
+
+	def struct_const(self, fmt):
+		if fmt not in self.struct_consts:
+			self.struct_consts[fmt] = "S_" + str(len(self.struct_consts))
+		return self.struct_consts[fmt]
+
+	def literal(self, value):
+		if value is None or isinstance(value, (bool, int, float, str, bytes)):
+			return repr(value)
+		raise UnsupportedConstruct("parameter value of type " + type(value).__name__)
+
+	def param(self, id, default=None):
+		return self.context.get_param(id, default, raise_if_missing=False)
+
+	def param_src(self, id):
+		value = self.param(id, self)
+		return "missing_param(" + repr(id) + ")" if value is self else self.literal(value)
+
+	def expr_src(self, expr: Expression):
+		try:
+			return PyExprGenerator(self).transform(expr.expr_tree)
+		except VisitError as ex:
+			raise ex.orig_exc
+
+	def parent_start(self):
+		if len(self.frames) >= 2:
+			self.frames[-2].start_line = None
+			return self.frames[-2].start
+		elif self.is_root:
+			return "no_parent_frame()"
+		else:
+			return "start"
+
+	def lookup_field(self, id):
+		list_checks = []
+		result = None
+		for frame in reversed(self.frames):
+			if frame.value is None: continue
+			if id == 'this':
+				frame.materialised = True
+				result = frame.value
+				break
+			if frame.fields is None:
+				list_checks.append(frame.value)
+			elif id in frame.fields:
+				result = frame.fields[id]
+				break
+		if result is None:
+			result = "outer[-1]" if id == 'this' else "expr_anyfield(outer, " + repr(id) + ")"
+		for lst in reversed(list_checks):
+			result = "(expr_list_member(" + lst + ", " + repr(id) + ") if " + repr(id) + " in " + lst + " else " + result + ")"
+		return result
+
+	def byteorder_src(self, n):
+		endianness = self.param("endianness")
+		if endianness == "<" or n == "1":
+			return "'little'"
+		elif endianness is not None:
+			return "('little' if " + n + " == 1 else 'big')"
+		else:
+			return "('little' if " + n + " == 1 else missing_param('endianness'))"
+
+	def require(self, n):
+		self.emit("if " + self.end + " - off < " + n + ": raise compiled_incomplete")
+
+	def node(self, desc):
+		if desc.params.get("ignore_errors") or self.param("ignore_errors"):
+			raise UnsupportedConstruct("parameter ignore_errors")
+		return desc.visit(self.context, self)
+
+	def push_frame(self, frame):
+		self.frames.append(frame)
+		return frame
+
+	def node_start(self):
+		"""Returns the variable holding the start offset of a new node, the assignment is dropped if unused"""
+		if not self.frames: return "start", None
+		start = self.var("s")
+		return start, self.emit(start + " = off")
+
+	def pop_frame(self):
+		frame = self.frames.pop()
+		if frame.start_line is not None:
+			self.lines[frame.start_line] = None
+		if not frame.materialised:
+			for index in frame.placeholders:
+				self.lines[index] = None
+		return frame
+
+	#endregion
+
+	#region visitor
+
+	def structfi(self, desc):
+		return self._struct_or_union(desc, union=False)
+
+	def unionfi(self, desc):
+		return self._struct_or_union(desc, union=True)
+
+	def _struct_or_union(self, desc, union):
+		start, start_line = self.node_start()
+		if union:
+			union_end = self.var("u")
+			self.emit(union_end + " = off")
+		frame = self.push_frame(_Frame(start, self.var("o"), {}))
+		if not union: frame.start_line = start_line
+		frame.placeholders.append(self.emit(frame.value + " = {}"))
+		for name, child, comment in desc.fi.children:
+			if union: self.emit("off = " + start)
+			self.context.id = name
+			frame.fields[name] = self.node(child)
+			frame.placeholders.append(self.emit(frame.value + "[" + repr(name) + "] = " + frame.fields[name]))
+			if union: self.emit(union_end + " = max(" + union_end + ", off)")
+		self.pop_frame()
+		if union: self.emit("off = " + union_end)
+		if not frame.materialised:
+			self.emit(frame.value + " = {" + ", ".join(repr(name) + ": " + value for name, value in frame.fields.items()) + "}")
+		return frame.value
+
+	def variantstructfi(self, desc):
+		start, start_line = self.node_start()
+		value = self.var("v")
+		self.push_frame(_Frame(start))
+		self.emit("while True:")
+		self.indent += 1
+		for i, child in enumerate(desc.fi.children):
+			self.emit("try:")
+			self.indent += 1
+			self.context.id = "var-%d" % i
+			self.emit(value + " = " + self.node(child))
+			self.emit("break")
+			self.indent -= 1
+			self.emit("except compiled_invalid:")
+			self.emit("\toff = " + start)
+		self.emit("raise compiled_invalid('no variant matched')")
+		self.indent -= 1
+		self.pop_frame()
+		return value
+
+	def repeatstructfi(self, desc):
+		fi = desc.fi
+		start, start_line = self.node_start()
+		frame = self.push_frame(_Frame(start, self.var("l")))
+		frame.start_line = start_line
+		self.emit(frame.value + " = []")
+		if fi.times_expr is None:
+			pos = self.var("p")
+			self.emit("while " + self.end + " - off > 0:")
+			self.indent += 1
+			self.emit(pos + " = off")
+			if fi.until_invalid:
+				self.emit("try:")
+				self.indent += 1
+			self.context.id = "[]"
+			item = self.node(fi.children)
+			if fi.until_invalid:
+				self.indent -= 1
+				self.emit("except compiled_invalid:")
+				self.emit("\toff = " + pos)
+				self.emit("\tbreak")
+			self.emit(frame.value + ".append(" + item + ")")
+			self.emit("if " + pos + " == off: raise compiled_failure('infinite loop prevented')")
+			if getattr(fi.until_expr.compiled, "constant", True) is not False:
+				self.emit("if " + self.expr_src(fi.until_expr) + ": break")
+			self.indent -= 1
+		else:
+			self.emit("for _ in range(" + self.expr_src(fi.times_expr) + "):")
+			self.indent += 1
+			self.context.id = "[]"
+			self.emit(frame.value + ".append(" + self.node(fi.children) + ")")
+			self.indent -= 1
+		self.pop_frame()
+		return frame.value
+
+	def switchfi(self, desc):
+		start, start_line = self.node_start()
+		self.push_frame(_Frame(start)).start_line = start_line
+		check_for, value = self.var("k"), self.var("v")
+		self.emit(check_for + " = " + self.expr_src(desc.fi.expr))
+		keyword = "if "
+		for expr, child in desc.fi.children:
+			self.emit(keyword + self.expr_src(expr) + " == " + check_for + ":")
+			self.indent += 1
+			self.context.id = "case"
+			self.emit(value + " = " + self.node(child))
+			self.indent -= 1
+			keyword = "elif "
+		if desc.fi.children:
+			self.emit("else:")
+			self.emit("\t" + value + " = None")
+		else:
+			self.emit(value + " = None")
+		self.pop_frame()
+		return value
+
+	def namedfi(self, desc):
+		env = {k: self.param(k) for k in self.param_names if self.param(k) is not None}
+		fn = self.request_function(desc.fi.ref_name, env)
+		scope = [frame.value for frame in self.frames if frame.value is not None]
+		for frame in self.frames: frame.materialised = True
+		outer = "outer + (" + "".join(v + ", " for v in scope) + ")" if scope else "outer"
+		value = self.var("v")
+		self.emit(value + ", off = " + fn + "(buf, off, " + self.end + ", " + outer + ")")
+		return value
+
+	def fieldfi(self, desc):
+		fi = desc.fi
+		frame = self.push_frame(_Frame(None))
+		if fi.parse_with is not None:
+			frame.start, frame.start_line = self.node_start()
+		value = self.var("v")
+
+		if fi.size == DYN_LEN:
+			if fi.format_type != "STRINGZ": raise UnsupportedConstruct(fi.format_type)
+			n = self.var("n")
+			zero = self.var("z")
+			self.emit(zero + " = find_zero(buf, off, " + self.end + ")")
+			self.emit("if " + zero + " >= 0:")
+			self.emit("\t" + value + " = str(buf[off:" + zero + "], " + self.param_src("charset") + ")")
+			self.emit("\t" + n + " = " + zero + " - off + 1")
+			self.emit("else:")
+			self.emit("\t" + value + ", " + n + " = b'', 0")
+		else:
+			if fi.size >= 0:
+				n = str(fi.size)
+			elif fi.size == PREFIX_LEN:
+				n, prefix_len = self.var("n"), self.var("n")
+				self.emit(prefix_len + " = " + self.expr_src(fi.size_len_expr))
+				self.emit(n + " = int.from_bytes(buf[off:off+" + prefix_len + "], " + self.byteorder_src(prefix_len) + ")")
+				self.require(prefix_len)
+				self.emit("off += " + prefix_len)
+			elif fi.size_expr:
+				n = self.var("n")
+				self.emit(n + " = " + self.expr_src(fi.size_expr))
+			else:
+				n = self.var("n")
+				self.emit(n + " = " + self.end + " - off")
+
+			if fi.parse_with is not None:
+				self.require(n)
+				child_end, parent_end = self.var("e"), self.end
+				self.emit(child_end + " = off + " + n)
+				self.end = child_end
+				self.context.id = "parse_with"
+				self.emit(value + " = " + self.node(fi.parse_with))
+				self.end = parent_end
+				self.emit("off = " + child_end)
+				self.pop_frame()
+				return value
+
+			self.require(n)
+			self.emit(value + " = " + self._field_value_src(fi.format_type, n))
+
+		magic = self.param("magic")
+		if magic is not None:
+			self.emit("if " + value + " != " + self.literal(magic) + ": raise compiled_invalid")
+		if fi.value_expr:
+			self.emit(value + " = " + self.expr_src(fi.value_expr))
+		self.emit("off += " + n)
+		self.pop_frame()
+		return value
+
+	def _field_value_src(self, format_type, n):
+		data = "buf[off:off+" + n + "]"
+		if format_type == "NONE":
+			return "None"
+		elif format_type in _struct_formats:
+			endianness = self.param("endianness")
+			if endianness is None: return "missing_param('endianness')"
+			return self.struct_const(endianness + _struct_formats[format_type]) + ".unpack_from(buf, off)[0]"
+		elif format_type in _unsigned_types or format_type in _signed_types:
+			return "int.from_bytes(" + data + ", " + self.byteorder_src(n) + ", signed=" + repr(format_type in _signed_types) + ")"
+		elif format_type in _bytes_types:
+			return data
+		elif format_type in _string_types:
+			return "str(" + data + ", " + self.param_src("charset") + ")"
+		elif format_type == "ABSOLUTE_TIME":
+			unit = self.param("unit")
+			if unit not in (None, "s", "ms", "us"): raise UnsupportedConstruct("time unit " + repr(unit))
+			return "parse_timestamp(int.from_bytes(" + data + ", " + self.byteorder_src(n) + "), " + repr(unit) + ")"
+		elif format_type == "GUID":
+			endianness = self.param("endianness")
+			if endianness is None: return "missing_param('endianness')"
+			return "UUID(" + ("bytes_le=" if endianness == "<" else "bytes=") + "bytes(" + data + "))"
+		elif hasattr(builtinTypes[format_type][1], "format"):
+			return repr(builtinTypes[format_type][1].format) + " % tuple(" + data + ")"
+		else:
+			raise UnsupportedConstruct("type " + format_type)
+
+	def bitstructfi(self, desc):
+		fi = desc.fi
+		if any("__" in name or bits <= 0 for name, bits in fi.children):
+			raise UnsupportedConstruct("multi-part or empty bit fields")
+		self.require(str(fi.size))
+		raw, value = self.var("r"), self.var("v")
+		byteorder = "'little'" if self.param("endianness") == "<" else "'big'"
+		self.emit(raw + " = int.from_bytes(buf[off:off+" + str(fi.size) + "], " + byteorder + ")")
+		items, bitpos = [], 0
+		for name, bits in fi.children:
+			shift = fi.size * 8 - bitpos - bits
+			items.append(repr(name) + ": " + raw + " >> " + str(shift) + " & " + str((1 << bits) - 1))
+			bitpos += bits
+		self.emit(value + " = {" + ", ".join(items) + "}")
+		self.emit("off += " + str(fi.size))
+		return value
+
+	#endregion
+
+
+def generate_python_module(format_infos, def_name=None):
+	"""
+	Returns the source code of a Python module which parses the given definition
+	(default: the main definition of the container) by calling its parse(buf) function
+	"""
+	if def_name is None: def_name = format_infos.main_name
+	entry, source = PyCodeGenerator(format_infos, _collect_param_names(format_infos)).generate_module(def_name)
+	return source
+
+
+def _collect_param_names(format_infos):
+	names = set(INHERITED_PARAMS)
+	def collect(value):
+		if isinstance(value, Expression):
+			names.update(str(tree.children[0]) for tree in value.expr_tree.find_data("param_expr"))
+		elif isinstance(value, (list, tuple)):
+			for item in value: collect(item)
+		elif isinstance(value, dict):
+			for item in value.values(): collect(item)
+		elif hasattr(value, "params"):
+			collect(value.params)
+	for desc in format_infos.definitions.values():
+		collect(desc)
+	return sorted(names)
+
+
+class CompiledGrammar:
+	"""
+	Holds the generated parser functions for the definitions of a FormatInfoContainer. Use
+	get_compiled_grammar() to get the cached instance of a container.
+	"""
+	def __init__(self, format_infos):
+		self.format_infos = format_infos
+		self.param_names = _collect_param_names(format_infos)
+		self.entries = {}
+
+	def get_entry(self, def_name):
+		"""Returns the generated function for def_name, or None if it can't be compiled"""
+		if def_name is None: def_name = self.format_infos.main_name
+		if def_name not in self.entries:
+			try:
+				entry, source = PyCodeGenerator(self.format_infos, self.param_names).generate_module(def_name)
+				namespace = {}
+				exec(compile(source, "<compiled grammar " + def_name + ">", "exec"), namespace)
+				self.entries[def_name] = namespace[entry]
+			except (UnsupportedConstruct, SyntaxError, RecursionError) as ex:
+				logging.info("Definition %s can't be compiled, using the interpreter: %s", def_name, ex)
+				self.entries[def_name] = None
+		return self.entries[def_name]
+
+
+def get_compiled_grammar(format_infos) -> CompiledGrammar:
+	if 'compiled_grammar' not in format_infos.caches:
+		format_infos.caches['compiled_grammar'] = CompiledGrammar(format_infos)
+	return format_infos.caches['compiled_grammar']
+
+
+class CompiledParseContext(ParseContext):
+	"""
+	ParseContext which runs definitions as generated Python code instead of interpreting them.
+	Returns plain values like ParseContext. Definitions the compiler doesn't support, subflow
+	reassembly and all failures are handled by the interpreter.
+	"""
+	def parse(self, by_name=None):
+		if by_name is None: by_name = self.format_infos.main_name
+		if self.on_new_subflow_category is None and not self.stack:
+			entry = get_compiled_grammar(self.format_infos).get_entry(by_name)
+			if entry is not None:
+				try:
+					result, self.buf_offset = entry(self.buf, self.buf_offset, self.buf_limit_end or len(self.buf), ())
+					return result
+				except Exception as ex:
+					self.log("compiled parser failed, retrying with interpreter:", repr(ex))
+		return super().parse(by_name)
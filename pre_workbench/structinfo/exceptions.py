@@ -14,13 +14,61 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from pre_workbench.structinfo.hexdump import hexdump
+
+
+def _restore_parse_exception(cls, args, state):
+	ex = Exception.__new__(cls)
+	Exception.__init__(ex, *args)
+	ex.__dict__.update(state)
+	return ex
+
+
 class parse_exception(Exception):
+	"""
+	Base class of the errors raised while parsing. Variants and repeats use them for control flow, so only the
+	offset, message, a snapshot of the parse stack and the bytes around the offset are stored, the path and hexdump
+	in str() are created on first access.
+	"""
 	def __init__(self, context, msg, cause=None):
-		self.offset = context.offset()
-		self.context_hexdump = context.hexdump_context(self.offset)
-		super().__init__(context.get_path() + ": " + msg + "\n" + self.context_hexdump)
+		super().__init__(msg)
+		self.msg = msg
 		if cause: self.__cause__ = cause
-		self.parse_stack = context.stack
+		self._capture(context)
+
+	def _capture(self, context):
+		self.offset = context.offset()
+		self.parse_stack = list(context.stack)
+		# only the bytes shown in the hexdump are copied, the buffer may be large or a view of a mapped file
+		self._hexdump_start = self.offset - (self.offset % 16) - 16
+		delta = context.display_offset_delta
+		self._hexdump_bytes = bytes(context.buf[self._hexdump_start - delta : self._hexdump_start + 32 - delta])
+		self._path = None
+		self._context_hexdump = None
+
+	@property
+	def path(self):
+		if self._path is None and self.parse_stack is not None:
+			self._path = ".".join(frame.id for frame in self.parse_stack)
+		return self._path
+
+	@property
+	def context_hexdump(self):
+		if self._context_hexdump is None and self._hexdump_bytes is not None:
+			start = self._hexdump_start
+			self._context_hexdump = hexdump(self._hexdump_bytes, result='return', addr_offset=start, addr_ptr=self.offset - start)
+			self._hexdump_bytes = None
+		return self._context_hexdump
+
+	def __str__(self):
+		return "%s: %s\n%s" % (self.path, self.msg, self.context_hexdump)
+
+	def __reduce__(self):
+		# the parse stack and descriptions refer to the whole parse tree and grammar, they are not pickled. The
+		# message parts which depend on them are rendered first
+		str(self)
+		state = {k: None if k in ('parse_stack', 'offending_desc', '_hexdump_bytes') else v for k, v in self.__dict__.items()}
+		return _restore_parse_exception, (type(self), self.args, state)
 
 
 class incomplete(parse_exception):
@@ -29,6 +77,16 @@ class incomplete(parse_exception):
 		self.needed_bytes = need
 		self.got_bytes = got
 
+	def reuse(self, context, need, got):
+		"""Updates this exception for another failure instead of allocating one, see ParseContext.preallocated_incomplete"""
+		self.__traceback__ = None
+		self.msg = "incomplete: needed %d, got %d bytes" %(need,got)
+		self.args = (self.msg,)
+		self.needed_bytes = need
+		self.got_bytes = got
+		self._capture(context)
+		return self
+
 
 class invalid(parse_exception):
 	def __init__(self, context, msg="invalid"):
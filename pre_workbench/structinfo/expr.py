@@ -17,8 +17,13 @@
 import json
 import os.path
 import logging
+import threading
+from collections import OrderedDict
 
-from lark import Lark, Transformer
+import operator
+
+from lark import Lark, Transformer, Token
+from lark.exceptions import LarkError
 
 from pre_workbench.structinfo import ExprFunctions
 
@@ -27,191 +32,226 @@ logging.info("grammar_file: %s", grammar_file)
 fi_parser = Lark(open(grammar_file), parser="earley", lexer="dynamic", start=["start","anytype","expression"], maybe_placeholders=True)
 fi_parser_hilight = Lark(open(grammar_file), parser="earley", lexer="dynamic", start=["start","anytype","expression"],
 						 maybe_placeholders=True, keep_all_tokens=True)
-
-
-class Evaluator(Transformer):
+lalr_grammar_file = os.path.join(os.path.dirname(__file__), "format_info_lalr.lark")
+fi_parser_lalr = Lark(open(lalr_grammar_file), parser="lalr", start=["start","anytype","expression"], maybe_placeholders=True)
+
+
+def parse_grammar_text(txt, start):
+	"""Parses with the fast LALR parser, falls back to the Earley parser for input the LALR variant doesn't accept"""
+	try:
+		return fi_parser_lalr.parse(txt, start=start)
+	except LarkError:
+		return fi_parser.parse(txt, start=start)
+
+
+_binary_ops = {
+	"+": operator.add,
+	"-": operator.sub,
+	"*": operator.mul,
+	"/": operator.truediv,
+	"&": operator.and_,
+	"|": operator.or_,
+	"^": operator.xor,
+	"<<": operator.lshift,
+	">>": operator.rshift,
+	"||": lambda a, b: a or b,
+	"&&": lambda a, b: a and b,
+	"==": operator.eq,
+	"!=": operator.ne,
+	"<": operator.lt,
+	">": operator.gt,
+	">=": operator.ge,
+	"<=": operator.le,
+}
+
+
+def _const(value):
+	fn = lambda ctx, scope: value
+	fn.constant = value
+	return fn
+
+
+class ExprCompiler(Transformer):
+	"""
+	Compiles an expression tree into a closure, which is called as fn(ctx, scope).
+
+	The closure only depends on the tree, so it is built once per Expression.
+	Everything that depends on the evaluation target (field lookup, parameters,
+	function calls) is delegated to the scope object, see ParseContextScope,
+	ByteBufferScope and DictScope.
+	"""
 	def paren_expr(self, s):
 		return s[0]
 
 	def string_expr(self, s):
-		return json.loads(s[0])
+		return _const(json.loads(s[0]))
 
 	def number_expr(self, n):
-		return float(n[0]) if "." in n[0] else int(n[0], 0)
+		return _const(float(n[0]) if "." in n[0] else int(n[0], 0))
 
-	null_expr = lambda self, _: None
-	true_expr = lambda self, _: True
-	false_expr = lambda self, _: False
+	null_expr = lambda self, _: _const(None)
+	true_expr = lambda self, _: _const(True)
+	false_expr = lambda self, _: _const(False)
 
 	def math_expr(self, node):
-		if node[1] == "+":
-			return node[0] + node[2]
-		elif node[1] == "-":
-			return node[0] - node[2]
-		elif node[1] == "*":
-			return node[0] * node[2]
-		elif node[1] == "&":
-			return node[0] & node[2]
-		elif node[1] == "|":
-			return node[0] | node[2]
-		elif node[1] == "^":
-			return node[0] ^ node[2]
-		elif node[1] == "<<":
-			return node[0] << node[2]
-		elif node[1] == ">>":
-			return node[0] >> node[2]
-		elif node[1] == "/":
-			if isinstance(node[0], dict): return node[0][node[1]]
-			return node[0] / node[2]
-		elif node[1] == "||":
-			return node[0] or node[2]
-		elif node[1] == "&&":
-			return node[0] and node[2]
-
-	def compare_expr(self, node):
-		if node[1] == "==":
-			return node[0] == node[2]
-		elif node[1] == "!=":
-			return node[0] != node[2]
-		elif node[1] == "<":
-			return node[0] < node[2]
-		elif node[1] == ">":
-			return node[0] > node[2]
-		elif node[1] == ">=":
-			return node[0] >= node[2]
-		elif node[1] == "<=":
-			return node[0] <= node[2]
+		a, op, b = node
+		fn = _binary_ops[str(op)]
+		if hasattr(a, "constant") and hasattr(b, "constant"):
+			try:
+				return _const(fn(a.constant, b.constant))
+			except Exception:
+				pass
+		return lambda ctx, scope: fn(a(ctx, scope), b(ctx, scope))
 
-	def bool_expr(self, node):
-		if node[1] == "||":
-			return node[0] or node[2]
-		elif node[1] == "&&":
-			return node[0] and node[2]
+	compare_expr = math_expr
+	bool_expr = math_expr
 
 	def fun_expr(self, node):
-		name, params = node[0], node[1:]
+		name, args = str(node[0]), node[1:]
+		if len(args) == 1:
+			arg = args[0]
+			return lambda ctx, scope: scope.call(ctx, name, (arg(ctx, scope),))
+		return lambda ctx, scope: scope.call(ctx, name, tuple(arg(ctx, scope) for arg in args))
+
+	def hierarchy_expr(self, node):
+		level = len(node[0])
+		return lambda ctx, scope: scope.hierarchy(ctx, level)
+
+	def array_expr(self, node):
+		obj, index = node
+		return lambda ctx, scope: scope.item(ctx, obj(ctx, scope), index(ctx, scope))
+
+	def member_expr(self, node):
+		obj, name = node[0], str(node[1])
+		return lambda ctx, scope: scope.member(ctx, obj(ctx, scope), name)
+
+	def anyfield_expr(self, node):
+		id = str(node[0])
+		return lambda ctx, scope: scope.anyfield(ctx, id)
+
+	def param_expr(self, node):
+		if isinstance(node[0], Token):
+			id = str(node[0])
+			return lambda ctx, scope: scope.param(ctx, id)
+		id_expr = node[0]
+		return lambda ctx, scope: scope.param(ctx, id_expr(ctx, scope))
+
+
+class Scope:
+	"""
+	Base class for the evaluation targets of compiled expressions. Methods receive
+	the target object as ctx, so scopes are stateless and shared.
+	"""
+	def hierarchy(self, ctx, level):
+		raise NotImplementedError("hierarchy expressions are not supported here")
+
+	def item(self, ctx, obj, index):
+		return obj[index]
+
+	def member(self, ctx, obj, name):
+		try:
+			return obj[name]
+		except KeyError as e:
+			raise Exception("item has no member named "+name)
+
+	def anyfield(self, ctx, id):
+		raise NotImplementedError
+
+	def param(self, ctx, id):
+		raise NotImplementedError
+
+	def call(self, ctx, name, params):
 		fn, meta = ExprFunctions.find(name=name)
 		if fn:
 			return fn(*params)
 		else:
 			raise Exception("Call to unknown function '"+name+"'")
 
-class ParseContextEvaluator(Evaluator):
-	def __init__(self, parse_context):
-		super().__init__()
-		self.parse_context = parse_context
 
-	def hierarchy_expr(self, node):
-		#print("hierarchy_expr", node, self.parse_context.stack[-len(node[0])][1])
-		return self.parse_context.stack[-len(node[0])].value
+class ParseContextScope(Scope):
+	def hierarchy(self, pc, level):
+		if pc._memo_recorders: pc.memo_escape(len(pc.stack) - level)
+		return pc.stack[-level].value
 
-	def array_expr(self, node):
-		#print("array_expr", node)
-		return self.parse_context.unpack_value(node[0][node[1]])
+	def item(self, pc, obj, index):
+		return pc.unpack_value(obj[index])
 
-	def member_expr(self, node):
-		#print("member_expr", node)
+	def member(self, pc, obj, name):
 		try:
-			return self.parse_context.unpack_value(node[0][node[1]])
+			return pc.unpack_value(obj[name])
 		except KeyError as e:
-			raise Exception("item has no member named \""+str(node[1])+"\"")
+			raise Exception("item has no member named \""+name+"\"")
 
-	def anyfield_expr(self, node):
-		id = node[0]
-		for i in range(len(self.parse_context.stack)-1, -1, -1):
-			frame = self.parse_context.stack[i]
-			if frame.value is not None:
+	def anyfield(self, pc, id):
+		if pc._memo_recorders: pc.memo_record('field', id)
+		for frame in reversed(pc.stack):
+			value = frame.value
+			if value is not None:
 				if id == 'this':
-					return frame.value
-				if id in frame.value:
-					return self.parse_context.unpack_value(frame.value[id])
+					return value
+				if id in value:
+					return pc.unpack_value(value[id])
 		raise Exception("field \""+id+"\" not found")
 
-	def param_expr(self, node):
-		return self.parse_context.get_param(node[0])
+	def param(self, pc, id):
+		return pc.get_param(id)
 
-	def fun_expr(self, node):
-		name, param = node
+	def call(self, pc, name, params):
 		if name == "pad":
-			len = self.parse_context.top_length(-2)
+			param, = params
+			if pc._memo_recorders: pc.memo_escape(len(pc.stack) - 2)
+			len = pc.top_length(-2)
 			if len % param == 0:
 				return 0
 			else:
 				return param - (len % param)
-		else:
-			return super().fun_expr(node)
+		return super().call(pc, name, params)
+
 
 def generic_unpack_value(packed_value):
 	while hasattr(packed_value, 'value'):
 		packed_value = packed_value.value
 	return packed_value
 
-class ByteBufferEvaluator(Evaluator):
-	def __init__(self, bbuf):
-		super().__init__()
-		self.bbuf = bbuf
-
-	def hierarchy_expr(self, node):
-		raise NotImplemented
+class ByteBufferScope(Scope):
+	def item(self, bbuf, obj, index):
+		return generic_unpack_value(obj[index])
 
-	def array_expr(self, node):
-		#print("array_expr", node)
-		return generic_unpack_value(node[0][node[1]])
-
-	def member_expr(self, node):
-		#print("member_expr", node)
+	def member(self, bbuf, obj, name):
 		try:
-			return generic_unpack_value(node[0][node[1]])
+			return generic_unpack_value(obj[name])
 		except KeyError as e:
-			raise Exception("item has no member named "+str(node[1]))
+			raise Exception("item has no member named "+name)
 
-	def anyfield_expr(self, node):
-		id = node[0]
+	def anyfield(self, bbuf, id):
 		if id == "payload":
-			return self.bbuf.buffer
+			return bbuf.buffer
 		if id == "fields":
-			return self.bbuf.fields
-		frame = generic_unpack_value(self.bbuf.fi_tree)
+			return bbuf.fields
+		frame = generic_unpack_value(bbuf.fi_tree)
 		if id == "root":
 			return frame
-		#print(frame)
 		if frame is not None and id in frame:
 			return generic_unpack_value(frame[id])
 		raise Exception("field "+id+" not found")
 
-	def param_expr(self, node):
-		return self.bbuf.metadata[node[0]]
-
-
-
-class DictEvaluator(Evaluator):
-	def __init__(self, dic):
-		super().__init__()
-		self.dic = dic
+	def param(self, bbuf, id):
+		return bbuf.metadata[id]
 
-	def hierarchy_expr(self, node):
-		raise NotImplemented
 
-	def array_expr(self, node):
-		#print("array_expr", node)
-		return node[0][node[1]]
+class DictScope(Scope):
+	def anyfield(self, dic, id):
+		if dic is not None and id in dic:
+			return dic[id]
+		raise Exception("field "+id+" not found")
 
-	def member_expr(self, node):
-		#print("member_expr", node)
-		try:
-			return node[0][node[1]]
-		except KeyError as e:
-			raise Exception("item has no member named "+str(node[1]))
+	def param(self, dic, id):
+		raise Exception("parameter $"+str(id)+" not available")
 
-	def anyfield_expr(self, node):
-		id = node[0]
-		frame = self.dic
-		if frame is not None and id in frame:
-			return frame[id]
-		raise Exception("field "+id+" not found")
 
-	def param_expr(self, node):
-		return self.bbuf.metadata[node[0]]
+parse_context_scope = ParseContextScope()
+byte_buffer_scope = ByteBufferScope()
+dict_scope = DictScope()
 
 
 class Stringifier(Transformer):
@@ -259,6 +299,47 @@ class Stringifier(Transformer):
 		return node[0] + "(" + node[1] + ")"
 
 
+class ExpressionCache:
+	"""
+	Bounded LRU of parsed and compiled expressions by expression text, shared by all Expression instances,
+	so re-applying a grammar doesn't parse the same expressions again.
+	"""
+	def __init__(self, maxsize=4096):
+		self.maxsize = maxsize
+		self.entries = OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	def lookup(self, expr_str, expr_tree=None):
+		"""Returns (expr_tree, compiled) for expr_str, parses it on a miss unless expr_tree is given"""
+		with self.lock:
+			entry = self.entries.get(expr_str)
+			if entry is not None:
+				self.hits += 1
+				self.entries.move_to_end(expr_str)
+				return entry
+			self.misses += 1
+		if expr_tree is None:
+			expr_tree = parse_grammar_text(expr_str, start="expression")
+		entry = (expr_tree, ExprCompiler().transform(expr_tree))
+		with self.lock:
+			self.entries[expr_str] = entry
+			if len(self.entries) > self.maxsize:
+				self.entries.popitem(last=False)
+		return entry
+
+	def stats(self):
+		return {"hits": self.hits, "misses": self.misses, "size": len(self.entries), "maxsize": self.maxsize}
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+			self.hits = self.misses = 0
+
+expression_cache = ExpressionCache()
+
+
 def deserialize_expr(expr):
 	if isinstance(expr, Expression): return expr
 	return Expression(expr_str=expr)
@@ -266,15 +347,19 @@ def deserialize_expr(expr):
 
 class Expression:
 	def __init__(self, expr_str=None, expr_tree=None):
-		if expr_str:
+		if expr_tree is not None:
+			self.expr_str = expr_str if expr_str else Stringifier().transform(expr_tree)
+			self.expr_tree, self.compiled = expression_cache.lookup(self.expr_str, expr_tree)
+		else:
 			self.expr_str = expr_str
 			try:
-				self.expr_tree = fi_parser.parse(self.expr_str, start="expression")
+				self.expr_tree, self.compiled = expression_cache.lookup(expr_str)
 			except Exception as e:
 				raise Exception("Failed to parse expression '"+expr_str+"': "+str(e)) from e
-		elif expr_tree:
-			self.expr_tree = expr_tree
-			self.expr_str = Stringifier().transform(expr_tree)
+
+	def __reduce__(self):
+		# the compiled closures can't be pickled, they are rebuilt from the tree
+		return Expression, (self.expr_str, self.expr_tree)
 
 	def serialize(self):
 		return self.expr_str
@@ -283,26 +368,20 @@ class Expression:
 
 	def evaluate(self, parse_context):
 		try:
-			return ParseContextEvaluator(parse_context).transform(self.expr_tree)
+			return self.compiled(parse_context, parse_context_scope)
 		except Exception as e:
-			#logging.exception("Failed to eval expr_str: %s", self.expr_str)
-			#logging.warning("expr_tree pretty: %s", self.expr_tree.pretty())
 			raise Exception("Failed to evaluate expression '"+self.expr_str+"' ("+type(e).__name__+"): "+str(e)) from e
 
 	def evaluate_bbuf(self, bbuf):
 		try:
-			return ByteBufferEvaluator(bbuf).transform(self.expr_tree)
+			return self.compiled(bbuf, byte_buffer_scope)
 		except Exception as e:
-			#logging.exception("Failed to eval expr_str on bbuf: %s", self.expr_str)
-			#logging.warning("expr_tree pretty: %s", self.expr_tree.pretty())
 			raise Exception("Failed to evaluate expression '"+self.expr_str+"' ("+type(e).__name__+"): "+str(e)) from e
 
 	def evaluate_dict(self, dic):
 		try:
-			return DictEvaluator(dic).transform(self.expr_tree)
+			return self.compiled(dic, dict_scope)
 		except Exception as e:
-			#logging.exception("Failed to eval expr_str on dict: %s", self.expr_str)
-			#logging.warning("expr_tree pretty: %s", self.expr_tree.pretty())
 			raise Exception("Failed to evaluate expression '"+self.expr_str+"' ("+type(e).__name__+"): "+str(e)) from e
 
 
@@ -16,23 +16,38 @@
 
 import datetime
 import logging
+import struct
 import uuid
 from collections import defaultdict
 
-from math import ceil, floor
+from math import ceil
 
-from bitstring import BitStream
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
 
 from pre_workbench.structinfo import FITypes, ExprFunctions, xdrm
 from pre_workbench.structinfo.exceptions import *
 from pre_workbench.structinfo.expr import deserialize_expr, Expression
-from pre_workbench.structinfo.parsecontext import ParseContext
+from pre_workbench.structinfo.parsecontext import ParseContext, LazyRepeatList, RecordArray
 from pre_workbench.structinfo.valueenc import StructInfoValueEncoder
 
 @xdrm.Serializable.register(class_id=0x1000)
 class FormatInfo:
+	# incremented on every parameter change, invalidates the cached inherited params of all nodes
+	params_generation = 0
+
 	def __init__(self, typeRef, params):
 		self.params = dict()
+		self.def_root = None
+		self.def_parent = None
+		self.def_depth = 0
+		self._inherited_params = None
+		self._inherited_generation = -1
+		self._fixed_size = None
+		self._fixed_size_generation = -1
 		self.fi = typeRef()
 		self.updateParams(**params)
 
@@ -45,6 +60,10 @@ class FormatInfo:
 	def __serialize__(self):
 		return [type(self.fi).type_id, self.params]
 
+	def __reduce__(self):
+		# pickle only type and params, the rest is derived by updateParams
+		return FormatInfo.__deserialize__, (self.__serialize__(),)
+
 	def updateParams(self, **changes):
 		for k,v in changes.items():
 			if v is None:
@@ -52,6 +71,8 @@ class FormatInfo:
 			else:
 				self.params[k] = v
 		self.fi.init(**self.params)
+		FormatInfo.params_generation += 1
+		self._update_expression_params()
 
 		if "show" in self.params:
 			# TODO: BUG: when this is called from Project load, plugin functions won't be registered yet
@@ -76,6 +97,37 @@ class FormatInfo:
 		item = parse_definition(txt)
 		self.fi = item.fi
 		self.params = item.params
+		FormatInfo.params_generation += 1
+		self._update_expression_params()
+
+	def _update_expression_params(self):
+		# the params extra_params has to evaluate, see AnnotatingParseContext
+		self.expression_params = tuple(k for k, v in self.params.items() if isinstance(v, Expression) and k not in ('children', 'def_name'))
+
+	def child_infos(self):
+		return self.fi._child_infos()
+
+	def get_inherited_params(self):
+		"""
+		Returns the params of this node merged with those of its ancestors in the same definition,
+		see FormatInfoContainer.link_definitions
+		"""
+		if self._inherited_generation != FormatInfo.params_generation:
+			base = self.def_parent.get_inherited_params() if self.def_parent is not None else {}
+			self._inherited_params = {**base, **self.params}
+			self._inherited_generation = FormatInfo.params_generation
+		return self._inherited_params
+
+	def fixed_size(self, context, seen=()):
+		"""
+		Returns the number of bytes this node consumes independent of the data, or None if it isn't known in advance.
+		seen contains the nodes currently being computed, to stop at recursive references.
+		"""
+		if self._fixed_size_generation != FormatInfo.params_generation:
+			if self in seen: return None
+			self._fixed_size = getattr(self.fi, '_fixed_size', lambda c, s: None)(context, (*seen, self))
+			self._fixed_size_generation = FormatInfo.params_generation
+		return self._fixed_size
 
 	def extra_params(self, removewhat=['children','def_name'], context=None):
 		return {i:self._eval_if_needed(self.params[i], context) for i in self.params if not i in removewhat}
@@ -97,13 +149,15 @@ class FormatInfo:
 				logging.info("%s %s: \t%r", "+ " * len(context.stack), self.params["print"], result.value if hasattr(result, "value") else result)
 			return result
 		except parse_exception as ex:
-			context.log("[!!!] parse_exception: "+str(ex))
+			context.log("[!!!] parse_exception:", ex)
+			if context.profile is not None: context.profile.count_exception(self)
 			context.restore_offset()
 			if not context.get_param("ignore_errors", False, raise_if_missing=False):
 				context.set_failed(ex)
 			return context.pack_error(ex)
 		except Exception as ex:
-			context.log("[!!!] UNHANDLED Exception in FI parse: "+str(ex))
+			context.log("[!!!] UNHANDLED Exception in FI parse:", ex)
+			if context.profile is not None: context.profile.count_exception(self)
 			context.restore_offset()
 			ex = parse_exception(context, "UNHANDLED Exception in FI parse: "+str(ex), cause=ex)
 			if not context.get_param("ignore_errors", False, raise_if_missing=False):
@@ -132,6 +186,10 @@ class FormatInfo:
 	def fi_type(self):
 		return type(self.fi).__name__
 
+# parameters which prevent a field from being decoded as part of a fixed layout struct
+_fixed_layout_blocking_params = ('magic', 'value', 'size', 'size_len', 'parse_with', 'print', 'endianness',
+								 'ignore_errors', 'reassemble_into', 'store_into')
+
 @FITypes.register(type_id=2)
 class StructFI:
 	def init(self, children, **kw):
@@ -140,6 +198,57 @@ class StructFI:
 			self.size = sum(c.size for (name, c, comment) in self.children)
 		except:
 			self.size = None
+		self._init_fixed_layout(kw)
+
+	def _init_fixed_layout(self, params):
+		"""
+		If all children are fixed-size numeric fields without parameters that influence parsing, the whole struct
+		is decoded with a single struct.Struct. The per-field results are created by ParseContext.pack_fixed_fields.
+		"""
+		self.fixed_format = None
+		self.fixed_fields = None
+		self.fixed_structs = {}
+		self.numpy_dtypes = {}
+		if not self.children or 'magic' in params: return
+		fmt = ""
+		for name, c, comment in self.children:
+			if not isinstance(c.fi, FieldFI) or c.fi.struct_format is None: return
+			if any(k in c.params for k in _fixed_layout_blocking_params): return
+			fmt += c.fi.struct_format
+		self.fixed_format = fmt
+		self.fixed_fields = [(name, c, c.fi.size) for (name, c, comment) in self.children]
+		self.fixed_names = [name for (name, c, comment) in self.children]
+		self.fixed_size = struct.calcsize("<" + fmt)
+		endianness = params.get('endianness')
+		if isinstance(endianness, str):
+			self._get_fixed_struct(endianness)
+
+	def _get_numpy_dtype(self, endianness):
+		try:
+			return self.numpy_dtypes[endianness]
+		except KeyError:
+			byteorder = _numpy_byteorders[endianness]
+			try:
+				dtype = numpy.dtype([(name, byteorder + numpyTypeCodes[c.fi.struct_format]) for (name, c, size) in self.fixed_fields])
+			except ValueError:
+				# e.g. duplicate field names
+				dtype = None
+			self.numpy_dtypes[endianness] = dtype
+			return dtype
+
+	def _get_fixed_struct(self, endianness):
+		try:
+			return self.fixed_structs[endianness]
+		except KeyError:
+			s = self.fixed_structs[endianness] = struct.Struct(endianness + self.fixed_format)
+			return s
+
+	def _child_infos(self):
+		return [c for (name, c, comment) in self.children]
+
+	def _fixed_size(self, context, seen):
+		sizes = [c.fixed_size(context, seen) for (name, c, comment) in self.children]
+		return None if None in sizes else sum(sizes)
 
 	def _to_text(self, indent, refs, all_params):
 		x = "struct"+params_to_text(indent, refs, all_params, )+" {"+"\n"
@@ -149,6 +258,12 @@ class StructFI:
 		return x + "\t"*indent+"}"
 
 	def _parse(self, context):
+		if self.fixed_format is not None and context.remaining_bytes() >= self.fixed_size:
+			endianness = context.get_param('endianness', raise_if_missing=False)
+			if endianness is not None and context.get_param('magic', raise_if_missing=False) is None:
+				values = self._get_fixed_struct(endianness).unpack_from(context.buf, context.buf_offset)
+				return context.pack_value(context.pack_fixed_fields(self, values))
+
 		o = {}
 		context.set_top_value(o)
 		for name, child, comment in self.children:
@@ -164,6 +279,9 @@ class VariantStructFI:
 		self.children = [c for c in children]
 		self.size = None
 
+	def _child_infos(self):
+		return self.children
+
 	def _to_text(self, indent, refs, all_params):
 		if len(self.children) == 1:
 			return params_to_text(indent, refs, all_params, ) + self.children[0].to_text(indent, refs)
@@ -174,7 +292,8 @@ class VariantStructFI:
 
 	def _parse(self, context):
 		start_offset = context.buf_offset
-		for i, variant in enumerate(self.children):
+		for i in self._candidates(context):
+			variant = self.children[i]
 			context.buf_offset = start_offset
 			context.id = "var-%d"%i
 			result = context.pack_value(variant.read_from_buffer(context))
@@ -192,6 +311,101 @@ class VariantStructFI:
 		raise invalid(context, "no variant matched")
 		#return context.pack_value(None)
 
+	def _candidates(self, context):
+		"""
+		Returns the indices of the children which might match, in order. Children starting with magic values (see
+		_leading_magic) are skipped if the bytes at the current offset don't match, as they would fail anyway.
+		The definitions of skipped children are added to context.used_definitions too, as changing them might
+		change which child matches.
+		"""
+		cache = context.format_infos.caches.setdefault('variant_dispatch', {})
+		try:
+			always, tables, names = cache[id(self)]
+		except KeyError:
+			always, tables, names = cache[id(self)] = self._build_dispatch(context)
+		if not tables or context.get_param('ignore_errors', False, raise_if_missing=False):
+			return range(len(self.children))
+		context.used_definitions.update(names)
+		candidates = list(always)
+		remaining = context.remaining_bytes()
+		for (offset, size, fmt, endianness), table in tables.items():
+			if endianness is None:
+				endianness = context.get_param('endianness', raise_if_missing=False)
+			value = _peek_magic(context, offset, size, fmt, endianness) if offset + size <= remaining else None
+			if value is None:
+				# not decidable here, e.g. incomplete, let the children fail on their own
+				for indices in table.values(): candidates.extend(indices)
+			else:
+				candidates.extend(table.get(value, ()))
+		return sorted(candidates)
+
+	def _build_dispatch(self, context):
+		"""
+		Returns the indices of the children without leading magic value, for each way to decode one (offset, size,
+		struct format, endianness or None if inherited) a dict of magic value to indices of the children, and the
+		names of the definitions referenced by the children, which include those _leading_magic looks into.
+		"""
+		always = []
+		tables = defaultdict(lambda: defaultdict(list))
+		names = []
+		for i, child in enumerate(self.children):
+			context.format_infos.referenced_definitions(child, names)
+			magic = _leading_magic(context, child, 0, None, set())
+			if not isinstance(magic, tuple):
+				always.append(i)
+			else:
+				offset, size, fmt, endianness, value = magic
+				tables[(offset, size, fmt, endianness)][value].append(i)
+		return always, {k: dict(v) for k, v in tables.items()}, names
+
+
+def _leading_magic(context, node, offset, endianness, seen):
+	"""
+	Returns (offset, size, struct format, endianness, value) of the first integer field with a magic value in node,
+	if it is only preceded by plain integer fields, so node fails with invalid if the value doesn't match. Returns
+	an int offset if node is such a field sequence without magic value, or None if it can't be determined.
+	"""
+	if any(k in node.params for k in ('ignore_errors', 'parse_with', 'size', 'size_len')): return None
+	endianness = node.params.get('endianness', endianness)
+	fi = node.fi
+	if isinstance(fi, NamedFI):
+		if fi.ref_name in seen or 'magic' in node.params: return None
+		try:
+			ref = context.get_fi_by_def_name(fi.ref_name)
+		except parse_exception:
+			return None
+		return _leading_magic(context, ref, offset, endianness, seen | {fi.ref_name})
+	elif isinstance(fi, StructFI):
+		if 'magic' in node.params: return None
+		for name, child, comment in fi.children:
+			result = _leading_magic(context, child, offset, endianness, seen)
+			if not isinstance(result, int): return result
+			offset = result
+		return offset
+	elif isinstance(fi, FieldFI) and fi.size > 0 and (fi.struct_format is not None or fi._parse_fn in (_parse_signed_int, _parse_unsigned_int)):
+		magic = node.params.get('magic')
+		if magic is None:
+			return offset + fi.size
+		if type(magic) is not int: return None
+		if fi._parse_fn in (_parse_signed_int, _parse_unsigned_int):
+			fmt = 's' if fi._parse_fn is _parse_signed_int else 'u'
+		else:
+			fmt = fi.struct_format
+		return offset, fi.size, fmt, endianness, magic
+	else:
+		return None
+
+
+def _peek_magic(context, offset, size, fmt, endianness):
+	if size == 1 and fmt in 'us':
+		endianness = '<'
+	elif endianness is None:
+		return None
+	start = context.buf_offset + offset
+	if fmt in 'us':
+		return int.from_bytes(context.buf[start:start + size], signed=fmt == 's', byteorder='little' if endianness == '<' else 'big')
+	return struct.unpack_from(endianness + fmt, context.buf, start)[0]
+
 
 @FITypes.register(type_id=4)
 class RepeatStructFI:
@@ -206,10 +420,28 @@ class RepeatStructFI:
 		self.until_invalid = until_invalid
 		self.size = None
 
+	def _child_infos(self):
+		return [self.children]
+
+	def _fixed_size(self, context, seen):
+		times = getattr(self.times_expr, 'compiled', None)
+		if not isinstance(getattr(times, 'constant', None), int): return None
+		size = self.children.fixed_size(context, seen)
+		return None if size is None else times.constant * size
+
 	def _to_text(self, indent, refs, all_params):
 		return "repeat"+params_to_text(indent, refs, all_params, ) +" "+ self.children.to_text(indent+1, refs)
 
 	def _parse(self, context : ParseContext):
+		if context.vectorize_repeats and numpy is not None:
+			records = self._parse_vectorized(context)
+			if records is not None:
+				return context.pack_value(records)
+		if context.lazy_repeat_threshold is not None:
+			lazy = self._parse_lazy(context)
+			if lazy is not None:
+				return context.pack_value(lazy)
+
 		o = []
 		context.set_top_value(o)
 		if self.times_expr is None:
@@ -236,6 +468,67 @@ class RepeatStructFI:
 				if context.failed: break
 		return context.pack_value(o)
 
+	def _static_count(self, context, size):
+		"""Returns the number of children of the given size if it is known without parsing them, otherwise None"""
+		remaining = context.remaining_bytes()
+		if self.times_expr is not None:
+			count = self.times_expr.evaluate(context)
+			return count if count * size <= remaining else None
+		elif getattr(self.until_expr.compiled, 'constant', None) is False and not self.until_invalid and remaining % size == 0:
+			return remaining // size
+		else:
+			return None
+
+	def _parse_lazy(self, context : ParseContext):
+		"""
+		If the children have a fixed size and their count is known without parsing them, returns a LazyRepeatList
+		which decodes them on access and consumes their bytes. Otherwise returns None to parse them right away.
+		"""
+		size = self.children.fixed_size(context)
+		if not size: return None
+		count = self._static_count(context, size)
+		if count is None or count < context.lazy_repeat_threshold: return None
+		# the elements are parsed later, with params and fields which memoized reads can't check
+		if context._memo_recorders: context.memo_escape(-1)
+		# the definitions the elements will use are all they could use
+		context.used_definitions.update(context.format_infos.referenced_definitions(self.children))
+		lazy = LazyRepeatList(context, self.children, context.buf_offset, size, count)
+		context.set_top_value(lazy)
+		context.buf_offset += count * size
+		return lazy
+
+	def _parse_vectorized(self, context : ParseContext):
+		"""
+		If the children are fixed layout structs (see StructFI._init_fixed_layout) and their count is known without
+		parsing them, decodes all of them at once into a RecordArray. Otherwise returns None.
+		"""
+		child = self.children
+		endianness = None
+		while True:
+			# params of the outer nodes apply unless the inner ones override them
+			if any(k in child.params for k in _fixed_layout_blocking_params if k != 'endianness'): return None
+			endianness = child.params.get('endianness', endianness)
+			if not isinstance(child.fi, NamedFI): break
+			context.used_definitions.add(child.fi.ref_name)
+			if child.fi.ref is None:
+				child.fi.ref = context.get_fi_by_def_name(child.fi.ref_name)
+			child = child.fi.ref
+		if not isinstance(child.fi, StructFI) or child.fi.fixed_format is None: return None
+		if endianness is None:
+			endianness = context.get_param('endianness', raise_if_missing=False)
+		if endianness not in _numpy_byteorders or context.get_param('magic', raise_if_missing=False) is not None:
+			return None
+		dtype = child.fi._get_numpy_dtype(endianness)
+		count = self._static_count(context, child.fi.fixed_size)
+		if dtype is None or count is None: return None
+		array = numpy.frombuffer(context.buf, dtype, count, context.buf_offset)
+		records = RecordArray(array)
+		context.set_top_value(records)
+		context.buf_offset += count * child.fi.fixed_size
+		return records
+
+
+_no_constant = object()
 
 @FITypes.register(type_id=5)
 class SwitchFI:
@@ -243,6 +536,19 @@ class SwitchFI:
 		self.children = [(deserialize_expr(expr), c) for (expr, c) in children]
 		self.expr = deserialize_expr(expr)
 		self.size = None
+		# cases with constant expressions are looked up by value, only the others are evaluated while parsing
+		self.constant_cases = {}
+		self.dynamic_cases = []
+		for i, (expr, c) in enumerate(self.children):
+			constant = getattr(expr.compiled, 'constant', _no_constant)
+			try:
+				if constant is _no_constant or constant != constant: raise TypeError()  # NaN never matches
+				self.constant_cases.setdefault(constant, i)
+			except TypeError:
+				self.dynamic_cases.append(i)
+
+	def _child_infos(self):
+		return [c for (expr, c) in self.children]
 
 	def _to_text(self, indent, refs, all_params):
 		x = "switch "+self.expr.expr_str+" "+ params_to_text(indent, refs, all_params, ignore=["children","expr"])+"{"+"\n"
@@ -252,12 +558,23 @@ class SwitchFI:
 
 	def _parse(self, context):
 		checkFor = self.expr.evaluate(context)
-		for expr, child in self.children:
-			if expr.evaluate(context) == checkFor:
-				context.id = "case %r" % (checkFor,)
-				return context.pack_value(child.read_from_buffer(context))
+		try:
+			match = self.constant_cases.get(checkFor)
+		except TypeError:
+			# unhashable values are compared with every constant case
+			match = next((i for i, (expr, c) in enumerate(self.children) if i not in self.dynamic_cases and expr.compiled.constant == checkFor), None)
+		# dynamic cases before the matching constant case take precedence
+		for i in self.dynamic_cases:
+			if match is not None and i > match: break
+			if self.children[i][0].evaluate(context) == checkFor:
+				match = i
+				break
+		if match is not None:
+			context.id = "case %r" % (checkFor,)
+			return context.pack_value(self.children[match][1].read_from_buffer(context))
 		#raise invalid(context, "no switch case matched")
-		context.log("no switch case matched, expr value = "+repr(checkFor))
+		if context.logging_enabled:
+			context.log("no switch case matched, expr value = "+repr(checkFor))
 		return context.pack_value(None)
 
 
@@ -267,14 +584,25 @@ class NamedFI:
 		self.ref_name = ref_name
 		self.ref = None
 
+	def _child_infos(self):
+		return []
+
+	def _fixed_size(self, context, seen):
+		if self.ref is None:
+			self.ref = context.get_fi_by_def_name(self.ref_name)
+		return self.ref.fixed_size(context, seen)
+
 	def _to_text(self, indent, refs, all_params):
 		return self.ref_name + params_to_text(indent, refs, all_params, ignore=["ref_name"])
 
 	def _parse(self, context):
+		context.used_definitions.add(self.ref_name)
 		if self.ref is None:
 			self.ref = context.get_fi_by_def_name(self.ref_name)
 		#print(context.id, self.ref_name)
 		context.id = self.ref_name
+		if context.memo is not None:
+			return context.pack_value(context.memoized_read(self.ref))
 		return context.pack_value(self.ref.read_from_buffer(context))
 
 
@@ -313,15 +641,20 @@ def _parse_unsigned_int_timestamp(c, n):
 def _parse_stringz(c, n):
 	for i in range(c.buf_offset, c.remaining_bytes() + c.buf_offset):
 		if c.buf[i] == 0:
-			return c.buf[c.buf_offset:i].decode(c.get_param('charset')), i - c.buf_offset + 1
+			return str(c.buf[c.buf_offset:i], c.get_param('charset')), i - c.buf_offset + 1
 	return b"", 0
 def _parse_bytes_formatted(format):
-	return lambda c,n: format % tuple(c.peek_bytes(n))
+	fn = lambda c,n: format % tuple(c.peek_bytes(n))
+	fn.format = format
+	return fn
+def _parse_string(c, n):
+	# str() instead of bytes.decode() so that memoryviews of zero-copy contexts work as well
+	return str(c.peek_bytes(n), c.get_param('charset'))
 def _parse_uuid(c, n):
 	if c.get_param("endianness") == "<":
-		return uuid.UUID(bytes_le=c.peek_bytes(n))
+		return uuid.UUID(bytes_le=bytes(c.peek_bytes(n)))
 	else:
-		return uuid.UUID(bytes=c.peek_bytes(n))
+		return uuid.UUID(bytes=bytes(c.peek_bytes(n)))
 
 builtinTypes = {
 	"NONE": 	(0, lambda c,b: None, ),   			#	/* used for text labels with no value */
@@ -352,9 +685,9 @@ builtinTypes = {
 	"DOUBLE": 	(8, lambda c,n: c.peek_structformat("d")[0], ),   			#
 	"ABSOLUTE_TIME": (EXPR_LEN, _parse_unsigned_int_timestamp, ),   		#
 	#"RELATIVE_TIME": (NOT_IMPL, None, ),   		#
-	"STRING": 	(EXPR_LEN, lambda c,n: c.peek_bytes(n).decode(c.get_param('charset')), ),   	#
+	"STRING": 	(EXPR_LEN, _parse_string, ),   	#
 	"STRINGZ": 	(DYN_LEN, _parse_stringz, ),   	#	/* for use with proto_tree_add_item() */
-	"UINT_STRING": (PREFIX_LEN, lambda c,n: c.peek_bytes(n).decode(c.get_param('charset')), ),   #	/* for use with proto_tree_add_item() */
+	"UINT_STRING": (PREFIX_LEN, _parse_string, ),   #	/* for use with proto_tree_add_item() */
 	"ETHER": 	(6, _parse_bytes_formatted("%02x:%02x:%02x:%02x:%02x:%02x"), ),   			#
 	"BYTES": 	(EXPR_LEN, lambda c,n: c.peek_bytes(n), ),   	#
 	"UINT_BYTES": (PREFIX_LEN, lambda c,n: c.peek_bytes(n), ),   	#
@@ -374,6 +707,18 @@ builtinTypes = {
 	#"FCWWN": (NOT_IMPL, None, ),   	#
 }
 
+# struct module format characters of the builtin types which can be decoded as part of a fixed layout
+structFormatChars = {
+	"BOOLEAN": "?", "CHAR": "B", "UINT8": "B", "UINT16": "H", "UINT32": "L", "UINT64": "Q",
+	"INT8": "b", "INT16": "h", "INT32": "l", "INT64": "q", "FLOAT": "f", "DOUBLE": "d",
+}
+
+# numpy type codes of the struct format characters above, used to decode repeats of fixed layout structs at once
+numpyTypeCodes = {
+	"?": "?", "B": "u1", "H": "u2", "L": "u4", "Q": "u8", "b": "i1", "h": "i2", "l": "i4", "q": "i8", "f": "f4", "d": "f8",
+}
+_numpy_byteorders = {"<": "<", ">": ">", "!": ">"}
+
 @FITypes.register(type_id=7)
 class FieldFI:
 	def init(self, format_type, base="DEC", bitmask=0, size=None, size_len=None, parse_with=None, value=None, **kw):
@@ -381,11 +726,18 @@ class FieldFI:
 		self.base = base
 		self.bitmask = bitmask
 		self.size, self._parse_fn = builtinTypes[format_type]
+		self.struct_format = structFormatChars.get(format_type)
 		self.size_expr = deserialize_expr(size) if size else None
 		self.size_len_expr = deserialize_expr(size_len) if size_len else None
 		self.parse_with = parse_with
 		self.value_expr = deserialize_expr(value) if value else None
 
+	def _child_infos(self):
+		return [self.parse_with] if self.parse_with is not None else []
+
+	def _fixed_size(self, context, seen):
+		return self.size if self.size >= 0 else None
+
 	def _to_text(self, indent, refs, all_params):
 		return self.format_type+""+params_to_text(indent, refs, all_params, ignore=['children', 'def_name', 'format_type'])
 
@@ -436,6 +788,13 @@ class UnionFI:
 		except:
 			self.size = None
 
+	def _child_infos(self):
+		return [c for (name, c, comment) in self.children]
+
+	def _fixed_size(self, context, seen):
+		sizes = [c.fixed_size(context, seen) for (name, c, comment) in self.children]
+		return None if None in sizes else max(sizes, default=0)
+
 	def _to_text(self, indent, refs, all_params):
 		x = "union"+params_to_text(indent, refs, all_params, )+" {"+"\n"
 		for (name, c, comment) in self.children:
@@ -461,6 +820,18 @@ class BitStructFI:
 	def init(self, children, **kw):
 		self.children = [(str(name), bitlength) for (name, bitlength) in children]
 		self.size = ceil(sum(bits for (name, bits) in self.children) / 8)
+		# (name, bit offset, bit length, shift, mask) per field, to extract it from the bytes decoded as integer
+		self.bit_fields = []
+		bitpos = 0
+		for name, bits in self.children:
+			self.bit_fields.append((name, bitpos, bits, self.size * 8 - bitpos - bits, (1 << bits) - 1))
+			bitpos += bits
+
+	def _child_infos(self):
+		return []
+
+	def _fixed_size(self, context, seen):
+		return self.size
 
 	def _to_text(self, indent, refs, all_params):
 		x = "bits"+params_to_text(indent, refs, all_params, )+" {"+"\n"
@@ -473,32 +844,10 @@ class BitStructFI:
 		o = {}
 		context.set_top_value(o)
 		context.require_bytes(self.size)
-		raw_data = context.peek_bytes(self.size)
-		le = False
-		if context.get_param("endianness", raise_if_missing=False) == "<":
-			raw_data = raw_data[::-1]
-			le = True
-		stream = BitStream(raw_data)
-		bitsize = self.size * 8
-		bitpos = 0
-		pos = context.buf_offset * 8
-		multifields = defaultdict(dict)
-		for key, len in self.children:
-			if not le: context.buf_offset = floor(pos / 8)
-			field = stream.read(len)
-			context.push(desc={'print': ("."*bitpos) + field.bin + ("."*(bitsize-bitpos-len)) + "  " + key + " = " + str(field.uint)}, id=key)
-			o[key] = context.pack_value(field.uint)
-			context.pop()
-			if "__" in key:
-				multikey, pos = key.split("__")
-				if pos == "hi": pos = "0"
-				if pos == "lo": pos = "1"
-				multifields[multikey][pos] = (len, field.uint)
-			pos += len
-			bitpos += len
-		#for k, v in multifields.items():
-
-		context.buf_offset = ceil(pos / 8)
+		little_endian = context.get_param("endianness", raise_if_missing=False) == "<"
+		raw = int.from_bytes(context.peek_bytes(self.size), 'little' if little_endian else 'big')
+		context.pack_bit_fields(self, raw, little_endian)
+		context.buf_offset += self.size
 		return context.pack_value(o)
 
 
@@ -0,0 +1,359 @@
+# PRE Workbench
+# Copyright (C) 2022 Mira Weller
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Applies a grammar definition on many buffers in worker processes, see BufferListDataSource, and serializes parse
+results for the parse result cache of the project, see dump_parse_result.
+
+The workers get the pickled definitions once, then batches of payloads. They return the Range trees created by
+AnnotatingParseContext serialized with xdrm, in which FormatInfo nodes are replaced by their index in
+index_format_infos(). The index is the same in all processes because the definitions are copies of each other.
+
+Results are encoded with xdrm-native types only, nothing is unpickled when loading them. Results containing other
+values raise UnsupportedValue, the buffer is parsed in the GUI process instead resp. the result isn't cached.
+"""
+
+import pickle
+import struct
+from datetime import datetime
+from typing import Optional
+from uuid import UUID
+
+from pre_workbench.algo.range import Range
+from pre_workbench.structinfo import xdrm, exceptions
+from pre_workbench.structinfo.expr import Expression
+from pre_workbench.structinfo.format_info import FormatInfo
+from pre_workbench.structinfo.parsecontext import FormatInfoContainer, AnnotatingParseContext, LazyRepeatList, \
+	pending_range_metadata
+
+# params which need the GUI process, definitions using them are parsed there
+_unsupported_params = ('reassemble_into', 'store_into')
+
+# kinds of Range values
+VALUE_LEAF = 0
+VALUE_RANGE = 1
+VALUE_DICT = 2
+VALUE_LIST = 3
+VALUE_BYTES = 4  # bytes value equal to the parsed bytes, sliced from the payload when decoding
+VALUE_INT = 5  # int exceeding 64 bits, as signed big endian bytes
+VALUE_DATETIME = 6  # datetime, as ISO 8601 string
+
+# optional parts of encoded ranges
+HAS_FIELD_NAME = 1
+HAS_META = 2
+HAS_EXCEPTION = 4
+HAS_DESC = 8
+
+# start, end, index of the FormatInfo or -1, value kind, flags
+_record_header = struct.Struct(">iiiBB")
+
+_native_types = (str, float, bool, type(None), bytes, UUID)
+
+
+class UnsupportedValue(Exception):
+	"""Raised for values which can't be encoded with xdrm-native types"""
+
+
+def index_format_infos(fic: FormatInfoContainer, names=None):
+	"""Returns all FormatInfo nodes of the definitions, or of the definitions in the list names, in depth-first order"""
+	result = []
+	def visit(node):
+		result.append(node)
+		for child in node.child_infos():
+			visit(child)
+	for name in fic.definitions if names is None else names:
+		if name in fic.definitions:
+			visit(fic.definitions[name])
+	return result
+
+
+def parallel_parsing_supported(fic: FormatInfoContainer, names=None):
+	return not any(k in node.params for node in index_format_infos(fic, names) for k in _unsupported_params)
+
+
+def pickle_definitions(fic: FormatInfoContainer):
+	return pickle.dumps((fic.definitions, fic.main_name), pickle.HIGHEST_PROTOCOL)
+
+
+def encode_value(value):
+	t = type(value)
+	if t in _native_types:
+		return value
+	elif t is int and -2**63 <= value < 2**63:
+		return value
+	elif isinstance(value, str):
+		# e.g. lark tokens in params
+		return str(value)
+	elif t is list:
+		return [encode_value(x) for x in value]
+	elif t is dict and all(isinstance(k, str) for k in value):
+		return {str(k): encode_value(x) for k, x in value.items()}
+	else:
+		raise UnsupportedValue(t.__name__)
+
+
+def encode_exception(ex: Exception):
+	"""Returns ex, a parse_exception, as [class name, args, state], with the message rendered like for pickle"""
+	if not isinstance(ex, exceptions.parse_exception):
+		raise UnsupportedValue(type(ex).__name__)
+	_, (cls, args, state) = ex.__reduce__()
+	return [cls.__name__, encode_value(list(args)), encode_value(state)]
+
+
+def decode_exception(data):
+	name, args, state = data
+	cls = getattr(exceptions, name, None)
+	if not (isinstance(cls, type) and issubclass(cls, exceptions.parse_exception)):
+		raise ValueError("unknown exception class " + name)
+	return exceptions._restore_parse_exception(cls, args, state)
+
+
+def encode_range(r: Range, desc_index: dict, buf, cache: dict, parent_name=None, key=None):
+	"""
+	Returns the Range tree r as nested lists for xdrm. Metadata which decode_range recreates is left out, as is
+	the field name if it matches the key in the parent dict. buf is the parsed payload, cache is passed to
+	_derived_metadata. The metadata loaders of the ranges aren't called, see pending_range_metadata.
+	"""
+	metadata = pending_range_metadata(r)
+	if metadata is None: metadata = r.metadata
+	name = metadata.get('name')
+	value = r.value
+	t = type(value)
+	if t is Range:
+		kind, payload = VALUE_RANGE, encode_range(value, desc_index, buf, cache, name)
+	elif t is dict and value and all(type(x) is Range for x in value.values()):
+		kind, payload = VALUE_DICT, {k: encode_range(x, desc_index, buf, cache, name, k) for k, x in value.items()}
+	elif t is list and value and all(type(x) is Range for x in value):
+		kind, payload = VALUE_LIST, [encode_range(x, desc_index, buf, cache, name) for x in value]
+	elif t is bytes and len(value) == r.end - r.start and buf[r.start:r.end] == value:
+		kind, payload = VALUE_BYTES, None
+	elif t is int and not -2**63 <= value < 2**63:
+		kind, payload = VALUE_INT, value.to_bytes(value.bit_length() // 8 + 1, "big", signed=True)
+	elif t is datetime:
+		kind, payload = VALUE_DATETIME, value.isoformat()
+	else:
+		kind, payload = VALUE_LEAF, encode_value(value)
+	source_desc = r.source_desc
+	derived, derived_show = _derived_metadata(r.start, r.end, source_desc, parent_name, r.field_name, cache)
+	meta = {str(k): encode_value(v) for k, v in metadata.items()
+			if not (k == 'show' and derived_show) and not (k in derived and type(derived[k]) is type(v) and derived[k] == v)}
+
+	# the numbers are packed into one bytes object, the other parts are only present if flagged
+	record = [None]
+	flags = 0
+	if r.field_name != key:
+		record.append(r.field_name); flags |= HAS_FIELD_NAME
+	if meta:
+		record.append(meta); flags |= HAS_META
+	if r.exception is not None:
+		record.append(encode_exception(r.exception)); flags |= HAS_EXCEPTION
+	desc = desc_index.get(id(source_desc), -1) if isinstance(source_desc, FormatInfo) else -1
+	if desc == -1 and source_desc is not None:
+		record.append(encode_value(source_desc)); flags |= HAS_DESC
+	if kind != VALUE_BYTES:
+		record.append(payload)
+	record[0] = _record_header.pack(r.start, r.end, desc, kind, flags)
+	return record
+
+
+def _derived_metadata(start, end, source_desc, parent_name, field_name, cache):
+	"""
+	Returns the metadata set by AnnotatingParseContext which doesn't depend on the parsed data, and whether 'show'
+	is str(value). The constant params of each FormatInfo are stored in the dict cache.
+	"""
+	meta = {'name': None if parent_name is None else parent_name + "." + field_name, 'pos': start, 'size': end - start,
+			'_sdef_ref': source_desc}
+	if isinstance(source_desc, FormatInfo):
+		try:
+			params, derived_show = cache[id(source_desc)]
+		except KeyError:
+			params = {k: v for k, v in source_desc.params.items() if k not in ('children', 'def_name') and not isinstance(v, Expression)}
+			derived_show = 'show' not in source_desc.params
+			cache[id(source_desc)] = params, derived_show
+		meta.update(params)
+		return meta, derived_show
+	elif isinstance(source_desc, dict):
+		meta.update(source_desc)
+		return meta, 'show' not in source_desc
+	else:
+		return meta, True
+
+
+def decode_range(record, descs: list, ranges: list, buf, cache: dict, parent_name=None, key=None):
+	"""
+	Recreates a Range tree from encode_range, appends all ranges to the list ranges in the order they were created.
+	buf is the parsed payload, cache is passed to _derived_metadata.
+	"""
+	start, end, desc, kind, flags = _record_header.unpack(record[0])
+	i = 1
+	field_name, meta, exception, source_desc = key, None, None, None
+	if flags & HAS_FIELD_NAME:
+		field_name = record[i]; i += 1
+	if flags & HAS_META:
+		meta = record[i]; i += 1
+	if flags & HAS_EXCEPTION:
+		exception = decode_exception(record[i]); i += 1
+	if flags & HAS_DESC:
+		source_desc = record[i]; i += 1
+	elif desc != -1:
+		source_desc = descs[desc]
+
+	metadata, derived_show = _derived_metadata(start, end, source_desc, parent_name, field_name, cache)
+	if meta: metadata.update(meta)
+	name = metadata['name']
+	if kind == VALUE_RANGE:
+		value = decode_range(record[i], descs, ranges, buf, cache, name)
+	elif kind == VALUE_DICT:
+		value = {k: decode_range(x, descs, ranges, buf, cache, name, k) for k, x in record[i].items()}
+	elif kind == VALUE_LIST:
+		value = [decode_range(x, descs, ranges, buf, cache, name) for x in record[i]]
+	elif kind == VALUE_BYTES:
+		value = bytes(buf[start:end])
+	elif kind == VALUE_INT:
+		value = int.from_bytes(record[i], "big", signed=True)
+	elif kind == VALUE_DATETIME:
+		value = datetime.fromisoformat(record[i])
+	else:
+		value = record[i]
+	if derived_show: metadata['show'] = str(value)
+	r = Range(start, end, value, source_desc=source_desc, field_name=field_name, meta=metadata)
+	r.exception = exception
+	ranges.append(r)
+	return r
+
+
+_worker_fic = None
+_worker_desc_index = None
+_worker_cache = None
+
+def init_parse_worker(definitions_data: bytes):
+	"""Initializer of the worker processes, definitions_data is the result of pickle_definitions"""
+	global _worker_fic, _worker_desc_index, _worker_cache
+	definitions, main_name = pickle.loads(definitions_data)
+	_worker_fic = FormatInfoContainer(definitions=definitions)
+	_worker_fic.main_name = main_name
+	_worker_desc_index = {id(node): i for i, node in enumerate(index_format_infos(_worker_fic))}
+	_worker_cache = {}
+
+
+def parse_batch(def_name: str, payloads: list) -> bytes:
+	"""
+	Parses each payload with def_name, returns the xdrm serialized list of [serialized range tree, exception], or
+	None for payloads whose result contains values which can't be encoded. The range trees are serialized on their
+	own, so they are only decoded when needed, see load_batch.
+	"""
+	results = []
+	for payload in payloads:
+		ctx = AnnotatingParseContext(_worker_fic, payload)
+		ctx.log_failures = False
+		try:
+			fi_tree = ctx.parse(def_name)
+		except Exception as ex:
+			fi_tree, ctx.failed = None, ex
+		try:
+			results.append([None if fi_tree is None else xdrm.dumps(encode_range(fi_tree, _worker_desc_index, payload, _worker_cache)),
+							None if ctx.failed is None else encode_exception(ctx.failed)])
+		except UnsupportedValue:
+			results.append(None)
+	return xdrm.dumps(results)
+
+
+class PendingParseResult:
+	"""Range tree returned by a worker, decoded by calling it, see ByteBuffer.setPendingResult"""
+	__slots__ = ('data', 'descs', 'payload', 'cache')
+
+	def __init__(self, data: Optional[bytes], descs: list, payload, cache: dict):
+		self.data = data
+		self.descs = descs
+		self.payload = payload
+		self.cache = cache
+
+	def __call__(self):
+		"""Returns (fi_tree, ranges)"""
+		ranges = []
+		fi_tree = None if self.data is None else decode_range(_loads_native(self.data), self.descs, ranges, self.payload, self.cache)
+		return fi_tree, ranges
+
+
+def load_batch(data: bytes, descs: list, payloads: list):
+	"""
+	Returns a list of (PendingParseResult, exception), or None for payloads to be parsed again, for the result of
+	parse_batch. Only the exceptions are decoded here.
+	"""
+	results = []
+	cache = {}
+	for result, payload in zip(_loads_native(data), payloads):
+		if result is None:
+			results.append(None)
+		else:
+			tree_data, failed = result
+			results.append((PendingParseResult(tree_data, descs, payload, cache), None if failed is None else decode_exception(failed)))
+	return results
+
+
+def decode_batch(data: bytes, descs: list, payloads: list):
+	"""Returns a list of (fi_tree, ranges, exception), or None for payloads to be parsed again, for the result of parse_batch"""
+	return [None if result is None else (*result[0](), result[1]) for result in load_batch(data, descs, payloads)]
+
+
+def _loads_native(data: bytes):
+	# results from the project database might come from someone else, objects of registered classes are rejected
+	return xdrm.loads(data, native_only=True)
+
+
+def _result_descs(fic: FormatInfoContainer, def_name: str):
+	key = ('result_descs', def_name)
+	if key not in fic.caches:
+		names = fic.reachable_definitions(def_name)
+		descs = index_format_infos(fic, names)
+		fic.caches[key] = descs, {id(node): i for i, node in enumerate(descs)}, parallel_parsing_supported(fic, names)
+	return fic.caches[key]
+
+
+def dump_parse_result(fic: FormatInfoContainer, def_name: str, buf, fi_tree, failed) -> Optional[bytes]:
+	"""
+	Serializes the result of parsing buf with def_name by AnnotatingParseContext. FormatInfo nodes are stored by
+	their index in the definitions reachable from def_name, so the result can be loaded as long as
+	fic.definition_hash(def_name) is unchanged. Returns None for results which can't be stored, i.e. if the
+	definitions use reassemble_into or store_into, fi_tree contains lazily decoded repeats, or values which can't
+	be encoded.
+	"""
+	descs, desc_index, supported = _result_descs(fic, def_name)
+	if not supported or (fi_tree is not None and _contains_lazy_repeat(fi_tree)):
+		return None
+	cache = fic.caches.setdefault('result_metadata', {})
+	try:
+		return xdrm.dumps([None if fi_tree is None else encode_range(fi_tree, desc_index, buf, cache),
+						   None if failed is None else encode_exception(failed)])
+	except UnsupportedValue:
+		return None
+
+
+def load_parse_result(fic: FormatInfoContainer, def_name: str, buf, data: bytes):
+	"""Returns (fi_tree, ranges, exception) from the result of dump_parse_result"""
+	descs, _, _ = _result_descs(fic, def_name)
+	record, failed = _loads_native(data)
+	ranges = []
+	fi_tree = None if record is None else decode_range(record, descs, ranges, buf, fic.caches.setdefault('result_metadata', {}))
+	return fi_tree, ranges, None if failed is None else decode_exception(failed)
+
+
+def _contains_lazy_repeat(r: Range):
+	value = r.value
+	if type(value) is LazyRepeatList: return True
+	if type(value) is Range: return _contains_lazy_repeat(value)
+	children = value.values() if type(value) is dict else value if type(value) is list else ()
+	return any(type(x) is Range and _contains_lazy_repeat(x) for x in children)
@@ -14,8 +14,15 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import copy
+import functools
+import hashlib
 import logging
+import os.path
+import pickle
 import struct
+from collections import OrderedDict
+from collections.abc import Sequence
 from typing import Optional, Any, Dict
 
 from pre_workbench.algo.range import Range
@@ -26,12 +33,31 @@ from pre_workbench.structinfo.expr import Expression
 from pre_workbench.structinfo.hexdump import hexdump
 
 
+@functools.lru_cache(maxsize=None)
+def _grammar_version():
+	h = hashlib.sha256(b"1")
+	for name in ["format_info.lark", "format_info_lalr.lark"]:
+		with open(os.path.join(os.path.dirname(__file__), name), "rb") as f:
+			h.update(f.read())
+	return h.digest()
+
+
 class FormatInfoContainer:
-	def __init__(self, definitions: Optional[Dict[str, Any]] = None, load_from_file: Optional[str] = None, load_from_string: Optional[str] = None):
+	logger = logging.getLogger("FormatInfoContainer")
+
+	def __init__(self, definitions: Optional[Dict[str, Any]] = None, load_from_file: Optional[str] = None, load_from_string: Optional[str] = None,
+				 parse_cache_file: Optional[str] = None):
+		"""
+		If parse_cache_file is given, the definitions parsed by load_from_string are stored in this file, and loaded
+		from it instead of parsing if the text is unchanged. The file is unpickled, so it must be in a location only the
+		user can write, never in a project folder which might come from someone else.
+		"""
 		self.definitions = {} if definitions is None else definitions
 		self.definition_comments = {}
 		self.main_name = None
 		self.file_name = None
+		self.parse_cache_file = parse_cache_file
+		self.invalidate_caches()
 		if load_from_file is not None: self.load_from_file(load_from_file)
 		if load_from_string is not None: self.load_from_string(load_from_string)
 
@@ -50,12 +76,83 @@ class FormatInfoContainer:
 		self.file_name = fileName
 
 	def load_from_string(self, txt):
+		"""
+		Replaces the definitions with the ones in txt. Definitions which are unchanged keep their FormatInfo objects,
+		so parse results referencing them stay valid, see definitions_changed.
+		"""
 		from pre_workbench.structinfo.parser import parse_definition_map_into_container
+		old_definitions = {name: (fi, self.definition_own_hash(name)) for name, fi in self.definitions.items()}
+		self.definitions = {}
+		self.definition_comments = {}
+		if self.parse_cache_file is None:
+			parse_definition_map_into_container(txt, self)
+		else:
+			key = hashlib.sha256(_grammar_version() + txt.encode("utf-8")).hexdigest()
+			if not self._load_parse_cache(key):
+				parse_definition_map_into_container(txt, self)
+				self._store_parse_cache(key)
+		self.invalidate_caches()
+		if old_definitions:
+			for name, (fi, own_hash) in old_definitions.items():
+				if name in self.definitions and self.definition_own_hash(name) == own_hash:
+					self.definitions[name] = fi
+			self.invalidate_caches()
+
+	def _load_parse_cache(self, key):
+		try:
+			with open(self.parse_cache_file, "rb") as f:
+				cache_key, self.definitions, self.definition_comments, self.main_name = pickle.load(f)
+			if cache_key == key:
+				return True
+		except FileNotFoundError:
+			pass
+		except Exception as ex:
+			self.logger.warning("Failed to load grammar parse cache %s: %r", self.parse_cache_file, ex)
 		self.definitions = {}
 		self.definition_comments = {}
-		parse_definition_map_into_container(txt, self)
+		return False
+
+	def _store_parse_cache(self, key):
+		try:
+			tmp_file = self.parse_cache_file + ".tmp"
+			with open(tmp_file, "wb") as f:
+				pickle.dump((key, self.definitions, self.definition_comments, str(self.main_name)), f, pickle.HIGHEST_PROTOCOL)
+			os.replace(tmp_file, self.parse_cache_file)
+		except Exception as ex:
+			self.logger.warning("Failed to store grammar parse cache %s: %r", self.parse_cache_file, ex)
+
+	def copy(self) -> 'FormatInfoContainer':
+		"""Returns a deep copy of the definitions, e.g. to parse on another thread while they might be edited"""
+		definitions, definition_comments, main_name = pickle.loads(pickle.dumps(
+			(self.definitions, self.definition_comments, self.main_name), pickle.HIGHEST_PROTOCOL))
+		fic = FormatInfoContainer(definitions=definitions)
+		fic.definition_comments = definition_comments
+		fic.main_name = main_name
+		return fic
+
+	def invalidate_caches(self):
+		"""Drops data derived from the definitions, e.g. compiled parsers. Call after changing definitions."""
+		self.caches = {}
+		self.link_definitions()
+
+	def link_definitions(self):
+		"""
+		Stores the definition root, parent and depth in each FormatInfo node. ParseContext.get_param uses them to
+		look up inherited params in one step per definition instead of walking every stack frame.
+		"""
+		def link(node, root, parent, depth):
+			node.def_root, node.def_parent, node.def_depth = root, parent, depth
+			node._inherited_generation = -1
+			if getattr(node.fi, 'ref_name', None) is not None:
+				# resolved again on the next parse, the referenced definition might have been replaced
+				node.fi.ref = None
+			for child in node.child_infos():
+				link(child, root, node, depth + 1)
+		for fi in self.definitions.values():
+			link(fi, fi, None, 0)
 
 	def write_file(self, fileName):
+		self.invalidate_caches()
 		if fileName.endswith(".txt"):
 			txt = self.to_text()
 			with open(fileName, "w") as f:
@@ -71,8 +168,77 @@ class FormatInfoContainer:
 	def get_fi_by_def_name(self, def_name):
 			return self.definitions[str(def_name)]
 
+	def referenced_definitions(self, node, result=None):
+		"""
+		Returns the names of all definitions referenced by the FormatInfo node directly or indirectly, including
+		names of missing definitions.
+		"""
+		if result is None: result = []
+		ref_name = getattr(node.fi, 'ref_name', None)
+		if ref_name is not None:
+			ref_name = str(ref_name)
+			if ref_name not in result:
+				result.append(ref_name)
+				if ref_name in self.definitions:
+					self.referenced_definitions(self.definitions[ref_name], result)
+		for child in node.child_infos():
+			self.referenced_definitions(child, result)
+		return result
+
+	def reachable_definitions(self, def_name):
+		"""Returns the names of def_name and all definitions it references directly or indirectly, in depth-first order"""
+		cache = self.caches.setdefault('reachable_definitions', {})
+		if def_name not in cache:
+			def_name = str(def_name)
+			cache[def_name] = [] if def_name not in self.definitions else \
+				self.referenced_definitions(self.definitions[def_name], [def_name])
+		return cache[def_name]
+
+	def definition_own_hash(self, def_name) -> Optional[bytes]:
+		"""Returns a hash of the normalized text of def_name, without the definitions it references, or None if it doesn't exist"""
+		cache = self.caches.setdefault('definition_own_hash', {})
+		if def_name not in cache:
+			fi = self.definitions.get(str(def_name))
+			if fi is None:
+				cache[def_name] = None
+			else:
+				h = hashlib.sha256((str(def_name) + " " + fi.to_text(0, None) + "\n").encode("utf-8"))
+				def visit(node):
+					# to_text is not unique for every tree, e.g. a variant with a single child is written as the child
+					h.update(type(node.fi).__name__.encode("ascii") + b"(")
+					for child in node.child_infos():
+						visit(child)
+					h.update(b")")
+				visit(fi)
+				cache[def_name] = h.digest()
+		return cache[def_name]
+
+	def definition_hash(self, def_name) -> bytes:
+		"""
+		Returns a hash of the normalized text of def_name and the definitions reachable from it, which changes
+		whenever parsing with def_name might give a different result.
+		"""
+		cache = self.caches.setdefault('definition_hash', {})
+		if def_name not in cache:
+			h = hashlib.sha256(_grammar_version())
+			for name in self.reachable_definitions(def_name):
+				h.update(self.definition_own_hash(name) or b"missing " + name.encode("utf-8"))
+			cache[def_name] = h.digest()
+		return cache[def_name]
+
+	def definitions_changed(self, snapshot) -> bool:
+		"""
+		Returns whether any definition in snapshot, a dict of definition name to (FormatInfo, definition_own_hash)
+		as created by snapshot_definitions, was changed or replaced since.
+		"""
+		return any(self.definitions.get(name) is not fi or self.definition_own_hash(name) != own_hash
+				   for name, (fi, own_hash) in snapshot.items())
+
+	def snapshot_definitions(self, names):
+		return {name: (self.definitions.get(name), self.definition_own_hash(name)) for name in names}
+
 class stack_frame:
-	__slots__ = ('desc', 'value', 'id', 'buf_offset', 'buf_limit_end')
+	__slots__ = ('desc', 'value', 'id', 'buf_offset', 'buf_limit_end', 'param_cache', 'profile')
 
 	def __init__(self, desc, value, id, buf_offset, buf_limit_end):
 		self.desc = desc
@@ -80,13 +246,42 @@ class stack_frame:
 		self.id = id
 		self.buf_offset = buf_offset
 		self.buf_limit_end = buf_limit_end
+		self.param_cache = None
+		self.profile = None
+
+
+_missing = object()
 
 
 class ParseContext:
 	logger = logging.getLogger("DataSource")
+	supports_memo = True
+
+	def __init__(self, format_infos: FormatInfoContainer, buf: bytes = None, logging_enabled=False, zero_copy=False):
+		"""
+		If zero_copy is set, the buffer is held as a memoryview and byte fields return views into it instead of
+		copies, use materialize() to convert them. buf may be any object supporting the buffer protocol, e.g. mmap.
+
+		If lazy_repeat_threshold is set, repeats of at least this many fixed-size elements return a LazyRepeatList,
+		which decodes the elements on access and keeps up to lazy_cache_size of them.
+
+		If vectorize_repeats is set and numpy is installed, repeats of fixed layout structs return a RecordArray.
+		Not supported by annotating contexts, which create a Range for every field.
+
+		The names of all definitions the parse used are collected in used_definitions.
+
+		If preallocated_incomplete is set to an incomplete exception, it is updated and raised whenever bytes are
+		missing, instead of allocating a new one. Only for callers which don't keep the failures, like StreamParser.
+
+		If memo_limit is set, up to this many results of referenced definitions are kept during one parse, and
+		reused when the same definition is read at the same offset again with the same params and fields from the
+		outside, e.g. by several alternatives of a variant, see memoized_read. Not supported by annotating
+		contexts, whose results depend on the path they were parsed at.
 
-	def __init__(self, format_infos: FormatInfoContainer, buf: bytes = None, logging_enabled=False):
+		If profile is set to a ParseProfile, statistics per grammar node are collected in it, see structinfo.profiler.
+		"""
 		self.format_infos = format_infos
+		self.zero_copy = zero_copy
 		self.stack = list()
 		self.id = ""
 		self.buf_offset = 0
@@ -96,6 +291,18 @@ class ParseContext:
 		self.on_new_subflow_category = None
 		self.subflow_categories = dict()
 		self.failed = None
+		self.log_failures = True
+		self.lazy_repeat_threshold = None
+		self.lazy_cache_size = 1024
+		self.vectorize_repeats = False
+		self.used_definitions = set()
+		self.preallocated_incomplete = None
+		self.profile = None
+		self.memo_limit = 0
+		self.memo = None
+		self.memo_count = 0
+		self.memo_hits = 0
+		self._memo_recorders = []
 		self.logging_enabled = logging_enabled
 		if buf is not None:
 			self.feed_bytes(buf)
@@ -104,7 +311,7 @@ class ParseContext:
 		if not isinstance(ex, parse_exception):
 			raise TypeError("Argument to set_failed must be of type parse_exception")
 		self.failed = ex
-		self.log("Marking context as failed", str(ex))
+		self.log("Marking context as failed", ex)
 
 	def clear_failed(self):
 		self.failed = None
@@ -113,7 +320,7 @@ class ParseContext:
 	def hexdump_context(self, ptr: int, context: int = 16):
 		start = ptr - (ptr%16) - context
 		end = start + 2*context
-		return hexdump(self.buf[start - self.display_offset_delta : end - self.display_offset_delta], result='return', addr_offset=start, addr_ptr=ptr-start)
+		return hexdump(bytes(self.buf[start - self.display_offset_delta : end - self.display_offset_delta]), result='return', addr_offset=start, addr_ptr=ptr-start)
 
 	def get_fi_by_def_name(self, def_name: str):
 		try:
@@ -123,37 +330,155 @@ class ParseContext:
 
 	def feed_bytes(self, data):
 		remove_bytes = self.buf_offset if len(self.stack) == 0 else 0
-		self.buf = self.buf[remove_bytes:] + data
+		if not self.zero_copy:
+			self.buf = self.buf[remove_bytes:] + data
+		elif remove_bytes == len(self.buf):
+			self.buf = memoryview(data)
+		else:
+			self.buf = memoryview(bytes(self.buf[remove_bytes:]) + data)
 		self.display_offset_delta += remove_bytes
 		self.buf_offset -= remove_bytes
+		if remove_bytes and self.memo:
+			self.memo = {}
+			self.memo_count = 0
 		if self.buf_limit_end != None:
 			self.buf_limit_end -= remove_bytes
 
+	def derive(self):
+		"""
+		Returns a copy of this context sharing the buffer, with a snapshot of the current stack, to continue parsing
+		from here later on. Subflows are not reassembled by the copy.
+		"""
+		ctx = copy.copy(self)
+		ctx.stack = list(self.stack)
+		ctx.failed = None
+		ctx.on_new_subflow_category = None
+		ctx.memo = None
+		ctx._memo_recorders = []
+		return ctx
+
 	def parse(self, by_name: Optional[str] = None):
 		if by_name is None: by_name = self.format_infos.main_name
 		self.id = by_name
+		self.used_definitions.add(str(by_name))
+		if self.memo_limit and self.supports_memo and self.on_new_subflow_category is None:
+			# the results depend on the buffer and may have side effects when subflows are reassembled
+			self.memo = {}
+			self.memo_count = 0
+		else:
+			self.memo = None
 		result = self.get_fi_by_def_name(by_name).read_from_buffer(self)
-		if self.failed:
+		if self.failed and self.log_failures:
 			ParseContext.logger.exception("Failed to parse", exc_info=self.failed)
 			#self.failed.partial_result = result
 			#raise self.failed
 		return result
 
 	def get_param(self, id: str, default = None, raise_if_missing: bool = True):
-		for i in range(len(self.stack)-1, -1, -1):
-			if hasattr(self.stack[i].desc, 'params'):
-				if id in self.stack[i].desc.params:
-					return self.stack[i].desc.params[id]
+		value = self._lookup_param(id, len(self.stack) - 1)
+		if self._memo_recorders: self.memo_record('param', id)
+		if value is not _missing:
+			return value
 		if raise_if_missing:
 			raise value_not_found(self, "Missing parameter "+id)
 		else:
 			return default
 
+	def _lookup_param(self, id: str, i: int):
+		stack = self.stack
+		while i >= 0:
+			desc = stack[i].desc
+			root = getattr(desc, 'def_root', None)
+			if root is not None:
+				# if the frames below belong to the same definition, all their params are merged into the
+				# inherited params of desc. Params from further below are cached in the definition's root frame
+				root_index = i - desc.def_depth
+				if root_index >= 0 and stack[root_index].desc is root:
+					params = desc.get_inherited_params()
+					if id in params:
+						return params[id]
+					root_frame = stack[root_index]
+					if root_frame.param_cache is None:
+						root_frame.param_cache = {}
+					try:
+						return root_frame.param_cache[id]
+					except KeyError:
+						value = root_frame.param_cache[id] = self._lookup_param(id, root_index - 1)
+						return value
+			if hasattr(desc, 'params'):
+				if id in desc.params:
+					return desc.params[id]
+			i -= 1
+		return _missing
+
+	def memoized_read(self, desc):
+		"""
+		Reads desc like desc.read_from_buffer, and stores the result in the memo table. If desc was read at the same
+		offset before, and all params and fields from outside of desc which that read looked up are unchanged, its
+		result is reused instead.
+		"""
+		if self.failed is not None:
+			return desc.read_from_buffer(self)
+		key = (id(desc), self.buf_offset, self.buf_limit_end)
+		entries = self.memo.get(key)
+		if entries is not None:
+			for deps, value, end_offset, failed in entries:
+				if all(self._memo_lookup(kind, name)[1] == dep_value for (kind, name), dep_value in deps.items()):
+					self.memo_hits += 1
+					# lookups of the reused read are lookups of the enclosing reads as well
+					for kind, name in deps:
+						self.memo_record(kind, name)
+					self.buf_offset = end_offset
+					if failed is not None: self.set_failed(failed)
+					return value
+
+		recorder = [len(self.stack), {}, True]
+		self._memo_recorders.append(recorder)
+		try:
+			value = desc.read_from_buffer(self)
+		finally:
+			self._memo_recorders.pop()
+		_, deps, pure = recorder
+		if pure and self.memo_count < self.memo_limit:
+			self.memo.setdefault(key, []).append((deps, value, self.buf_offset, self.failed))
+			self.memo_count += 1
+		return value
+
+	def _memo_lookup(self, kind: str, name: str):
+		"""Returns the stack index and value of the param or field name, or -1 and _missing if it isn't found"""
+		stack = self.stack
+		for i in range(len(stack) - 1, -1, -1):
+			if kind == 'param':
+				params = getattr(stack[i].desc, 'params', None)
+				if params is not None and name in params:
+					return i, params[name]
+			else:
+				value = stack[i].value
+				if value is not None and name in value:
+					return i, self.unpack_value(value[name])
+		return -1, _missing
+
+	def memo_record(self, kind: str, name: str):
+		"""Called when a param or field is looked up while memoized reads are running, see memoized_read"""
+		if kind == 'field' and name == 'this':
+			return self.memo_escape(next((i for i in range(len(self.stack) - 1, -1, -1) if self.stack[i].value is not None), -1))
+		index, value = self._memo_lookup(kind, name)
+		for floor, deps, pure in self._memo_recorders:
+			if index < floor:
+				deps[(kind, name)] = value
+
+	def memo_escape(self, index: int):
+		"""Marks the running memoized reads which started above the stack frame index as not reusable"""
+		for recorder in self._memo_recorders:
+			if index < recorder[0]:
+				recorder[2] = False
+
 	def push(self, desc, value = None, id: Optional[str] = None):
 		if id != None: self.id = id
 		self.log("push", desc)
 		self.stack.append(stack_frame(desc, value, self.id, self.buf_offset, self.buf_limit_end))
 		self.id=""
+		if self.profile is not None: self.profile.enter(self, self.stack[-1])
 
 	def restore_offset(self):
 		self.buf_offset = self.stack[-1].buf_offset
@@ -162,6 +487,7 @@ class ParseContext:
 		self.log("pop")
 		frame = self.stack.pop()
 		self.id = frame.id; self.buf_limit_end = frame.buf_limit_end
+		if self.profile is not None: self.profile.leave(self, frame)
 		self.log("-->", frame.value, frame.desc)
 		return frame.value
 
@@ -186,7 +512,11 @@ class ParseContext:
 			return len(self.buf) - self.buf_offset
 
 	def require_bytes(self, needed: int):
-		if self.remaining_bytes() < needed: raise incomplete(self, needed, self.remaining_bytes())
+		remaining = self.remaining_bytes()
+		if remaining < needed:
+			if self.preallocated_incomplete is not None:
+				raise self.preallocated_incomplete.reuse(self, needed, remaining)
+			raise incomplete(self, needed, remaining)
 
 	def peek_structformat(self, format_string: str):
 		return struct.unpack_from(self.get_param('endianness') + format_string, self.buf, self.buf_offset)
@@ -213,7 +543,7 @@ class ParseContext:
 		return self.stack[stack_index].buf_offset + self.display_offset_delta
 
 	def top_length(self, stack_index: int = -1):
-		return self.buf_offset - self.stack[stack_index].buf_offset + self.display_offset_delta
+		return self.buf_offset - self.stack[stack_index].buf_offset
 
 	def top_value(self, stack_index: int = -1):
 		return self.stack[stack_index].value
@@ -242,7 +572,7 @@ class ParseContext:
 					if category not in self.subflow_categories:
 						self.subflow_categories[category] = ByteBufferList()
 						new = True
-					databytes = self.top_buf()
+					databytes = bytes(self.top_buf())
 					if 'segment_meta' in desc.params:
 						datameta = { k: v.evaluate(self) for k,v in desc.params['segment_meta'] }
 					else:
@@ -257,7 +587,7 @@ class ParseContext:
 					if category not in self.subflow_categories:
 						self.subflow_categories[category] = ByteBufferList()
 						new = True
-					self.subflow_categories[category].add(ByteBuffer(buf=self.top_buf(), metadata=meta))
+					self.subflow_categories[category].add(ByteBuffer(buf=bytes(self.top_buf()), metadata=meta))
 					if new: self.on_new_subflow_category(category=category, parse_context=self)
 
 			except Exception as ex:
@@ -265,6 +595,25 @@ class ParseContext:
 
 		return value
 
+	def pack_fixed_fields(self, struct_fi, values):
+		"""
+		Packs the values of a fixed layout struct which were decoded at once, see StructFI. Consumes the bytes of
+		all fields.
+		"""
+		self.buf_offset += struct_fi.fixed_size
+		o = dict(zip(struct_fi.fixed_names, values))
+		self.set_top_value(o)
+		return o
+
+	def pack_bit_fields(self, bits_fi, raw: int, little_endian: bool):
+		"""
+		Stores the fields of a bits struct in the top value, see BitStructFI. raw are its bytes decoded as integer.
+		Doesn't consume the bytes.
+		"""
+		o = self.stack[-1].value
+		for name, bitpos, bits, shift, mask in bits_fi.bit_fields:
+			o[name] = raw >> shift & mask
+
 	def pack_error(self, ex):
 		return None
 
@@ -285,20 +634,213 @@ class ParseContext:
 		return category, meta, tuple(subflow_key)
 
 
+class LazyRepeatList(Sequence):
+	"""
+	Elements of a repeat decoded on access, see ParseContext.lazy_repeat_threshold. Only the offset of the first
+	element is stored, the most recently used elements are cached. Parse errors of an element are logged when it is
+	accessed, the element is the result of pack_error then.
+	"""
+	def __init__(self, context: ParseContext, child, start: int, element_size: int, element_count: int):
+		self.context = context.derive()
+		self.child = child
+		self.start = start
+		self.element_size = element_size
+		self.element_count = element_count
+		self.buf_limit_end = context.buf_limit_end
+		self.cache = OrderedDict()
+		self.cache_size = context.lazy_cache_size
+
+	def __len__(self):
+		return self.element_count
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return [self[i] for i in range(*index.indices(self.element_count))]
+		if index < 0: index += self.element_count
+		if not 0 <= index < self.element_count:
+			raise IndexError("lazy repeat index out of range")
+		try:
+			value = self.cache[index]
+			self.cache.move_to_end(index)
+			return value
+		except KeyError:
+			pass
+		value = self.cache[index] = self._decode(index)
+		if len(self.cache) > self.cache_size:
+			self.cache.popitem(last=False)
+		return value
+
+	def __iter__(self):
+		for i in range(self.element_count):
+			yield self[i]
+
+	def __eq__(self, other):
+		if not isinstance(other, (list, LazyRepeatList)): return NotImplemented
+		return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+	def __repr__(self):
+		# must not decode the elements, AnnotatingParseContext stores str(value) in every range
+		return "[%d x %d bytes]" % (self.element_count, self.element_size)
+
+	def _decode(self, index):
+		ctx = self.context
+		ctx.buf_offset = self.start + index * self.element_size
+		ctx.buf_limit_end = self.buf_limit_end
+		ctx.id = "[%d/%d]" % (index, self.element_count)
+		value = self.child.read_from_buffer(ctx)
+		if ctx.failed is not None:
+			ctx.logger.warning("Failed to parse lazy repeat element %s.%s: %s", ctx.get_path(), ctx.id, ctx.failed)
+			ctx.failed = None
+		return value
+
+
+class RecordArray(Sequence):
+	"""
+	Elements of a repeat of fixed layout structs, decoded at once into a numpy structured array, see
+	ParseContext.vectorize_repeats. Indexing with a number returns the element as dict, like a list of parsed
+	structs, indexing with a field name returns the column as numpy array.
+	"""
+	def __init__(self, array):
+		self.array = array
+		self.names = array.dtype.names
+
+	def __len__(self):
+		return len(self.array)
+
+	def __getitem__(self, index):
+		if isinstance(index, str):
+			return self.array[index]
+		elif isinstance(index, slice):
+			return RecordArray(self.array[index])
+		return dict(zip(self.names, self.array[index].item()))
+
+	def __iter__(self):
+		return iter(self.to_list())
+
+	def __eq__(self, other):
+		if not isinstance(other, (list, RecordArray)): return NotImplemented
+		return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+	def __repr__(self):
+		return "[%d x (%s)]" % (len(self.array), ", ".join(self.names))
+
+	def to_list(self):
+		names = self.names
+		return [dict(zip(names, row)) for row in self.array.tolist()]
+
+
+def materialize(value):
+	"""
+	Replaces the memoryviews returned by zero-copy parse contexts with bytes objects and decodes LazyRepeatLists and
+	RecordArrays, recursing into dicts and lists
+	"""
+	if isinstance(value, memoryview):
+		return value.tobytes()
+	elif isinstance(value, RecordArray):
+		return value.to_list()
+	elif isinstance(value, dict):
+		return {k: materialize(v) for k, v in value.items()}
+	elif isinstance(value, (list, LazyRepeatList)):
+		return [materialize(v) for v in value]
+	else:
+		return value
+
+
+def _evaluate_expression_params(source_desc, ids, scope):
+	# rebuild the parse stack, params and fields are looked up in the frames below, the values of structs are the
+	# dicts of the result, including the fields parsed later
+	frames, buf_offset = scope
+	context = AnnotatingParseContext(None)
+	context.stack = [stack_frame(desc, value, id, offset, None) for id, (desc, value, offset) in zip(ids, frames)]
+	context.buf_offset = buf_offset
+	return {k: source_desc.params[k].evaluate(context) for k in source_desc.expression_params}
+
+
+def _load_range_metadata(range, metadata, state):
+	"""
+	Adds the metadata of a Range created by AnnotatingParseContext on first access. state contains the ids of the
+	frames on the parse stack when the value was packed and, if the definition has expression params, what's needed
+	to evaluate them, see AnnotatingParseContext.pack_value.
+	"""
+	from pre_workbench.structinfo.format_info import FormatInfo
+	ids, scope = state
+	source_desc = range.source_desc
+	metadata['name'] = ".".join(ids)
+	metadata['pos'] = range.start
+	metadata['size'] = range.end - range.start
+	metadata['show'] = str(range.value)
+	if isinstance(source_desc, FormatInfo):
+		evaluated_params = None if scope is None else _evaluate_expression_params(source_desc, ids, scope)
+		for k, v in source_desc.params.items():
+			if k != 'children' and k != 'def_name':
+				metadata[k] = evaluated_params[k] if evaluated_params is not None and k in evaluated_params else v
+	elif isinstance(source_desc, dict):
+		metadata.update(source_desc)
+
+
+def pending_range_metadata(range):
+	"""
+	Returns the metadata of a Range created by AnnotatingParseContext without calling its loader, if it wasn't
+	called yet: the name, the evaluated expression params and the entries already present. The other entries are
+	derived from the range and its definition. Returns None if the metadata is loaded already.
+	"""
+	state = range.metadata_state
+	if state is None: return None
+	ids, scope = state
+	metadata = dict(range.get_metadata(False))
+	metadata['name'] = ".".join(ids)
+	if scope is not None:
+		metadata.update(_evaluate_expression_params(range.source_desc, ids, scope))
+	return metadata
+
+
 class AnnotatingParseContext(ParseContext):
+	"""
+	Returns each parsed value wrapped in a Range with its position and metadata. The metadata (path, display
+	value, params of the definition) is computed when it is first accessed, see _load_range_metadata. Params which
+	are expressions are evaluated then too, from the definitions and values of the enclosing frames.
+	"""
+	supports_memo = False
+
 	def pack_value(self, value):
 		from pre_workbench.structinfo.format_info import FormatInfo
-		source_desc = self.stack[-1].desc
+		if isinstance(value, memoryview): value = value.tobytes()
+		top = self.stack[-1]
+		source_desc = top.desc
 		self.log("pack(A)",type(source_desc).__name__, self.top_offset(), self.top_length())#, value)
-		range = Range(self.top_offset(), self.top_offset() + self.top_length(), super().pack_value(value), source_desc=source_desc, field_name=str(self.top_id()))
-		range.metadata.update({ 'name': self.get_path(), 'pos': self.top_offset(), 'size': self.top_length(), '_sdef_ref': source_desc, 'show': str(value) })
-
-		if isinstance(source_desc, FormatInfo):
-			range.metadata.update(source_desc.extra_params(context=self))
-		elif isinstance(source_desc, dict):
-			range.metadata.update(source_desc)
+		start = top.buf_offset + self.display_offset_delta
+		range = Range(start, start + self.buf_offset - top.buf_offset, super().pack_value(value), source_desc=source_desc, field_name=str(self.top_id()), meta={'_sdef_ref': source_desc})
+		scope = None
+		if isinstance(source_desc, FormatInfo) and source_desc.expression_params:
+			scope = tuple((frame.desc, frame.value, frame.buf_offset) for frame in self.stack), self.buf_offset
+		range.set_metadata_loader(_load_range_metadata, (tuple(frame.id for frame in self.stack), scope))
 		return range
 
+	def pack_fixed_fields(self, struct_fi, values):
+		# create the ranges as if the fields had been parsed one by one
+		o = {}
+		self.set_top_value(o)
+		for (name, child, size), value in zip(struct_fi.fixed_fields, values):
+			self.push(child, None, id=name)
+			self.buf_offset += size
+			o[name] = self.pack_value(value)
+			self.pop()
+		return o
+
+	def pack_bit_fields(self, bits_fi, raw: int, little_endian: bool):
+		# create a range for each field, whose description prints its bits
+		o = self.stack[-1].value
+		start = self.buf_offset
+		total_bits = bits_fi.size * 8
+		for name, bitpos, bits, shift, mask in bits_fi.bit_fields:
+			value = raw >> shift & mask
+			if not little_endian: self.buf_offset = start + bitpos // 8
+			binary = format(value, "0%db" % bits) if bits else ""
+			self.push(desc={'print': ("."*bitpos) + binary + ("."*(total_bits-bitpos-bits)) + "  " + name + " = " + str(value)}, id=name)
+			o[name] = self.pack_value(value)
+			self.pop()
+		self.buf_offset = start
+
 	def pack_error(self, ex):
 		range = self.pack_value(None)
 		range.exception = ex
@@ -308,3 +850,104 @@ class AnnotatingParseContext(ParseContext):
 		while isinstance(packed_value, Range):
 			packed_value = packed_value.value
 		return packed_value
+
+
+class stream_record:
+	__slots__ = ('offset', 'buf', 'value')
+
+	def __init__(self, offset, buf, value):
+		self.offset = offset
+		self.buf = buf
+		self.value = value
+
+	def __repr__(self):
+		return "stream_record(%d, %d bytes, %r)" % (self.offset, len(self.buf), self.value)
+
+
+class StreamParser:
+	"""
+	Parses a stream of consecutive top-level records of one definition, which arrives in chunks of arbitrary size.
+
+	feed() returns each record as soon as it is complete. A record cut off by the end of the buffered data is
+	retried only when enough bytes arrived to get past the point where it stopped. Consumed bytes are discarded,
+	incoming chunks are only joined when a parse is attempted. If more than high_water_mark bytes are buffered
+	or a record fails to parse for another reason, the buffered data is dropped to resynchronize.
+
+	The definition must determine the length of a record by itself, e.g. a BYTES field without size would
+	consume whatever happens to be buffered.
+	"""
+	logger = logging.getLogger("StreamParser")
+
+	def __init__(self, format_infos: FormatInfoContainer, def_name: Optional[str] = None,
+				 high_water_mark: int = 16*1024*1024, context_class=ParseContext):
+		self.format_infos = format_infos
+		self.def_name = def_name if def_name is not None else format_infos.main_name
+		self.high_water_mark = high_water_mark
+		self.context_class = context_class
+		self.chunks = list()
+		self.buffered_bytes = 0
+		self.needed_bytes = 1
+		self.stream_offset = 0
+		self.record_count = 0
+		self.dropped_bytes = 0
+		self.last_error = None
+		# records cut off at the end are the common case, they don't need a new exception each time
+		self.preallocated_incomplete = incomplete.__new__(incomplete)
+
+	def feed(self, data) -> list:
+		"""Appends data to the stream, returns the list of stream_records completed by it"""
+		records = []
+		if not data: return records
+		self.chunks.append(data)
+		self.buffered_bytes += len(data)
+		if self.buffered_bytes >= self.needed_bytes:
+			self._parse_records(records)
+		if self.buffered_bytes > self.high_water_mark:
+			self._drop("%d bytes buffered without completing a record, exceeding the high-water mark" % self.buffered_bytes)
+		return records
+
+	def _parse_records(self, records):
+		buf = bytes(self.chunks[0]) if len(self.chunks) == 1 else b"".join(self.chunks)
+		end = len(buf)
+		ctx = self.context_class(self.format_infos, buf)
+		ctx.log_failures = False
+		ctx.preallocated_incomplete = self.preallocated_incomplete
+		ctx.display_offset_delta = self.stream_offset
+		start = 0
+		self.needed_bytes = 1
+		while start < end:
+			ctx.buf_offset = start
+			ctx.failed = None
+			value = ctx.parse(self.def_name)
+			if ctx.failed is not None:
+				ex = ctx.failed
+				if isinstance(ex, incomplete) and ex.offset + ex.got_bytes == self.stream_offset + end:
+					# cut off by the end of the buffered data - retry when the missing bytes arrived
+					self.needed_bytes = end - start + ex.needed_bytes - ex.got_bytes
+					break
+				self._consume(buf, start)
+				self._drop("record failed to parse", copy.copy(ex) if ex is self.preallocated_incomplete else ex)
+				return
+			if ctx.buf_offset == start:
+				self._consume(buf, start)
+				self._drop("record consumed zero bytes")
+				return
+			records.append(stream_record(self.stream_offset + start, buf[start:ctx.buf_offset], value))
+			self.record_count += 1
+			start = ctx.buf_offset
+		self._consume(buf, start)
+
+	def _consume(self, buf, count):
+		rest = buf[count:]
+		self.chunks = [rest] if rest else []
+		self.buffered_bytes = len(rest)
+		self.stream_offset += count
+
+	def _drop(self, reason, ex=None):
+		self.logger.warning("Dropping %d bytes at stream offset %d: %s", self.buffered_bytes, self.stream_offset, reason)
+		self.last_error = ex
+		self.dropped_bytes += self.buffered_bytes
+		self.stream_offset += self.buffered_bytes
+		self.chunks = []
+		self.buffered_bytes = 0
+		self.needed_bytes = 1
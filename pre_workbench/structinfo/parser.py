@@ -19,7 +19,7 @@ from lark import Transformer
 
 from pre_workbench.structinfo.format_info import VariantStructFI, StructFI, RepeatStructFI, SwitchFI, NamedFI, \
 	FormatInfo, UnionFI, FieldFI, builtinTypes, BitStructFI
-from pre_workbench.structinfo.expr import Expression, fi_parser
+from pre_workbench.structinfo.expr import Expression, parse_grammar_text
 
 
 def make_builtin(name, params):
@@ -30,13 +30,13 @@ def make_builtin(name, params):
 
 
 def parse_definition(txt, start="anytype"):
-	ast = fi_parser.parse(txt, start=start)
+	ast = parse_grammar_text(txt, start)
 
 	return transformer.transform(ast)
 
 
 def parse_definition_map_into_container(txt, container, start="start"):
-	ast = fi_parser.parse(txt, start=start)
+	ast = parse_grammar_text(txt, start)
 
 	for definition in ast.children:
 		container.definitions[str(definition.children[1])] = transformer.transform(definition.children[2])
@@ -0,0 +1,157 @@
+# PRE Workbench
+# Copyright (C) 2022 Mira Weller
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Packet offset index of pcap and pcapNG files, to read single packets of huge captures without loading all of them.
+
+The index holds a packed record per packet with the values of iter_pcap_records, and the file metadata. It is stored
+in a sidecar file next to the capture (capture file name + INDEX_SUFFIX), and reused as long as size and modification
+time of the capture are unchanged.
+"""
+
+import logging
+import mmap
+import os
+import struct
+from typing import Optional
+
+from pre_workbench.objects import ByteBuffer
+from pre_workbench.structinfo import xdrm
+from pre_workbench.structinfo.pcap_reader import iter_pcap_records, packet_metadata
+
+INDEX_SUFFIX = ".pwidx"
+INDEX_MAGIC = b"PWPCAPIX"
+INDEX_VERSION = 1
+
+# magic, version, file format, size and mtime_ns of the capture file, packet count, length of the metadata
+_index_header = struct.Struct("<8sIIQqQI")
+# payload offset, captured length, original length, timestamp, interface id
+_index_record = struct.Struct("<QIIQi")
+
+
+class PcapIndex:
+	def __init__(self, file_format: int, metadata: dict, records: bytes, file_size: int = 0, file_mtime: int = 0):
+		self.file_format = file_format
+		self.metadata = metadata
+		self.records = records
+		self.file_size = file_size
+		self.file_mtime = file_mtime
+
+	@staticmethod
+	def build(data, file_size: int = 0, file_mtime: int = 0) -> 'PcapIndex':
+		"""Scans data, the contents of a pcap or pcapNG file, without copying any payload"""
+		metadata = dict()
+		file_format, records = iter_pcap_records(data, metadata)
+		packed = bytearray()
+		pack = _index_record.pack
+		for record in records:
+			packed += pack(*record)
+		return PcapIndex(file_format, metadata, bytes(packed), file_size, file_mtime)
+
+	@staticmethod
+	def for_file(file_name: str, sidecar: bool = True) -> 'PcapIndex':
+		"""
+		Returns the index of the capture file file_name. If sidecar is set, an up-to-date index file is loaded, or
+		the newly built index is saved if the directory is writable.
+		"""
+		stat = os.stat(file_name)
+		index_name = file_name + INDEX_SUFFIX
+		if sidecar:
+			index = PcapIndex.load(index_name, stat.st_size, stat.st_mtime_ns)
+			if index is not None:
+				return index
+		with open(file_name, "rb") as f:
+			if stat.st_size == 0:
+				index = PcapIndex.build(f.read(), stat.st_size, stat.st_mtime_ns)
+			else:
+				with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+					index = PcapIndex.build(data, stat.st_size, stat.st_mtime_ns)
+		if sidecar:
+			try:
+				index.save(index_name)
+			except OSError as ex:
+				logging.info("Can't store packet index %s: %s", index_name, ex)
+		return index
+
+	@staticmethod
+	def load(index_name: str, file_size: int, file_mtime: int) -> Optional['PcapIndex']:
+		"""Returns the index stored in index_name, or None if it's missing, invalid or for another file version"""
+		try:
+			with open(index_name, "rb") as f:
+				data = f.read()
+		except OSError:
+			return None
+		try:
+			magic, version, file_format, size, mtime, count, meta_length = _index_header.unpack_from(data, 0)
+			if magic != INDEX_MAGIC or version != INDEX_VERSION or size != file_size or mtime != file_mtime:
+				return None
+			start = _index_header.size + meta_length
+			if len(data) != start + count * _index_record.size:
+				return None
+			# index files are found next to capture files from anywhere, they mustn't restore objects
+			metadata = xdrm.loads(data[_index_header.size:start], native_only=True)
+		except Exception as ex:
+			logging.warning("Invalid packet index %s: %r", index_name, ex)
+			return None
+		return PcapIndex(file_format, metadata, data[start:], size, mtime)
+
+	def save(self, index_name: str):
+		meta = xdrm.dumps(self.metadata)
+		tmp_name = index_name + ".tmp"
+		with open(tmp_name, "wb") as f:
+			f.write(_index_header.pack(INDEX_MAGIC, INDEX_VERSION, self.file_format, self.file_size, self.file_mtime,
+									   len(self), len(meta)))
+			f.write(meta)
+			f.write(self.records)
+		os.replace(tmp_name, index_name)
+
+	def __len__(self):
+		return len(self.records) // _index_record.size
+
+	def record(self, i: int) -> tuple:
+		"""Returns (payload offset, captured length, original length, timestamp, interface id) of packet i"""
+		if not 0 <= i < len(self): raise IndexError("packet index out of range")
+		return _index_record.unpack_from(self.records, i * _index_record.size)
+
+	def packet_metadata(self, i: int) -> dict:
+		return packet_metadata(self.file_format, *self.record(i)[1:])
+
+	def read_packet(self, data, i: int) -> ByteBuffer:
+		"""Returns packet i as ByteBuffer, data is the contents of the capture file, e.g. an mmap"""
+		offset, length, orig_length, timestamp, interface_id = self.record(i)
+		return ByteBuffer(data[offset:offset + length],
+						  metadata=packet_metadata(self.file_format, length, orig_length, timestamp, interface_id))
+
+
+class PcapPacketReader:
+	"""Reads the packets of a capture file by their number, e.g. as provider of a LazyByteBufferList"""
+	def __init__(self, file_name: str, index: PcapIndex):
+		self.index = index
+		if len(index):
+			with open(file_name, "rb") as f:
+				self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		else:
+			self.data = b""
+
+	def __len__(self):
+		return len(self.index)
+
+	def __call__(self, i: int) -> ByteBuffer:
+		return self.index.read_packet(self.data, i)
+
+	def close(self):
+		if isinstance(self.data, mmap.mmap):
+			self.data.close()
@@ -14,8 +14,12 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import io
 import logging
+import mmap
+import struct
 from datetime import datetime
+from typing import List
 
 from pre_workbench.objects import ByteBufferList, ByteBuffer
 from pre_workbench.structinfo.parsecontext import FormatInfoContainer
@@ -129,44 +133,264 @@ pcapng_options repeat struct {
 """)
 
 
+_pcap_header = {e: struct.Struct(e + "IHHiIII") for e in "<>"}
+_pcap_header_fields = ('magic_number', 'version_major', 'version_minor', 'thiszone', 'sigfigs', 'snaplen', 'encap_proto')
+_pcap_record = {e: struct.Struct(e + "IIII") for e in "<>"}
+_pcap_magic = {b"\xd4\xc3\xb2\xa1": "<", b"\x4d\x3c\xb2\xa1": "<", b"\xa1\xb2\xc3\xd4": ">", b"\xa1\xb2\x3c\x4d": ">"}
+
+_pcapng_block = {e: struct.Struct(e + "II") for e in "<>"}
+_pcapng_shb = {e: struct.Struct(e + "IHHq") for e in "<>"}
+_pcapng_idb = {e: struct.Struct(e + "HHI") for e in "<>"}
+_pcapng_epb = {e: struct.Struct(e + "IIIII") for e in "<>"}
+_pcapng_spb = {e: struct.Struct(e + "I") for e in "<>"}
+_pcapng_option = {e: struct.Struct(e + "HH") for e in "<>"}
+_pcapng_byte_order = {b"\x4d\x3c\x2b\x1a": "<", b"\x1a\x2b\x3c\x4d": ">"}
+PCAPNG_SHB, PCAPNG_IDB, PCAPNG_SPB, PCAPNG_EPB = 0x0A0D0D0A, 1, 3, 6
+
+# file formats
+PCAP = 1
+PCAPNG = 2
+
+# interface id of the records of pcapNG simple packet blocks
+SPB_INTERFACE = -1
+
+# records of streams above this size are considered corrupt, instead of waiting for them
+MAX_STREAM_RECORD_LENGTH = 1 << 26
+
+
 def read_pcap_file(f):
-	from pre_workbench.structinfo.parsecontext import ParseContext
-	ctx = ParseContext(PcapFormats, f.read())
-	pcapfile = ctx.parse()
+	"""Reads all packets of a pcap or pcapNG file into a ByteBufferList, see iter_pcap_file"""
 	plist = ByteBufferList()
-	if 'header' in pcapfile:
-		# pcap classic
-		plist.metadata.update(pcapfile['header'])
-		for packet in pcapfile['packets']:
-			plist.add(ByteBuffer(packet['payload'], metadata=packet['pheader']))
-	else:
-		blocks = [ pcapfile['first_block'] ] + pcapfile['rest_blocks']
-		# pcapNG
-		plist.metadata['interfaces'] = []
-		for block_wrapper in blocks:
-			block = block_wrapper['block_payload']
-			if isinstance(block, dict) and 'payload' in block:
-				meta = {'interface_id': block.get('interface_id', 0),
-						'timestamp': datetime.fromtimestamp(
-							(block.get('timestamp_hi', 0) << 32 | block.get('timestamp_lo', 0)) / 1000000.0),
-						'cap_length': block.get('cap_length', 0),
-						'orig_length': block['orig_length'],
-						}
-				plist.add(ByteBuffer(block['payload'], metadata=meta))
-			elif block_wrapper['block_type'] == 0x0A0D0D0A:  # SHB
-				plist.metadata['pcap_version'] = "%d.%d" % (block['version_major'], block['version_minor'])
-				for opt in block['options']:
-					update_option(plist.metadata, "SHB", opt["code"], opt["value"])
-			elif block_wrapper['block_type'] == 1:  # IDB
-				interface = {'linktype': block['linktype'], 'snaplen': block['snaplen']}
-				for opt in block['options']:
-					update_option(interface, "IDB", opt["code"], opt["value"])
-				plist.metadata['interfaces'].append(interface)
-			else:
-				logging.info("PCAPng - unhandled header block: %r", block_wrapper)
+	for bbuf in iter_pcap_file(f, plist.metadata):
+		plist.add(bbuf)
 	return plist
 
 
+def iter_pcap_file(f, metadata: dict):
+	"""
+	Yields a ByteBuffer for each packet of the pcap or pcapNG file f, see iter_pcap_data. The file is mapped instead
+	of read, the packet payloads are only copied once into their ByteBuffers.
+	"""
+	try:
+		data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+		# not a regular file, or empty
+		yield from iter_pcap_data(f.read(), metadata)
+		return
+	try:
+		yield from iter_pcap_data(data, metadata)
+	finally:
+		data.close()
+
+
+def iter_pcap_data(data, metadata: dict):
+	"""
+	Yields a ByteBuffer for each packet in data, the contents of a pcap or pcapNG file. The file header of pcap files,
+	or the version and options of the section headers and the list of interfaces of pcapNG files are stored in
+	metadata as they are read. A record cut off at the end of data is skipped with a warning.
+	"""
+	view = memoryview(data)
+	try:
+		file_format, records = iter_pcap_records(view, metadata)
+		for offset, length, orig_length, timestamp, interface_id in records:
+			yield ByteBuffer(view[offset:offset + length],
+							 metadata=packet_metadata(file_format, length, orig_length, timestamp, interface_id))
+	finally:
+		view.release()
+
+
+def iter_pcap_records(data, metadata: dict):
+	"""
+	Returns the format of the pcap or pcapNG file in data, PCAP or PCAPNG, and an iterator of a tuple per packet:
+	(offset of the payload in data, captured length, original length, timestamp, interface id). The timestamp is
+	ts_sec << 32 | ts_usec for pcap files, the 64-bit timestamp of the packet block for pcapNG files. The interface id
+	is 0 for pcap files and SPB_INTERFACE for simple packet blocks. Metadata is filled as in iter_pcap_data.
+	"""
+	magic = bytes(data[0:4])
+	if magic in _pcap_magic:
+		endianness = _pcap_magic[magic]
+		header = _pcap_header[endianness]
+		if len(data) < header.size:
+			raise ValueError("Truncated pcap file header")
+		metadata.update(zip(_pcap_header_fields, header.unpack_from(data, 0)))
+		return PCAP, _iter_pcap(data, header.size, _pcap_record[endianness])
+	elif len(data) >= 12 and magic == b"\x0a\x0d\x0d\x0a":
+		return PCAPNG, _iter_pcapng(data, metadata)
+	else:
+		raise ValueError("Not a pcap or pcapNG file (magic %s)" % magic.hex())
+
+
+def packet_metadata(file_format, length, orig_length, timestamp, interface_id):
+	"""Returns the metadata of a packet from the values of its iter_pcap_records tuple"""
+	if file_format == PCAP:
+		return {'ts_sec': timestamp >> 32, 'ts_usec': timestamp & 0xffffffff, 'incl_len': length, 'orig_len': orig_length}
+	elif interface_id == SPB_INTERFACE:
+		return {'interface_id': 0, 'timestamp': datetime.fromtimestamp(0), 'cap_length': 0, 'orig_length': orig_length}
+	else:
+		return {'interface_id': interface_id, 'timestamp': datetime.fromtimestamp(timestamp / 1000000.0),
+				'cap_length': length, 'orig_length': orig_length}
+
+
+def _iter_pcap(data, offset, record):
+	end = len(data)
+	while offset < end:
+		if offset + record.size > end:
+			logging.warning("pcap file - record header at offset %d cut off", offset)
+			return
+		ts_sec, ts_usec, incl_len, orig_len = record.unpack_from(data, offset)
+		offset += record.size
+		if offset + incl_len > end:
+			logging.warning("pcap file - packet at offset %d cut off", offset)
+			return
+		yield offset, incl_len, orig_len, ts_sec << 32 | ts_usec, 0
+		offset += incl_len
+
+
+def _iter_pcapng(data, metadata):
+	interfaces = metadata.setdefault('interfaces', [])
+	offset, end = 0, len(data)
+	endianness = "<"
+	while offset + 12 <= end:
+		endianness = _pcapng_section_endianness(data, offset, endianness)
+		block_type, block_length = _pcapng_block[endianness].unpack_from(data, offset)
+		if block_length < 12 or block_length % 4 or offset + block_length > end:
+			logging.warning("pcapNG file - invalid or cut off block at offset %d", offset)
+			return
+		record = _read_pcapng_block(data, offset, block_type, block_length, endianness, metadata, interfaces)
+		if record is not None:
+			yield record
+		offset += block_length
+	if offset < end:
+		logging.warning("pcapNG file - block header at offset %d cut off", offset)
+
+
+def _pcapng_section_endianness(data, offset, endianness):
+	"""Returns the byte order of the block at offset, which is set by each section header block"""
+	if data[offset:offset + 4] != b"\x0a\x0d\x0d\x0a":
+		return endianness
+	byte_order = bytes(data[offset + 8:offset + 12])
+	if byte_order not in _pcapng_byte_order:
+		raise ValueError("Invalid pcapNG byte order magic %s at offset %d" % (byte_order.hex(), offset))
+	return _pcapng_byte_order[byte_order]
+
+
+def _read_pcapng_block(data, offset, block_type, block_length, endianness, metadata, interfaces):
+	"""Returns the iter_pcap_records tuple of a packet block, stores the information of other blocks in metadata"""
+	body = offset + 8
+	body_end = offset + block_length - 4
+	if block_type == PCAPNG_EPB:
+		interface_id, timestamp_hi, timestamp_lo, cap_length, orig_length = _pcapng_epb[endianness].unpack_from(data, body)
+		payload = body + _pcapng_epb[endianness].size
+		return payload, min(cap_length, body_end - payload), orig_length, timestamp_hi << 32 | timestamp_lo, interface_id
+	elif block_type == PCAPNG_SPB:
+		orig_length, = _pcapng_spb[endianness].unpack_from(data, body)
+		payload = body + _pcapng_spb[endianness].size
+		return payload, min(orig_length, body_end - payload), orig_length, 0, SPB_INTERFACE
+	elif block_type == PCAPNG_SHB:
+		magic, version_major, version_minor, section_length = _pcapng_shb[endianness].unpack_from(data, body)
+		metadata['pcap_version'] = "%d.%d" % (version_major, version_minor)
+		_read_options(data, body + _pcapng_shb[endianness].size, body_end, endianness, metadata, "SHB")
+	elif block_type == PCAPNG_IDB:
+		linktype, reserved, snaplen = _pcapng_idb[endianness].unpack_from(data, body)
+		interface = {'linktype': linktype, 'snaplen': snaplen}
+		_read_options(data, body + _pcapng_idb[endianness].size, body_end, endianness, interface, "IDB")
+		interfaces.append(interface)
+	else:
+		logging.info("pcapNG file - unhandled block type 0x%08X at offset %d", block_type, offset)
+	return None
+
+
+class PcapStreamDecoder:
+	"""
+	Decodes a pcap or pcapNG stream, e.g. the output of "tcpdump -w -", from chunks of any size. feed returns the
+	packets completed by a chunk as ByteBuffers, with the same metadata as iter_pcap_data. The file metadata is
+	collected in self.metadata.
+	"""
+	def __init__(self):
+		self.metadata = dict()
+		self.file_format = None
+		self.endianness = "<"
+		self.buf = bytearray()
+		self.pos = 0
+		self.bytes_read = 0
+
+	def feed(self, chunk) -> List[ByteBuffer]:
+		buf = self.buf
+		if self.pos:
+			del buf[:self.pos]
+			self.bytes_read += self.pos
+			self.pos = 0
+		buf += chunk
+		if self.file_format is None and not self._read_file_header():
+			return []
+		if self.file_format == PCAP:
+			return self._feed_pcap()
+		else:
+			return self._feed_pcapng()
+
+	def _read_file_header(self):
+		buf = self.buf
+		if len(buf) < 4: return False
+		magic = bytes(buf[0:4])
+		if magic in _pcap_magic:
+			self.endianness = _pcap_magic[magic]
+			header = _pcap_header[self.endianness]
+			if len(buf) < header.size: return False
+			self.metadata.update(zip(_pcap_header_fields, header.unpack_from(buf, 0)))
+			self.file_format, self.pos = PCAP, header.size
+		elif magic == b"\x0a\x0d\x0d\x0a":
+			self.metadata['interfaces'] = []
+			self.file_format = PCAPNG
+		else:
+			raise ValueError("Not a pcap or pcapNG stream (magic %s)" % magic.hex())
+		return True
+
+	def _feed_pcap(self):
+		buf, pos, end = self.buf, self.pos, len(self.buf)
+		record = _pcap_record[self.endianness]
+		packets = []
+		while pos + record.size <= end:
+			ts_sec, ts_usec, incl_len, orig_len = record.unpack_from(buf, pos)
+			if incl_len > MAX_STREAM_RECORD_LENGTH:
+				raise ValueError("Invalid pcap record length %d at offset %d" % (incl_len, self.bytes_read + pos))
+			payload = pos + record.size
+			if payload + incl_len > end: break
+			packets.append(ByteBuffer(buf[payload:payload + incl_len],
+									  metadata={'ts_sec': ts_sec, 'ts_usec': ts_usec, 'incl_len': incl_len, 'orig_len': orig_len}))
+			pos = payload + incl_len
+		self.pos = pos
+		return packets
+
+	def _feed_pcapng(self):
+		buf, pos, end = self.buf, self.pos, len(self.buf)
+		metadata, interfaces = self.metadata, self.metadata['interfaces']
+		packets = []
+		while pos + 12 <= end:
+			self.endianness = _pcapng_section_endianness(buf, pos, self.endianness)
+			block_type, block_length = _pcapng_block[self.endianness].unpack_from(buf, pos)
+			if block_length < 12 or block_length % 4 or block_length > MAX_STREAM_RECORD_LENGTH:
+				raise ValueError("Invalid pcapNG block length %d at offset %d" % (block_length, self.bytes_read + pos))
+			if pos + block_length > end: break
+			record = _read_pcapng_block(buf, pos, block_type, block_length, self.endianness, metadata, interfaces)
+			if record is not None:
+				offset, length, orig_length, timestamp, interface_id = record
+				packets.append(ByteBuffer(buf[offset:offset + length],
+										  metadata=packet_metadata(PCAPNG, length, orig_length, timestamp, interface_id)))
+			pos += block_length
+		self.pos = pos
+		return packets
+
+
+def _read_options(data, offset, end, endianness, target, block_type):
+	option = _pcapng_option[endianness]
+	while offset + option.size <= end:
+		code, length = option.unpack_from(data, offset)
+		offset += option.size
+		if code == 0: return
+		update_option(target, block_type, code, bytes(data[offset:offset + length]))
+		offset += (length + 3) & ~3
+
+
 opt_names = {
 	"*": {
 		1: ("opt_comment", True),  # yes
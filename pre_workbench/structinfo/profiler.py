@@ -0,0 +1,140 @@
+# PRE Workbench
+# Copyright (C) 2022 Mira Weller
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Collects statistics per grammar node while parsing, to find the expensive parts of a grammar.
+
+Set ParseContext.profile to a ParseProfile before parsing. Every FormatInfo node read by the context counts an
+invocation, the bytes it consumed, its cumulative time (including the nodes below, counted once for recursive
+definitions) and self time, the exceptions it caught, and for variants the alternatives tried. One profile can
+collect the statistics of many parses.
+"""
+
+import time
+
+from pre_workbench.structinfo.format_info import FormatInfo, VariantStructFI, StructFI, UnionFI
+from pre_workbench.structinfo.parsecontext import FormatInfoContainer
+
+COLUMNS = ('calls', 'bytes', 'total_time', 'self_time', 'exceptions', 'alternatives')
+
+
+class node_stats:
+	__slots__ = ('desc', 'calls', 'bytes', 'total_time', 'self_time', 'exceptions', 'alternatives', 'active')
+
+	def __init__(self, desc):
+		self.desc = desc
+		self.calls = 0
+		self.bytes = 0
+		self.total_time = 0.0
+		self.self_time = 0.0
+		self.exceptions = 0
+		self.alternatives = 0
+		self.active = 0
+
+
+class ParseProfile:
+	timer = time.perf_counter
+
+	def __init__(self):
+		self.nodes = dict()
+
+	def clear(self):
+		self.nodes = dict()
+
+	def _stats(self, desc):
+		try:
+			return self.nodes[id(desc)]
+		except KeyError:
+			stats = self.nodes[id(desc)] = node_stats(desc)
+			return stats
+
+	def enter(self, context, frame):
+		desc = frame.desc
+		if not isinstance(desc, FormatInfo): return
+		stats = self._stats(desc)
+		stats.calls += 1
+		stats.active += 1
+		if len(context.stack) > 1:
+			parent = context.stack[-2].desc
+			if isinstance(parent, FormatInfo) and type(parent.fi) is VariantStructFI:
+				self._stats(parent).alternatives += 1
+		# start time and time spent in the nodes below
+		frame.profile = [self.timer(), 0.0]
+
+	def leave(self, context, frame):
+		if frame.profile is None: return
+		start, child_time = frame.profile
+		elapsed = self.timer() - start
+		if context.stack and context.stack[-1].profile is not None:
+			context.stack[-1].profile[1] += elapsed
+		stats = self.nodes[id(frame.desc)]
+		stats.active -= 1
+		stats.self_time += elapsed - child_time
+		stats.bytes += context.buf_offset - frame.buf_offset
+		if stats.active == 0:
+			stats.total_time += elapsed
+
+	def count_exception(self, desc):
+		self._stats(desc).exceptions += 1
+
+	def node_rows(self, format_infos: FormatInfoContainer):
+		"""Returns a dict per node with its name, definition, type and the values of COLUMNS"""
+		names = _node_names(format_infos)
+		rows = []
+		for stats in self.nodes.values():
+			desc = stats.desc
+			definition, name = names.get(id(desc), (None, repr(desc)))
+			row = {'name': name, 'definition': definition, 'type': desc.fi_type}
+			row.update((k, getattr(stats, k)) for k in COLUMNS)
+			rows.append(row)
+		rows.sort(key=lambda row: row['self_time'], reverse=True)
+		return rows
+
+	def definition_rows(self, format_infos: FormatInfoContainer):
+		"""
+		Returns a dict per definition with the calls, bytes and total time of its root node, and the sums of the self
+		time, exceptions and alternatives of all its nodes.
+		"""
+		rows = {}
+		for row in self.node_rows(format_infos):
+			definition = row['definition']
+			if definition is None: continue
+			total = rows.setdefault(definition, {'name': definition, 'calls': 0, 'bytes': 0, 'total_time': 0.0,
+												 'self_time': 0.0, 'exceptions': 0, 'alternatives': 0})
+			if row['name'] == definition:
+				total['calls'], total['bytes'], total['total_time'] = row['calls'], row['bytes'], row['total_time']
+			for k in ('self_time', 'exceptions', 'alternatives'):
+				total[k] += row[k]
+		return sorted(rows.values(), key=lambda row: row['self_time'], reverse=True)
+
+	def to_json(self, format_infos: FormatInfoContainer):
+		return {'definitions': self.definition_rows(format_infos), 'nodes': self.node_rows(format_infos)}
+
+
+def _node_names(format_infos: FormatInfoContainer):
+	"""Returns (definition name, path of the node in the definition) by id of every node of the definitions"""
+	result = {}
+	def visit(node, definition, path):
+		result[id(node)] = (definition, path)
+		if type(node.fi) in (StructFI, UnionFI):
+			for name, child, comment in node.fi.children:
+				visit(child, definition, path + "." + name)
+		else:
+			for i, child in enumerate(node.child_infos()):
+				visit(child, definition, "%s[%d]" % (path, i))
+	for name, root in format_infos.definitions.items():
+		visit(root, name, name)
+	return result
@@ -41,12 +41,16 @@ XDRM_map    = 0b111  # rest: pair-count
 
 Serializable = TypeRegistry("Serializable")
 
-def loads(data, magic=bytes(), enable_deserialize=True):
+def loads(data, magic=bytes(), enable_deserialize=True, native_only=False):
+	"""
+	Decodes data. Objects of Serializable classes are deserialized if enable_deserialize is set, and returned as
+	("__serialized__", class id, data) tuples otherwise. If native_only is set, they raise an exception instead.
+	"""
 	if data[0:len(magic)] != magic:
 		raise Exception("Invalid file format (magic number expected=%r, got=%r)" % (magic, data[0:len(magic)]))
 	data = data[len(magic):]
 	unpacker = xdrlib.Unpacker(data)
-	return _unpack_xdrm(unpacker, enable_deserialize)
+	return _unpack_xdrm(unpacker, enable_deserialize, native_only)
 
 
 def dumps(data, magic=bytes()):
@@ -55,7 +59,7 @@ def dumps(data, magic=bytes()):
 	return magic + packer.get_buffer()
 
 
-def _unpack_xdrm(unpacker, enable_deserialize=True):
+def _unpack_xdrm(unpacker, enable_deserialize=True, native_only=False):
 	typecode = unpacker.unpack_uint()
 	type, rest = typecode & 0b111, typecode >> 3
 	if type == XDRM_inlong:
@@ -74,28 +78,30 @@ def _unpack_xdrm(unpacker, enable_deserialize=True):
 		return UUID(bytes=unpacker.unpack_fopaque(0x10))
 	elif type == XDRM_number and (rest & 0x1fff) == 0x1fff:
 		serialize_id = rest >> 13  #16-bit class ID
+		if native_only:
+			raise Exception("serialized object of class id 0x%04X not allowed" % (serialize_id, ))
 		if enable_deserialize:
 			clazz, _ = Serializable.find(class_id=serialize_id)
 			if not clazz: raise Exception("unknown class id 0x%04X" % (serialize_id, ))
 			try:
-				return clazz.__deserialize__(_unpack_xdrm(unpacker, enable_deserialize))
+				return clazz.__deserialize__(_unpack_xdrm(unpacker, enable_deserialize, native_only))
 			except:
 				logging.error("Failed to deserialize class %s", clazz)
 				return None
 		else:
-			return ("__serialized__", serialize_id, _unpack_xdrm(unpacker, enable_deserialize))
+			return ("__serialized__", serialize_id, _unpack_xdrm(unpacker, enable_deserialize, native_only))
 	elif type == XDRM_utf8:
 		return unpacker.unpack_fstring(rest).decode("utf-8",'surrogateescape')
 	elif type == XDRM_bytes:
 		return unpacker.unpack_fopaque(rest)
 	elif type == XDRM_array:
-		result = [_unpack_xdrm(unpacker, enable_deserialize) for _ in range(rest)]
+		result = [_unpack_xdrm(unpacker, enable_deserialize, native_only) for _ in range(rest)]
 		return result
 	elif type == XDRM_map:
 		result = {}
 		for _ in range(rest):
-			key = _unpack_xdrm(unpacker, enable_deserialize)
-			result[key] = _unpack_xdrm(unpacker, enable_deserialize)
+			key = _unpack_xdrm(unpacker, enable_deserialize, native_only)
+			result[key] = _unpack_xdrm(unpacker, enable_deserialize, native_only)
 		return result
 	else:
 		raise Exception("invalid typecode 0x%08x (type=%d, rest=0x%x) at offset 0x%x" % (typecode, type, rest, unpacker.get_position()))
@@ -16,7 +16,7 @@ def run_cli():
 	parser.add_argument('-d', '--definition', metavar='NAME', type=str,
 						help='Name of start grammar definition. Uses first if unspecified')
 	parser.add_argument('-l', '--language', metavar='LANG', type=str,
-						help='Programming language to generate (supported: lua)', default="lua")
+						help='Programming language to generate (supported: lua, python)', default="lua")
 	parser.add_argument('--dissector-table', metavar='NAME:KEY', type=str, action='append',
 						help='Register the protocol in the given dissector table, under the given key')
 	parser.add_argument('--raise-not-implemented', type=bool, default=True, action=argparse.BooleanOptionalAction,
@@ -47,6 +47,9 @@ def run_cli():
 
 	if r.language == 'lua':
 		generate_lua_dissector(r.definition, r.only_types, r.dissector_table, fic, r.raise_not_implemented, out)
+	elif r.language == 'python':
+		from pre_workbench.structinfo.compiler import generate_python_module
+		out.write(generate_python_module(fic, r.definition))
 	else:
 		raise NotImplemented
 
@@ -44,6 +44,8 @@ class ObjectWindow(QWidget):
 
 		self.dataSource = None
 		self.dataSourceType = ""
+		# the window is deleted when its dock widget is closed
+		self.destroyed.connect(lambda: self.dataSource is not None and self.dataSource.close())
 		self._initUI(collapseSettings)
 		self.dataObject = dataObject
 		self.dataDisplay.setContents(dataObject)
@@ -180,6 +182,15 @@ class ObjectWindow(QWidget):
 			"Loaded data in %f sec" % (time.perf_counter() - self._start_fetch_timestamp)))
 
 
+	def onProgress(self, done, total):
+		QApplication.postEvent(self, QStatusTipEvent(
+			"Parsed %d of %d buffers in %f sec" % (done, total, time.perf_counter() - self._start_fetch_timestamp)))
+
+	def onStats(self, stats):
+		QApplication.postEvent(self, QStatusTipEvent(
+			"%d packets, %.0f packets/s, %.1f kB/s, %d dropped, %d evicted" % (stats['packets'], stats['packetsPerSec'],
+				stats['bytesPerSec'] / 1024, stats['dropped'], stats['evicted'])))
+
 	def onCancelFetch(self):
 		self.dataSource.cancelFetch()
 		QApplication.postEvent(self, QStatusTipEvent(
@@ -189,6 +200,7 @@ class ObjectWindow(QWidget):
 		self.reload()
 
 	def reload(self):
+		oldDataSource = self.dataSource
 		try:
 			self.cancelAction.setEnabled(True)
 
@@ -199,6 +211,8 @@ class ObjectWindow(QWidget):
 			clz = self._getDatasource(self.params["dataSourceType"])
 			self.dataSource = clz(self.params)
 			self.dataSource.on_finished.connect(self.onFinished)
+			self.dataSource.on_progress.connect(self.onProgress)
+			self.dataSource.on_stats.connect(self.onStats)
 			self._start_fetch_timestamp = time.perf_counter()
 			result = self.dataSource.startFetch()
 			self.dataDisplay.setContents(result)
@@ -207,6 +221,8 @@ class ObjectWindow(QWidget):
 			self.dataDisplay.setErrMes(traceback.format_exc(), "Error: " + str(e))
 			self.cancelAction.setEnabled(False)
 			self.dataObject = None
+		if oldDataSource is not None:
+			oldDataSource.close()
 
 	def childActionProxy(self):
 		return self.dataDisplay.childWidget
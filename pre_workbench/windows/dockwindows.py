@@ -33,7 +33,7 @@ from PyQt5.QtWidgets import QFileSystemModel, QTreeView, QWidget, QVBoxLayout, Q
 	QShortcut, QFileDialog, QDialog, QTextBrowser
 
 import pre_workbench.app
-from pre_workbench import configs
+from pre_workbench import configs, bbuf_parsing
 from pre_workbench.algo.range import Range
 from pre_workbench.app import navigate
 from pre_workbench.configs import getIcon, SettingsField
@@ -45,6 +45,7 @@ from pre_workbench.guihelper import filledColorIcon, getMonospaceFont, runProces
 from pre_workbench.macros.macro import Macro
 from pre_workbench.rangetree import RangeTreeWidget
 from pre_workbench.structinfo.parsecontext import AnnotatingParseContext
+from pre_workbench.structinfo.profiler import ParseProfile
 from pre_workbench.typeeditor import JsonView
 from pre_workbench.typeregistry import WindowTypes, DockWidgetTypes
 from pre_workbench.util import PerfTimer, truncate_str
@@ -747,6 +748,79 @@ class SearchDockWidget(QWidget):
 		self.hexview.selectRange(range, True)
 
 
+class _NumericTreeWidgetItem(QTreeWidgetItem):
+	# sorts by the values stored in the UserRole instead of the displayed text
+	def __lt__(self, other):
+		column = self.treeWidget().sortColumn()
+		return self.data(column, QtCore.Qt.UserRole) < other.data(column, QtCore.Qt.UserRole)
+
+
+@DockWidgetTypes.register(title="Parse Profiler", icon="beaker.png", dock="Bottom", showFirstRun=False)
+class ParseProfilerDockWidget(QWidget):
+	"""Shows the statistics per definition or grammar node collected while parsing in the GUI, see structinfo.profiler"""
+	columns = [("name", "Name"), ("calls", "Calls"), ("bytes", "Bytes"), ("total_time", "Total ms"), ("self_time", "Self ms"),
+			   ("exceptions", "Exceptions"), ("alternatives", "Alternatives")]
+
+	def __init__(self):
+		super().__init__()
+		self.profile = ParseProfile()
+		self._initUI()
+
+	def _initUI(self):
+		toolbar = QToolBar()
+		self.recordAction = QAction(getIcon("beaker.png"), "Record", self, triggered=self._setRecording)
+		self.recordAction.setCheckable(True)
+		toolbar.addAction(self.recordAction)
+		toolbar.addAction(getIcon("arrow-circle-double.png"), "Refresh", self._refresh)
+		toolbar.addAction(getIcon("table-reset.png"), "Clear", self._clear)
+		self.viewSelect = QComboBox()
+		self.viewSelect.addItems(["Definitions", "Grammar nodes"])
+		self.viewSelect.currentIndexChanged.connect(self._refresh)
+		toolbar.addWidget(self.viewSelect)
+
+		self.treeView = QTreeWidget()
+		self.treeView.setColumnCount(len(self.columns))
+		self.treeView.setColumnWidth(0, 300)
+		self.treeView.setRootIsDecorated(False)
+		for i, (key, title) in enumerate(self.columns):
+			self.treeView.headerItem().setText(i, title)
+		self.treeView.setSortingEnabled(True)
+		self.treeView.sortByColumn(4, QtCore.Qt.DescendingOrder)
+		windowLayout = QVBoxLayout()
+		windowLayout.addWidget(toolbar)
+		windowLayout.addWidget(self.treeView)
+		windowLayout.setContentsMargins(0,0,0,0)
+		self.setLayout(windowLayout)
+
+	def _setRecording(self, checked):
+		bbuf_parsing.active_profile = self.profile if checked else None
+		self._refresh()
+
+	def _clear(self):
+		self.profile.clear()
+		self._refresh()
+
+	def _refresh(self):
+		self.treeView.clear()
+		fic = pre_workbench.app.CurrentProject.formatInfoContainer
+		rows = self.profile.definition_rows(fic) if self.viewSelect.currentIndex() == 0 else self.profile.node_rows(fic)
+		self.treeView.setSortingEnabled(False)
+		for row in rows:
+			item = _NumericTreeWidgetItem(self.treeView)
+			for i, (key, title) in enumerate(self.columns):
+				value = row[key]
+				item.setData(i, QtCore.Qt.UserRole, value)
+				item.setText(i, "%.3f" % (value * 1000) if key.endswith("_time") else str(value))
+				if i > 0: item.setTextAlignment(i, QtCore.Qt.AlignRight)
+			if 'type' in row: item.setToolTip(0, row['type'])
+		self.treeView.setSortingEnabled(True)
+
+	def saveState(self):
+		return {"hs": self.treeView.header().saveState(), "view": self.viewSelect.currentIndex()}
+
+	def restoreState(self, state):
+		if "view" in state: self.viewSelect.setCurrentIndex(state["view"])
+		if "hs" in state: self.treeView.header().restoreState(state["hs"])
 
 
 class LogWidget(QWidget):
@@ -5,7 +5,8 @@ import struct
 
 from binascii import unhexlify
 
-from pre_workbench.structinfo.parsecontext import FormatInfoContainer, ParseContext
+from pre_workbench.structinfo.compiler import CompiledParseContext
+from pre_workbench.structinfo.parsecontext import FormatInfoContainer, ParseContext, materialize
 
 log = False
 
@@ -19,6 +20,12 @@ def parse_me(definition, hexstring, expected):
 		raise pc.failed
 	print(result)
 	assert result == expected
+	assert CompiledParseContext(fic, unhexlify(hexstring.replace(" ",""))).parse() == expected
+	pc = ParseContext(fic, unhexlify(hexstring.replace(" ","")))
+	pc.memo_limit = 1000
+	assert pc.parse() == expected
+	assert materialize(ParseContext(fic, unhexlify(hexstring.replace(" ","")), zero_copy=True).parse()) == expected
+	assert materialize(CompiledParseContext(fic, unhexlify(hexstring.replace(" ","")), zero_copy=True).parse()) == expected
 
 
 def open_fixture(name, mode="rb"):
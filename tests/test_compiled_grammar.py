@@ -0,0 +1,42 @@
+from binascii import unhexlify
+
+from pre_workbench.structinfo.compiler import CompiledParseContext, generate_python_module, get_compiled_grammar
+from pre_workbench.structinfo.parsecontext import FormatInfoContainer, ParseContext
+from pre_workbench.structinfo.pcap_reader import PcapFormats
+from parse_helper import open_fixture
+
+
+def test_pcap_fixtures():
+	for name in ["test006_le.pcapng", "test006_be.pcapng", "test201.pcapng"]:
+		data = open_fixture(name).read()
+		assert get_compiled_grammar(PcapFormats).get_entry(None) is not None
+		assert CompiledParseContext(PcapFormats, data).parse() == ParseContext(PcapFormats, data).parse()
+
+
+def test_generated_module():
+	fic = FormatInfoContainer(load_from_string="""
+	main struct {
+		len UINT16(endianness=">")
+		items repeat(times=(len)) UINT8
+	}
+	""")
+	ns = {}
+	exec(generate_python_module(fic), ns)
+	assert ns["parse"](unhexlify("0002aabb")) == {"len": 2, "items": [0xaa, 0xbb]}
+
+
+def test_fallback():
+	fic = FormatInfoContainer(load_from_string="""
+	main struct(ignore_errors=true) {
+		a UINT8
+	}
+	""")
+	assert get_compiled_grammar(fic).get_entry(None) is None
+	assert CompiledParseContext(fic, b"\x05").parse() == {"a": 5}
+
+
+def test_invalidate_caches():
+	fic = FormatInfoContainer(load_from_string="main UINT8")
+	assert CompiledParseContext(fic, b"\x05").parse() == 5
+	fic.load_from_string("main UINT16(endianness=\">\")")
+	assert CompiledParseContext(fic, b"\x00\x05").parse() == 5
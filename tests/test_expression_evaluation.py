@@ -0,0 +1,68 @@
+import pytest
+
+from pre_workbench.structinfo.expr import Expression
+from pre_workbench.structinfo.parsecontext import FormatInfoContainer, ParseContext
+
+
+def eval_dict(expr_str, dic=None):
+	return Expression(expr_str=expr_str).evaluate_dict(dic or {})
+
+def test_literals():
+	assert eval_dict("42") == 42
+	assert eval_dict("0x10") == 16
+	assert eval_dict('"foo"') == "foo"
+	assert eval_dict("true") is True
+	assert eval_dict("null") is None
+
+def test_operators():
+	assert eval_dict("2+3*4") == 14
+	assert eval_dict("(2+3)*4") == 20
+	assert eval_dict("1 << 4 | 3") == 19
+	assert eval_dict("7 / 2") == 3.5
+	assert eval_dict("a - 12 >= 4", {"a": 16}) is True
+	assert eval_dict("a == 1 || b != 2", {"a": 0, "b": 2}) is False
+	assert eval_dict("a && b", {"a": 5, "b": 7}) == 7
+
+def test_fields():
+	assert eval_dict("a.b[1]", {"a": {"b": [10, 20]}}) == 20
+	with pytest.raises(Exception, match="field x not found"):
+		eval_dict("x", {"a": 1})
+	with pytest.raises(Exception, match="no member named c"):
+		eval_dict("a.c", {"a": {"b": 1}})
+
+def test_functions():
+	assert eval_dict("len(a)", {"a": b"1234"}) == 4
+	with pytest.raises(Exception, match="unknown function"):
+		eval_dict("nonexisting_fn(1)")
+
+def test_parse_context():
+	pc = ParseContext(FormatInfoContainer(), b"\0" * 8)
+	pc.push(None, {"zzz": 999})
+	pc.push(None, {"yyy": 888})
+	pc.buf_offset = 5
+	pc.push(None, {"a": 1, "dd": {"x": 5}})
+	assert Expression(expr_str="a + dd.x + zzz").evaluate(pc) == 1005
+	assert Expression(expr_str="´´").evaluate(pc) == {"yyy": 888}
+	assert Expression(expr_str="this.a").evaluate(pc) == 1
+	assert Expression(expr_str="pad(4)").evaluate(pc) == 3
+	pc.stack[0].desc = type("desc", (), {"params": {"charset": "ascii"}})()
+	assert Expression(expr_str="$charset").evaluate(pc) == "ascii"
+	assert Expression(expr_str='${"char" + "set"}').evaluate(pc) == "ascii"
+
+def test_compiled_once():
+	expr = Expression(expr_str="a * 2")
+	assert [expr.evaluate_dict({"a": i}) for i in range(3)] == [0, 2, 4]
+	assert Expression(expr_str="(1 + 2) * 4").compiled.constant == 12
+
+
+def test_expression_cache():
+	from pre_workbench.structinfo.expr import ExpressionCache
+	cache = ExpressionCache(maxsize=2)
+	a_tree, a_fn = cache.lookup("a + 1")
+	assert cache.lookup("a + 1") == (a_tree, a_fn)
+	cache.lookup("b")
+	cache.lookup("a + 1")
+	cache.lookup("c")  # evicts "b"
+	assert list(cache.entries) == ["a + 1", "c"]
+	assert cache.stats() == {"hits": 2, "misses": 3, "size": 2, "maxsize": 2}
+	assert Expression(expr_str="pad(4)").compiled is Expression(expr_str="pad(4)").compiled
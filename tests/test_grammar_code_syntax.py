@@ -79,3 +79,33 @@ def test_complex_statement_1():
 	d = parse_definition(code, "anytype")
 	assert_text(d, code)
 
+
+
+def test_lalr_matches_earley():
+	from pre_workbench.structinfo.expr import fi_parser, fi_parser_lalr
+	from pre_workbench.structinfo.pcap_reader import PcapFormats
+	code = PcapFormats.to_text() + """
+
+	expressions struct {
+		a UINT8(value=(f(a, b.c[1]) + $endianness * ´´.x - ${"a" + "b"}))
+		b switch (a) {
+			case (1): UINT8(bbb=true, ccc=null, ddd=[1, "x"], eee={"a": foo})
+		}
+	}
+	"""
+	from pre_workbench.structinfo.parser import transformer
+	def to_text(ast):
+		return "\n".join(str(d.children[1]) + " " + transformer.transform(d.children[2]).to_text() for d in ast.children)
+	assert to_text(fi_parser_lalr.parse(code, start="start")) == to_text(fi_parser.parse(code, start="start"))
+
+
+def test_parse_cache(tmp_path):
+	from pre_workbench.structinfo.pcap_reader import PcapFormats
+	code = PcapFormats.to_text()
+	cache_file = str(tmp_path / "grammar_cache")
+	first = FormatInfoContainer(load_from_string=code, parse_cache_file=cache_file)
+	cached = FormatInfoContainer(load_from_string=code, parse_cache_file=cache_file)
+	assert cached.to_text() == first.to_text() == code
+	assert cached.main_name == "pcap_file"
+	changed = FormatInfoContainer(load_from_string="DEFAULT UINT8", parse_cache_file=cache_file)
+	assert changed.to_text() == "DEFAULT UINT8"
@@ -1,3 +1,4 @@
+import gc
 import uuid
 
 import pytest
@@ -254,3 +255,287 @@ def test_custom_values():
 		 }
 	)
 
+
+
+def test_fixed_layout_struct():
+	parse_me("""
+		DEFAULT repeat struct(endianness="<") {
+				flag BOOLEAN
+				a INT8
+				b UINT16(show="0x%04x")
+				c INT32
+				d DOUBLE
+			}
+		""",
+		"01 ff 3412 feffffff 000000000000f03f  00 01 0100 01000000 0000000000000040",
+		[
+			{'flag': True, 'a': -1, 'b': 0x1234, 'c': -2, 'd': 1.0},
+			{'flag': False, 'a': 1, 'b': 1, 'c': 1, 'd': 2.0},
+		]
+	)
+
+
+def test_fixed_layout_struct_ranges():
+	from binascii import unhexlify
+	from pre_workbench.structinfo.parsecontext import FormatInfoContainer, AnnotatingParseContext
+	fic = FormatInfoContainer(load_from_string="""
+		DEFAULT struct(endianness=">") {
+			a UINT8
+			b UINT32(color="red")
+		}
+		""")
+	assert fic.definitions["DEFAULT"].fi.fixed_format == "BL"
+	result = AnnotatingParseContext(fic, unhexlify("0100000002")).parse()
+	a, b = result.value["a"], result.value["b"]
+	assert (a.start, a.end, a.value, a.metadata["name"]) == (0, 1, 1, "DEFAULT.a")
+	assert (b.start, b.end, b.value, b.metadata["color"]) == (1, 5, 2, "red")
+
+
+def test_zero_copy_views():
+	from pre_workbench.structinfo.parsecontext import FormatInfoContainer, ParseContext, materialize
+	fic = FormatInfoContainer(load_from_string="""
+		DEFAULT struct(charset="ascii") {
+			len UINT8
+			name STRING[len]
+			payload BYTES[len](parse_with=inner)
+			rest BYTES
+		}
+		inner struct {
+			first UINT8
+			data BYTES
+		}
+		""")
+	data = bytearray(b"\x02ab\x01\x02xyz")
+	result = ParseContext(fic, data, zero_copy=True).parse()
+	assert isinstance(result["rest"], memoryview) and isinstance(result["payload"]["data"], memoryview)
+	data[-1] = ord("Z")  # views share memory with the buffer
+	assert materialize(result) == {'len': 2, 'name': 'ab', 'payload': {'first': 1, 'data': b"\x02"}, 'rest': b"xyZ"}
+
+
+def test_inherited_params():
+	parse_me("""
+		DEFAULT struct(endianness=">") {
+			a sub
+			b sub(endianness="<")
+			c struct(endianness="<") {
+				x sub
+				y UINT16(endianness=">")
+			}
+		}
+
+		sub struct {
+			v UINT16
+		}
+		""",
+		"0001 0100 0100 0001",
+		{'a': {'v': 1}, 'b': {'v': 1}, 'c': {'x': {'v': 1}, 'y': 1}}
+	)
+
+
+def test_inherited_params_update():
+	from pre_workbench.structinfo.parsecontext import FormatInfoContainer, ParseContext
+	fic = FormatInfoContainer(load_from_string="""
+		DEFAULT struct(endianness=">") {
+			v UINT16
+		}
+		""")
+	assert ParseContext(fic, b"\x00\x01").parse() == {'v': 1}
+	fic.definitions["DEFAULT"].updateParams(endianness="<")
+	assert ParseContext(fic, b"\x00\x01").parse() == {'v': 256}
+
+
+def test_lazy_repeat():
+	from pre_workbench.structinfo.parsecontext import FormatInfoContainer, ParseContext, AnnotatingParseContext, LazyRepeatList
+	fic = FormatInfoContainer(load_from_string="""
+		DEFAULT struct(endianness=">") {
+			count UINT8
+			items repeat(times=(count)) entry
+			third UINT16(value=(items[2].b))
+			rest repeat UINT8
+		}
+		entry struct {
+			a UINT8
+			b UINT16
+		}
+		""")
+	data = bytes([4]) + b"".join(bytes([i, 0, i * 2]) for i in range(4)) + b"\x07\x08\x09\x0a"
+	eager = ParseContext(fic, data).parse()
+
+	pc = ParseContext(fic, data)
+	pc.lazy_repeat_threshold = 2
+	pc.lazy_cache_size = 2
+	lazy = pc.parse()
+	assert not pc.failed
+	assert isinstance(lazy["items"], LazyRepeatList) and isinstance(lazy["rest"], LazyRepeatList)
+	assert lazy["third"] == 4
+	assert lazy == eager
+	assert lazy["items"][-1] == {'a': 3, 'b': 6} and lazy["items"][1:3] == eager["items"][1:3]
+	assert len(lazy["items"].cache) == 2
+
+	apc = AnnotatingParseContext(fic, data)
+	apc.lazy_repeat_threshold = 2
+	item = apc.parse().value["items"].value[1]
+	assert (item.start, item.end, item.metadata["name"]) == (4, 7, "DEFAULT.items.[1/4]")
+
+
+def test_vectorized_repeat(monkeypatch):
+	numpy = pytest.importorskip("numpy")
+	from pre_workbench.structinfo import format_info
+	from pre_workbench.structinfo.parsecontext import FormatInfoContainer, ParseContext, RecordArray
+	fic = FormatInfoContainer(load_from_string="""
+		DEFAULT struct(endianness=">") {
+			count UINT8
+			items repeat(times=(count)) entry(endianness="<")
+			last INT16(value=(items[1].b + 1))
+		}
+		entry struct {
+			a INT8
+			b UINT16
+			c DOUBLE
+		}
+		""")
+	data = b"\x02" + b"\xff\x01\x00" + bytes(8) + b"\x07\x02\x00" + bytes(8) + b"\x00\x00"
+	eager = ParseContext(fic, data).parse()
+
+	pc = ParseContext(fic, data)
+	pc.vectorize_repeats = True
+	result = pc.parse()
+	assert isinstance(result["items"], RecordArray)
+	assert result == eager and result["last"] == 3
+	assert list(result["items"]["b"]) == [1, 2] and result["items"]["b"].dtype == numpy.dtype("<u2")
+
+	monkeypatch.setattr(format_info, "numpy", None)
+	pc = ParseContext(fic, data)
+	pc.vectorize_repeats = True
+	assert type(pc.parse()["items"]) == list
+
+
+def test_used_definitions():
+	from pre_workbench.structinfo.parsecontext import FormatInfoContainer, ParseContext
+	text = """
+		packet struct { type UINT8 body variant { ipv4 ipv6 } }
+		ipv4 struct { version UINT8(magic=4) }
+		ipv6 struct { version UINT8(magic=6) }
+		other UINT8
+		"""
+	fic = FormatInfoContainer(load_from_string=text)
+	pc = ParseContext(fic, b"\x00\x04")
+	pc.parse()
+	# ipv6 is skipped by the magic dispatch, but changing it might change the result
+	assert pc.used_definitions == {"packet", "ipv4", "ipv6"}
+	snapshot = fic.snapshot_definitions(pc.used_definitions)
+	assert not fic.definitions_changed(snapshot)
+
+	# unchanged definitions keep their objects when the text is loaded again
+	fic.load_from_string(text.replace("other UINT8", "other UINT16"))
+	assert not fic.definitions_changed(snapshot)
+	fic.definitions["ipv4"].fi.children[0][1].updateParams(magic=5)
+	fic.invalidate_caches()
+	assert fic.definitions_changed(snapshot)
+
+
+def test_used_definitions_skipped_variant():
+	from pre_workbench.structinfo.parsecontext import FormatInfoContainer, ParseContext
+	text = """
+		packet struct { body variant { ipv4 ipv6 } }
+		ipv4 struct { header ipv4_header }
+		ipv4_header struct { version UINT8(magic=4) }
+		ipv6 struct { version UINT8(magic=6) }
+		"""
+	fic = FormatInfoContainer(load_from_string=text)
+	pc = ParseContext(fic, b"\x06")
+	assert pc.parse() == {"body": {"version": 6}}
+	assert pc.used_definitions == {"packet", "ipv4", "ipv4_header", "ipv6"}
+	snapshot = fic.snapshot_definitions(pc.used_definitions)
+
+	# ipv4 matches now, and is tried first
+	fic.load_from_string(text.replace("magic=4", "magic=6"))
+	assert fic.definitions_changed(snapshot)
+	pc = ParseContext(fic, b"\x06")
+	assert pc.parse() == {"body": {"header": {"version": 6}}}
+
+
+def test_switch_dispatch():
+	parse_me("""
+		DEFAULT repeat message
+		
+		message struct {
+			type UINT8
+			limit UINT8
+			value switch (type) {
+				case (1): UINT8
+				case (limit): UINT16(endianness=">")
+				case (2): INT8
+				case (1): STRING[1](charset="ascii")
+			}
+		}
+		""",
+		"01 05 ff  02 02 0102  02 05 ff  03 05",
+		[
+			{'type': 1, 'limit': 5, 'value': 255},
+			{'type': 2, 'limit': 2, 'value': 258},
+			{'type': 2, 'limit': 5, 'value': -1},
+			{'type': 3, 'limit': 5, 'value': None},
+		]
+	)
+
+
+def test_lazy_range_metadata():
+	from pre_workbench.structinfo.parsecontext import FormatInfoContainer, AnnotatingParseContext
+	fic = FormatInfoContainer(load_from_string="""
+		DEFAULT struct(endianness=">") {
+			len UINT8
+			data BYTES[len](color="red", label=(len * 2))
+			tail UINT16(show="hex")
+		}
+		""")
+	result = AnnotatingParseContext(fic, bytes([2, 0xaa, 0xbb, 0, 7])).parse()
+	data = result.value["data"]
+	assert data.matches(hasMetaKey="_sdef_ref", start=1)
+	assert data.metadata == {'_sdef_ref': fic.definitions["DEFAULT"].fi.children[1][1], 'name': 'DEFAULT.data',
+							 'pos': 1, 'size': 2, 'show': str(b"\xaa\xbb"), 'format_type': 'BYTES', 'color': 'red', 'label': 4}
+	assert result.value["tail"].metadata["show"] == "hex"
+
+
+def test_lazy_range_metadata_expressions():
+	from pre_workbench.structinfo.parsecontext import FormatInfoContainer, AnnotatingParseContext, stack_frame
+	fic = FormatInfoContainer(load_from_string="""
+		DEFAULT struct(factor=3) {
+			len UINT8
+			inner inner
+			tail UINT8
+		}
+		inner struct(factor=5) {
+			x UINT8(label=(len * $factor), next=(tail))
+		}
+		""")
+	result = AnnotatingParseContext(fic, bytes([2, 1, 9])).parse()
+	x = result.value["inner"].value.value["x"]
+	# the expressions are evaluated on first access, the loader doesn't keep the parse stack
+	assert not any(isinstance(o, stack_frame) for o in gc.get_referents(*gc.get_referents(x)))
+	assert (x.metadata["name"], x.metadata["label"], x.metadata["next"]) == ("DEFAULT.inner.inner.x", 10, 9)
+
+
+def test_bit_fields():
+	parse_me("""
+		DEFAULT struct {
+			be bits(endianness=">") {
+				a :  3
+				b :  9
+				c :  4
+			}
+			le bits(endianness="<") {
+				a :  3
+				b :  9
+				c :  4
+			}
+		}
+		""",
+		"a5 c3  c3 a5",
+		{'be': {'a': 5, 'b': 0x5c, 'c': 3}, 'le': {'a': 5, 'b': 0x5c, 'c': 3}}
+	)
+	from pre_workbench.structinfo.parsecontext import FormatInfoContainer, AnnotatingParseContext
+	fic = FormatInfoContainer(load_from_string="DEFAULT bits(endianness=\">\") { a : 3 b : 9 c : 4 }")
+	result = AnnotatingParseContext(fic, bytes.fromhex("a5c3")).parse().value
+	assert [(r.start, r.metadata["print"]) for r in result.values()] == [
+		(0, "101.............  a = 5"), (0, "...001011100....  b = 92"), (1, "............0011  c = 3")]
@@ -68,3 +68,61 @@ def test_variant_reset_offset_2():
 		 'dummy': 1,
 		 'magic_number': 0xA1B2C3D4
 	 })
+
+
+def test_variant_memo():
+	from pre_workbench.structinfo.parsecontext import FormatInfoContainer, ParseContext
+	fic = FormatInfoContainer(load_from_string="""
+		DEFAULT struct {
+			len UINT8
+			body variant {
+				struct(endianness=">") { h header  t UINT8(magic=1) }
+				struct(endianness=">") { h header  t UINT8(magic=2) }
+				struct(endianness="<") { h header  t UINT8(magic=3) }
+				struct(endianness="<") { h header  t UINT8(magic=4) }
+			}
+		}
+		header struct {
+			v UINT16
+			data BYTES[len]
+		}
+		""")
+	data = bytes.fromhex("02 0102 aaaa 04")
+	expected = ParseContext(fic, data).parse()
+	assert expected["body"] == {"h": {"v": 0x0201, "data": b"\xaa\xaa"}, "t": 4}
+	pc = ParseContext(fic, data)
+	pc.memo_limit = 100
+	assert pc.parse() == expected
+	# header is parsed once per endianness, the field len from outside doesn't change
+	assert pc.memo_hits == 2
+
+	pc = ParseContext(fic, bytes.fromhex("02 0102 aaaa 05"))
+	pc.memo_limit = 100
+	pc.log_failures = False
+	pc.parse()
+	assert isinstance(pc.failed, invalid) and pc.memo_hits == 2
+
+
+def test_variant_magic_dispatch():
+	from pre_workbench.structinfo.parsecontext import FormatInfoContainer, ParseContext
+	fic = FormatInfoContainer(load_from_string="""
+		DEFAULT variant(endianness=">") {
+			struct { type UINT16(magic=1) value UINT8 }
+			struct(endianness="<") { type UINT16(magic=2) value UINT8 }
+			tlv3
+			struct { type UINT16 value UINT8 }
+		}
+		tlv3 struct { type UINT16(magic=3) value UINT16 }
+		""")
+	always, tables, names = fic.definitions["DEFAULT"].fi._build_dispatch(ParseContext(fic))
+	assert always == [3] and names == ["tlv3"]
+	assert tables == {(0, 2, 'H', None): {1: [0], 3: [2]}, (0, 2, 'H', '<'): {2: [1]}}
+	assert ParseContext(fic, bytes.fromhex("0001 05")).parse() == {'type': 1, 'value': 5}
+	assert ParseContext(fic, bytes.fromhex("0200 05")).parse() == {'type': 2, 'value': 5}
+	assert ParseContext(fic, bytes.fromhex("0003 0005")).parse() == {'type': 3, 'value': 5}
+	assert ParseContext(fic, bytes.fromhex("0004 05")).parse() == {'type': 4, 'value': 5}
+	# the bytes of the magic value are missing, the first child fails as incomplete
+	pc = ParseContext(fic, bytes.fromhex("00"))
+	pc.log_failures = False
+	pc.parse()
+	assert isinstance(pc.failed, incomplete)
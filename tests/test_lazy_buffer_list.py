@@ -0,0 +1,74 @@
+import gc
+
+from pre_workbench.objects import ByteBuffer, ByteBufferList, LazyByteBufferList
+from pre_workbench.structinfo.pcap_index import PcapIndex, PcapPacketReader
+from parse_helper import open_fixture
+
+
+def test_lazy_buffer_list():
+	created = []
+	def provider(i):
+		created.append(i)
+		return ByteBuffer(i.to_bytes(2, "big"), metadata={'i': i})
+	plist = LazyByteBufferList(provider, 1000, cache_size=2)
+	loaded = []
+	plist.buffers.on_load = lambda bbuf: loaded.append(bbuf.metadata['i'])
+	new_packets = []
+	plist.on_new_packet.connect(new_packets.append)
+
+	assert len(plist) == 1000 and created == []
+	assert plist[5].buffer == b"\x00\x05" and plist.buffers[-1].metadata == {'i': 999}
+	assert plist[5] is plist.buffers[5] and created == [5, 999]
+	assert loaded == [5, 999]
+
+	# buffer 0 stays pinned, buffer 1 is dropped from the cache
+	plist[0].metadata['marked'] = True
+	plist.pin(0)
+	plist[1].metadata['marked'] = True
+	plist[2], plist[3]
+	gc.collect()
+	assert plist[0].metadata['marked'] and 'marked' not in plist[1].metadata
+	assert created.count(1) == 2 and created.count(0) == 1
+
+	plist.add(ByteBuffer(b"new"))
+	assert len(plist) == 1001 and plist[1000].buffer == b"new" and new_packets == [1]
+	assert [bbuf.buffer for bbuf in plist.buffers[998:]] == [b"\x03\xe6", b"\x03\xe7", b"new"]
+	assert plist.getAllKeys(fieldKeys=False) == {'i', 'marked'}
+
+
+def test_lazy_pcap_list(tmp_path):
+	file_name = str(tmp_path / "test.pcapng")
+	with open_fixture("test201.pcapng") as f, open(file_name, "wb") as out:
+		out.write(f.read())
+	reader = PcapPacketReader(file_name, PcapIndex.for_file(file_name, sidecar=False))
+	plist = LazyByteBufferList(reader, len(reader))
+	assert len(plist) == 4 and [bbuf.metadata["orig_length"] for bbuf in plist.buffers] == [314, 342, 314, 168]
+	plist.close()
+	assert reader.data.closed
+
+
+def test_remove_oldest():
+	plist = ByteBufferList()
+	events = []
+	plist.on_removing_packets.connect(lambda count: events.append(("removing", count, len(plist))))
+	plist.on_removed_packets.connect(lambda count: events.append(("removed", count, len(plist))))
+	for i in range(5):
+		plist.add(ByteBuffer(bytes([i])))
+	plist.removeOldest(3)
+	plist.removeOldest(0)
+	assert [bbuf.buffer for bbuf in plist.buffers] == [b"\x03", b"\x04"]
+	assert events == [("removing", 3, 5), ("removed", 3, 2)]
+
+
+def test_remove_oldest_lazy():
+	plist = LazyByteBufferList(lambda i: ByteBuffer(i.to_bytes(2, "big")), 5, cache_size=2)
+	plist[1].metadata['marked'] = True
+	plist.pin(1)
+	plist[3].metadata['marked'] = True
+	plist.pin(3)
+	plist.add(ByteBuffer(b"new"))
+	plist.removeOldest(2)
+	assert len(plist) == 4 and plist[0].buffer == b"\x00\x02" and plist[-1].buffer == b"new"
+	assert plist[1].metadata == {'marked': True} and list(plist.buffers.pinned) == [3]
+	plist.removeOldest(4)
+	assert len(plist) == 0 and plist.buffers.pinned == {}
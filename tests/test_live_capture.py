@@ -0,0 +1,179 @@
+import socket
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("appdirs")
+
+from PyQt5.QtCore import QCoreApplication
+
+from pre_workbench import app, configs, datasource
+from pre_workbench.datasource import UdpListenerDataSource, LivePcapCaptureDataSource, kernelDropCount, SO_RXQ_OVFL
+from pre_workbench.structinfo.parsecontext import FormatInfoContainer
+
+
+@pytest.fixture
+def qapp():
+	return QCoreApplication.instance() or QCoreApplication([])
+
+
+def wait_for(condition, timeout=5):
+	end = time.monotonic() + timeout
+	while not condition():
+		if time.monotonic() > end: raise TimeoutError()
+		time.sleep(0.01)
+
+
+def start_listener(params):
+	ds = UdpListenerDataSource(dict({"bind_address": "127.0.0.1", "bind_port": 0}, **params))
+	plist = ds.startFetch()
+	# the timer isn't run without an event loop, the tests flush the queue themselves
+	ds.timer.stop()
+	sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	sender.connect(ds.socket.getsockname())
+	return ds, plist, sender
+
+
+def stop_listener(ds, sender):
+	sender.close()
+	ds.cancelFetch()
+	wait_for(lambda: ds.finished)
+
+
+def test_udp_listener(qapp):
+	ds, plist, sender = start_listener({})
+	added = []
+	plist.on_new_packet.connect(added.append)
+	for i in range(100):
+		sender.send(b"packet %d" % i)
+	wait_for(lambda: ds.stats.packets == 100)
+	ds._flushQueue()
+	assert [bbuf.buffer for bbuf in plist.buffers] == [b"packet %d" % i for i in range(100)]
+	assert plist[0].metadata['source'] == "%s:%d" % sender.getsockname()
+	# one update of the list per flush
+	assert added == [100]
+	stats = plist.metadata['captureStats']
+	assert stats['packets'] == 100 and stats['bytes'] == sum(len(b"packet %d" % i) for i in range(100))
+	assert stats['dropped'] == 0 and stats['evicted'] == 0
+
+	finished = []
+	ds.on_finished.connect(lambda: finished.append(True))
+	stop_listener(ds, sender)
+	ds._flushQueue()
+	assert finished == [True]
+
+
+def test_udp_listener_retention(qapp):
+	ds, plist, sender = start_listener({"retention": 3})
+	for i in range(5):
+		sender.send(bytes([i]))
+	wait_for(lambda: ds.stats.packets == 5)
+	ds._flushQueue()
+	assert [bbuf.buffer for bbuf in plist.buffers] == [b"\x02", b"\x03", b"\x04"] and ds.stats.evicted == 2
+
+	removed = []
+	plist.on_removed_packets.connect(removed.append)
+	for i in range(5, 7):
+		sender.send(bytes([i]))
+	wait_for(lambda: ds.stats.packets == 7)
+	ds._flushQueue()
+	assert [bbuf.buffer for bbuf in plist.buffers] == [b"\x04", b"\x05", b"\x06"] and removed == [2]
+	assert plist.metadata['captureStats']['evicted'] == 4
+	stop_listener(ds, sender)
+
+
+def test_udp_listener_max_pending(qapp, monkeypatch):
+	monkeypatch.setitem(configs.configDict, "DataSources.live.maxPending", 2)
+	ds, plist, sender = start_listener({})
+	for i in range(5):
+		sender.send(bytes([i]))
+	wait_for(lambda: ds.stats.packets == 5)
+	ds._flushQueue()
+	assert [bbuf.buffer for bbuf in plist.buffers] == [b"\x00", b"\x01"]
+	assert plist.metadata['captureStats']['dropped'] == 3 and ds.stats.kernelDropped == 0
+	stop_listener(ds, sender)
+
+
+def test_udp_listener_grammar(qapp, monkeypatch):
+	fic = FormatInfoContainer(load_from_string="packet struct { type UINT8 value UINT8 }")
+	monkeypatch.setattr(datasource, "APP", lambda: SimpleNamespace(project=SimpleNamespace(formatInfoContainer=fic)))
+	monkeypatch.setattr(app, "CurrentProject", SimpleNamespace(formatInfoContainer=fic), raising=False)
+	ds, plist, sender = start_listener({"formatInfo": "packet"})
+	# the parser thread uses the definitions from startFetch
+	fic.load_from_string("packet struct { type UINT16 }")
+	sender.send(b"\x01\x02")
+	wait_for(lambda: len(ds.queue) == 1)
+	ds._flushQueue()
+	assert plist[0].fi_tree.value["value"].value == 2 and plist[0].fi_container is not fic
+	stop_listener(ds, sender)
+
+
+def test_udp_listener_close(qapp, monkeypatch):
+	fic = FormatInfoContainer(load_from_string="packet struct { type UINT8 }")
+	monkeypatch.setattr(datasource, "APP", lambda: SimpleNamespace(project=SimpleNamespace(formatInfoContainer=fic)))
+	monkeypatch.setattr(app, "CurrentProject", SimpleNamespace(formatInfoContainer=fic), raising=False)
+	ds, plist, sender = start_listener({"formatInfo": "packet"})
+	ds.timer.start(1000)
+	ds.close()
+	# the receiver and the parser thread end, the timer is stopped
+	wait_for(lambda: ds.finished and not any(t.name.startswith("UdpListener") for t in threading.enumerate()))
+	assert not ds.timer.isActive()
+	sender.close()
+
+
+def test_udp_listener_reload(qapp):
+	ds, plist, sender = start_listener({})
+	port = ds.socket.getsockname()[1]
+	ds.close()
+	# like ObjectWindow.reload, the new source binds the same port right after closing the old one
+	ds = UdpListenerDataSource({"bind_address": "127.0.0.1", "bind_port": port})
+	plist = ds.startFetch()
+	ds.timer.stop()
+	sender.send(b"again")
+	wait_for(lambda: ds.stats.packets == 1)
+	ds._flushQueue()
+	assert plist[0].buffer == b"again"
+	stop_listener(ds, sender)
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="needs a POSIX shell")
+def test_pcap_capture_close(qapp):
+	ds = LivePcapCaptureDataSource({"shell_cmd": "sleep 60"})
+	ds.startFetch()
+	ds.close()
+	# the command is killed and the reader thread ends
+	assert ds.process.poll() is not None
+	wait_for(lambda: ds.finished)
+	assert not ds.timer.isActive()
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="SO_RXQ_OVFL is Linux only")
+def test_kernel_drop_count():
+	receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+	receiver.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+	receiver.bind(("127.0.0.1", 0))
+	sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	sender.connect(receiver.getsockname())
+	sender.send(b"first")
+	assert kernelDropCount(receiver.recvmsg(100, 64)[1]) is None
+
+	# overflow the receive buffer, only datagrams queued after the drops carry the count
+	for i in range(1000):
+		sender.send(bytes(100))
+	receiver.setblocking(False)
+	queued = 0
+	try:
+		while True:
+			assert kernelDropCount(receiver.recvmsg(100, 64)[1]) is None
+			queued += 1
+	except BlockingIOError:
+		pass
+	sender.send(b"last")
+	data, ancdata, flags, address = receiver.recvmsg(100, 64)
+	assert data == b"last" and 0 < queued < 1000 and kernelDropCount(ancdata) == 1000 - queued
+	receiver.close()
+	sender.close()
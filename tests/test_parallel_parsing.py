@@ -0,0 +1,168 @@
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from pre_workbench.algo.range import Range
+from pre_workbench.objects import ByteBuffer
+from pre_workbench.structinfo.exceptions import invalid
+from pre_workbench.structinfo import xdrm, parsecontext
+from pre_workbench.structinfo.parallel import init_parse_worker, parse_batch, decode_batch, index_format_infos, \
+	pickle_definitions, parallel_parsing_supported, dump_parse_result, load_parse_result, load_batch
+from pre_workbench.structinfo.parsecontext import FormatInfoContainer, AnnotatingParseContext, _load_range_metadata
+
+fic = FormatInfoContainer(load_from_string="""
+	packet struct(endianness=">") {
+		magic UINT8(magic=0x42, color="red")
+		flags bits {
+			a : 4
+			b : 4
+		}
+		time ABSOLUTE_TIME[4](unit="s")
+		big UINT64
+		items repeat(times=(2)) item
+	}
+	item variant {
+		struct { type UINT8(magic=1) value INT16 }
+		struct { type UINT8 text STRING[2](charset="ascii") }
+	}
+	""")
+
+payloads = [
+	b"\x42\x12\x00\x00\x00\x10\xff\xff\xff\xff\xff\xff\xff\xff\x01\xff\xfe\x02ab",
+	b"\x42\x34\x00\x00\x00\x20\x00\x00\x00\x00\x00\x00\x00\x01\x01\x00",
+	b"\x41",
+]
+
+
+def flatten(r):
+	values = r.value.values() if type(r.value) == dict else r.value if type(r.value) == list else [r.value]
+	children = [flatten(v) for v in values if type(v) == Range]
+	value = r.value if not children else None
+	return (r.start, r.end, r.field_name, r.source_desc, value, dict(r.metadata), str(r.exception), children)
+
+
+def check_results(data):
+	results = decode_batch(data, index_format_infos(fic), payloads)
+	assert len(results) == len(payloads)
+	for payload, (fi_tree, ranges, failed) in zip(payloads, results):
+		ctx = AnnotatingParseContext(fic, payload)
+		ctx.log_failures = False
+		expected = ctx.parse()
+		assert flatten(fi_tree) == flatten(expected)
+		assert fi_tree in ranges and all(type(r) == Range for r in ranges)
+		assert str(failed) == str(ctx.failed) and type(failed) == type(ctx.failed)
+	assert isinstance(results[2][2], invalid) and results[2][0].value["magic"].exception.offset == 0
+
+
+def test_parse_batch():
+	assert parallel_parsing_supported(fic)
+	init_parse_worker(pickle_definitions(fic))
+	check_results(parse_batch("packet", payloads))
+
+
+def test_native_values_only():
+	def serialized(x):
+		children = x.values() if type(x) == dict else x if type(x) == list else ()
+		return type(x) == tuple or any(serialized(y) for y in children)
+	init_parse_worker(pickle_definitions(fic))
+	for tree_data, failed in xdrm.loads(parse_batch("packet", payloads), enable_deserialize=False):
+		assert not serialized(failed) and not serialized(xdrm.loads(tree_data, enable_deserialize=False))
+
+	ctx = AnnotatingParseContext(fic, payloads[0])
+	fi_tree = ctx.parse()
+	fi_tree.metadata["unsupported"] = {1, 2}
+	assert dump_parse_result(fic, "packet", payloads[0], fi_tree, None) is None
+
+
+def test_pending_results():
+	init_parse_worker(pickle_definitions(fic))
+	bbuf = ByteBuffer(payloads[0])
+	other = bbuf.addRange(Range(0, 1, meta={'color': 'red'}))
+	(load, failed), = load_batch(parse_batch("packet", payloads[:1]), index_format_infos(fic), payloads[:1])
+	bbuf.setPendingResult(load)
+	assert bbuf._fi_tree is None
+	expected = AnnotatingParseContext(fic, payloads[0]).parse()
+	assert flatten(bbuf.fi_tree) == flatten(expected) and bbuf.fi_tree in bbuf.ranges and other in bbuf.ranges
+	assert bbuf.fields["packet.magic"].value == 0x42
+
+
+def test_pending_results_benchmark():
+	# attaching the results to the buffers must be much faster than decoding them, or the GUI process spends as
+	# much time on them as parsing the buffers itself
+	init_parse_worker(pickle_definitions(fic))
+	batch = [payloads[0]] * 500
+	data = parse_batch("packet", batch)
+	descs = index_format_infos(fic)
+
+	start = time.perf_counter()
+	for bbuf, (fi_tree, ranges, failed) in zip(map(ByteBuffer, batch), decode_batch(data, descs, batch)):
+		bbuf.setRanges(ranges)
+		bbuf.fi_tree = fi_tree
+	decode_time = time.perf_counter() - start
+
+	start = time.perf_counter()
+	for bbuf, (load, failed) in zip(map(ByteBuffer, batch), load_batch(data, descs, batch)):
+		bbuf.setPendingResult(load)
+	pending_time = time.perf_counter() - start
+	assert pending_time * 3 < decode_time
+
+
+def test_process_pool():
+	with ProcessPoolExecutor(1, multiprocessing.get_context("spawn"),
+							 initializer=init_parse_worker, initargs=(pickle_definitions(fic),)) as executor:
+		check_results(executor.submit(parse_batch, "packet", payloads).result())
+
+
+def test_unsupported_params():
+	assert not parallel_parsing_supported(FormatInfoContainer(load_from_string="""
+		packet struct {
+			payload BYTES(store_into=("payloads"))
+		}
+		"""))
+
+
+def test_parse_result_cache_format():
+	for payload in payloads:
+		ctx = AnnotatingParseContext(fic, payload)
+		ctx.log_failures = False
+		expected = ctx.parse()
+		fi_tree, ranges, failed = load_parse_result(fic, "packet", payload, dump_parse_result(fic, "packet", payload, expected, ctx.failed))
+		assert flatten(fi_tree) == flatten(expected)
+		assert str(failed) == str(ctx.failed)
+
+
+def test_parse_result_cache_keeps_metadata_lazy(monkeypatch):
+	loaded = []
+	def load_range_metadata(range, metadata, state):
+		loaded.append(range.field_name)
+		_load_range_metadata(range, metadata, state)
+	monkeypatch.setattr(parsecontext, "_load_range_metadata", load_range_metadata)
+	ctx = AnnotatingParseContext(fic, payloads[0])
+	expected = ctx.parse()
+	data = dump_parse_result(fic, "packet", payloads[0], expected, ctx.failed)
+	assert loaded == []
+	fi_tree, ranges, failed = load_parse_result(fic, "packet", payloads[0], data)
+	assert flatten(fi_tree) == flatten(expected)
+
+
+def test_parse_result_cache_rejects_objects():
+	class Foreign:
+		class_id = 0x1001
+		def __serialize__(self):
+			return b"pickled data"
+	data = xdrm.dumps([None, Foreign()])
+	with pytest.raises(Exception, match="class id 0x1001"):
+		load_parse_result(fic, "packet", payloads[0], data)
+
+
+def test_definition_hash():
+	def hashes(text):
+		c = FormatInfoContainer(load_from_string=text)
+		return c.reachable_definitions("a"), c.definition_hash("a")
+	names, h = hashes("a struct { x b } b UINT8 c UINT16")
+	assert names == ["a", "b"]
+	assert hashes("a struct { x b } b UINT8 c UINT32")[1] == h
+	assert hashes("a struct { x b } b UINT16 c UINT16")[1] != h
+	assert hashes("a struct { x b } b variant { UINT8 } c UINT16")[1] != h
@@ -0,0 +1,29 @@
+from pre_workbench.structinfo.parsecontext import FormatInfoContainer, ParseContext, AnnotatingParseContext
+from pre_workbench.structinfo.profiler import ParseProfile
+
+fic = FormatInfoContainer(load_from_string="""
+	DEFAULT repeat message
+	message variant {
+		struct { type UINT8(magic=1) value UINT8 }
+		struct { type UINT8 len UINT8 data BYTES[len] end UINT8(magic=0xff) }
+		struct { type UINT8 rest BYTES[1] }
+	}
+	""")
+
+
+def test_profile():
+	profile = ParseProfile()
+	for context_class in (ParseContext, AnnotatingParseContext):
+		pc = context_class(fic, bytes.fromhex("0300 0105 0201aaff"))
+		pc.profile = profile
+		pc.parse()
+	nodes = {row['name']: row for row in profile.node_rows(fic)}
+	assert nodes['message']['calls'] == 6 and nodes['message']['bytes'] == 16
+	assert nodes['message']['alternatives'] == 8
+	assert nodes['message[1].end']['exceptions'] == 2 and nodes['message[1].end']['bytes'] == 2
+	assert nodes['message[2].rest']['calls'] == 2 and nodes['message[2].rest']['type'] == 'FieldFI'
+	assert nodes['DEFAULT']['total_time'] >= nodes['message']['total_time'] >= nodes['message']['self_time'] > 0
+
+	definitions = {row['name']: row for row in profile.definition_rows(fic)}
+	assert definitions['message']['calls'] == 6 and definitions['message']['exceptions'] == 2
+	assert abs(definitions['message']['self_time'] - sum(row['self_time'] for row in nodes.values() if row['definition'] == 'message')) < 1e-9
@@ -1,10 +1,14 @@
+import io
 import logging
 import os.path
+import struct
 
 # sample files from https://github.com/hadrielk/pcapng-test-generator
 
-from pre_workbench.structinfo.pcap_reader import read_pcap_file
-from parse_helper import open_fixture
+from pre_workbench.objects import ByteBuffer, ByteBufferList
+from pre_workbench.structinfo.pcap_index import PcapIndex, INDEX_SUFFIX
+from pre_workbench.structinfo.pcap_reader import read_pcap_file, iter_pcap_data, PcapStreamDecoder
+from parse_helper import open_fixture, make_pcap
 
 def test_load_pcapng_le():
 	"""
@@ -60,3 +64,81 @@ def test_load_pcapng_difficult_be():
 	assert len(result.metadata['interfaces']) == 5 # file contains 5 IDB blocks
 
 
+
+
+def test_load_pcap():
+	lst = ByteBufferList()
+	for payload in (b"\x01\x02\x03", b"", b"\xff" * 100):
+		lst.add(ByteBuffer(payload))
+	filename = make_pcap(1, lst)
+	try:
+		with open(filename, "rb") as f:
+			result = read_pcap_file(f)
+	finally:
+		os.unlink(filename)
+	assert [bbuf.buffer for bbuf in result.buffers] == [bbuf.buffer for bbuf in lst.buffers]
+	assert result.buffers[2].metadata == {'ts_sec': 0, 'ts_usec': 0, 'incl_len': 100, 'orig_len': 100}
+	assert result.metadata['encap_proto'] == 1 and result.metadata['snaplen'] == 65535
+
+
+def test_load_pcap_be_truncated():
+	data = struct.pack(">IHHiIII", 0xa1b2c3d4, 2, 4, 0, 0, 65535, 101) \
+		+ struct.pack(">IIII", 1, 2, 2, 60) + b"ab" \
+		+ struct.pack(">IIII", 3, 4, 10, 10) + b"cut off"
+	metadata = {}
+	packets = list(iter_pcap_data(data, metadata))
+	assert len(packets) == 1 and packets[0].buffer == b"ab"
+	assert packets[0].metadata == {'ts_sec': 1, 'ts_usec': 2, 'incl_len': 2, 'orig_len': 60}
+	assert metadata['encap_proto'] == 101
+	# files without fileno
+	assert len(read_pcap_file(io.BytesIO(data))) == 1
+
+
+def test_pcap_index(tmp_path):
+	for name in ("test006_le.pcapng", "test201.pcapng"):
+		file_name = str(tmp_path / name)
+		with open_fixture(name) as f, open(file_name, "wb") as out:
+			data = f.read()
+			out.write(data)
+		expected = read_pcap_file(io.BytesIO(data))
+		index = PcapIndex.for_file(file_name)
+		assert os.path.exists(file_name + INDEX_SUFFIX)
+		for index in (index, PcapIndex.for_file(file_name)):
+			assert len(index) == len(expected) and index.metadata == expected.metadata
+			for i, bbuf in enumerate(expected.buffers):
+				assert index.packet_metadata(i) == bbuf.metadata
+				assert index.read_packet(data, i).buffer == bbuf.buffer
+
+		stat = os.stat(file_name)
+		assert PcapIndex.load(file_name + INDEX_SUFFIX, stat.st_size, stat.st_mtime_ns) is not None
+		assert PcapIndex.load(file_name + INDEX_SUFFIX, stat.st_size + 1, stat.st_mtime_ns) is None
+
+
+def test_pcap_index_rejects_objects(tmp_path):
+	file_name = str(tmp_path / "test006_le.pcapng")
+	with open_fixture("test006_le.pcapng") as f, open(file_name, "wb") as out:
+		out.write(f.read())
+	index = PcapIndex.for_file(file_name)
+	PcapIndex(index.file_format, dict(index.metadata, foreign=ByteBuffer(b"data")), index.records, index.file_size,
+			  index.file_mtime).save(file_name + INDEX_SUFFIX)
+	stat = os.stat(file_name)
+	assert PcapIndex.load(file_name + INDEX_SUFFIX, stat.st_size, stat.st_mtime_ns) is None
+	# the index is rebuilt and replaced
+	assert PcapIndex.for_file(file_name).metadata == index.metadata
+	assert PcapIndex.load(file_name + INDEX_SUFFIX, stat.st_size, stat.st_mtime_ns).metadata == index.metadata
+
+
+def test_pcap_stream_decoder():
+	classic = struct.pack("<IHHiIII", 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1) \
+		+ b"".join(struct.pack("<IIII", i, 0, i, i) + bytes(range(i)) for i in range(20))
+	fixtures = [open_fixture(name).read() for name in ("test006_le.pcapng", "test006_be.pcapng", "test201.pcapng")]
+	for data in [classic] + fixtures:
+		expected = read_pcap_file(io.BytesIO(data))
+		for chunk_size in (1, 7, 100, len(data)):
+			decoder = PcapStreamDecoder()
+			packets = []
+			for i in range(0, len(data), chunk_size):
+				packets += decoder.feed(data[i:i + chunk_size])
+			assert [bbuf.buffer for bbuf in packets] == [bbuf.buffer for bbuf in expected.buffers]
+			assert [bbuf.metadata for bbuf in packets] == [bbuf.metadata for bbuf in expected.buffers]
+			assert decoder.metadata == expected.metadata
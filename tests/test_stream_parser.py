@@ -0,0 +1,84 @@
+import random
+
+from pre_workbench.structinfo.parsecontext import FormatInfoContainer, StreamParser, AnnotatingParseContext, ParseContext
+
+fic = FormatInfoContainer(load_from_string="""
+	record struct(endianness=">", charset="ascii") {
+		magic UINT8(magic=0x42)
+		len UINT16
+		name_len UINT8
+		name STRING[name_len]
+		data BYTES[len]
+	}
+	""")
+
+def make_record(i):
+	return b"\x42" + (i % 300).to_bytes(2, "big") + bytes([len(b"rec%d" % i)]) + b"rec%d" % i + bytes([i % 256]) * (i % 300)
+
+
+def test_chunked():
+	stream = b"".join(make_record(i) for i in range(200))
+	rnd = random.Random(1)
+	for max_chunk in [1, 7, 100, 5000, len(stream)]:
+		parser = StreamParser(fic)
+		records = []
+		pos = 0
+		while pos < len(stream):
+			n = rnd.randint(1, max_chunk)
+			records += parser.feed(stream[pos:pos+n])
+			pos += n
+		assert [r.value for r in records] == [{"magic": 0x42, "len": i % 300, "name_len": len("rec%d" % i), "name": "rec%d" % i, "data": bytes([i % 256]) * (i % 300)} for i in range(200)]
+		assert [r.buf for r in records] == [make_record(i) for i in range(200)]
+		assert records[10].offset == sum(len(make_record(i)) for i in range(10))
+		assert parser.buffered_bytes == 0 and parser.dropped_bytes == 0
+
+
+def test_waits_for_needed_bytes():
+	parser = StreamParser(fic)
+	rec = make_record(250)
+	assert parser.feed(rec[:20]) == []
+	assert parser.needed_bytes == len(rec)
+	assert parser.feed(rec[20:-1]) == []
+	assert len(parser.feed(rec[-1:] + rec[:3])) == 1
+	assert parser.buffered_bytes == 3 and parser.stream_offset == len(rec)
+
+
+def test_drop():
+	parser = StreamParser(fic, high_water_mark=100)
+	assert parser.feed(b"\x43" + make_record(1)) == []
+	assert parser.dropped_bytes == len(make_record(1)) + 1 and parser.last_error is not None
+	assert parser.feed(make_record(250)[:120]) == []
+	assert parser.dropped_bytes == len(make_record(1)) + 1 + 120
+	records = parser.feed(make_record(2))
+	assert len(records) == 1 and records[0].offset == len(make_record(1)) + 1 + 120
+
+
+def test_annotating_offsets():
+	parser = StreamParser(fic, context_class=AnnotatingParseContext)
+	records = parser.feed(make_record(3) + make_record(4)[:5]) + parser.feed(make_record(4)[5:])
+	assert [(r.value.start, r.value.end) for r in records] == [(0, 11), (11, 23)]
+	assert records[1].value.value["data"].start == 19
+
+
+def test_exception_message():
+	parser = StreamParser(fic)
+	assert parser.feed(make_record(250)[:20]) == []
+	ex = parser.preallocated_incomplete
+	assert ex.needed_bytes == 250 and ex.got_bytes == 10
+	assert str(ex).startswith("record.data: incomplete: needed 250, got 10 bytes\n")
+	assert "72 65 63 32 35 30" in str(ex)
+	assert parser.feed(make_record(250)[20:] + make_record(1)[:3]) != []
+	assert parser.preallocated_incomplete is ex and parser.needed_bytes == 4
+
+
+def test_exception_releases_buffer():
+	buf = bytearray(make_record(250)[:20])
+	ctx = ParseContext(fic, buf, zero_copy=True)
+	ctx.log_failures = False
+	ctx.parse()
+	ex = ctx.failed
+	# only the bytes shown in the hexdump are kept, not a view of the buffer
+	assert not any(isinstance(v, (memoryview, bytearray)) for v in vars(ex).values())
+	buf[:] = bytes(len(buf))
+	assert str(ex).startswith("record.data: incomplete: needed 250, got 10 bytes\n")
+	assert "72 65 63 32 35 30" in str(ex)